@@ -28,7 +28,9 @@
 import os
 import pwem
 
-from empiar.constants import ASPERA_PASS, ASCP_PATH, EMPIAR_TOKEN
+from empiar.constants import (ASPERA_PASS, ASCP_PATH, EMPIAR_TOKEN,
+                              EMPIAR_CATALOG, EMPIAR_CATALOG_DEFAULT,
+                              EMPIAR_STORE, EMPIAR_STORE_QUOTA)
 
 
 __version__ = '3.1.1'
@@ -45,6 +47,9 @@ class Plugin(pwem.Plugin):
         cls._defineVar(ASCP_PATH, os.path.expanduser('~/.aspera/connect/bin/ascp'))
         cls._defineVar(ASPERA_PASS, '')
         cls._defineVar(EMPIAR_TOKEN, '')
+        cls._defineVar(EMPIAR_CATALOG, os.path.expanduser(EMPIAR_CATALOG_DEFAULT))
+        cls._defineVar(EMPIAR_STORE, '')  # shared download store folder
+        cls._defineVar(EMPIAR_STORE_QUOTA, '0')  # GB, 0 for no limit
 
     @classmethod
     def defineBinaries(cls, env):
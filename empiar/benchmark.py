@@ -0,0 +1,417 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+""" Benchmark of the deposition creation on synthetic Scipion projects.
+
+A project is created with protocols whose outputs are generated on the
+fly (micrographs, CTFs, coordinates, particles, 2D classes and volumes,
+with random MRC data) and the depositor export is run on it, without
+making any deposition. Wall time per phase, rendered images per second,
+peak memory and bytes written are reported.
+
+Run it inside the Scipion environment, e.g.:
+    scipion3 python -m empiar.benchmark --micrographs 50 --particles 5000
+
+With --import-time, the time needed to load the plugin is measured
+instead (python -X importtime) and checked against a budget:
+    scipion3 python -m empiar.benchmark --import-time --import-budget 150
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import subprocess
+from contextlib import contextmanager
+
+import numpy as np
+
+MRC_HEADER_SIZE = 1024
+
+# Modules loaded by Scipion anyway, not counted in the plugin import time
+IMPORT_BASELINE = ('pyworkflow.protocol', 'pyworkflow.utils', 'pwem.protocols', 'pwem.objects')
+IMPORT_MODULES = ('empiar', 'empiar.protocols')
+IMPORT_BUDGET_MS = 150
+IMPORT_MARK = '--- empiar imports ---'
+# Modules that only some steps need, the plugin must not load them
+HEAVY_MODULES = ('numpy', 'PIL', 'matplotlib', 'jsonschema', 'requests',
+                 'empiar_depositor', 'pkg_resources', 'tifffile', 'emtable',
+                 'xmippLib', 'tomo')
+
+
+def writeMrc(fileName, data, samplingRate=1.0, isVolume=False):
+    """ Write a float32 MRC file (a stack if data has 3 dimensions and it
+    is not a volume). """
+    data = np.asarray(data, dtype=np.float32)
+    if data.ndim == 2:
+        data = data[None]
+    nz, ny, nx = data.shape
+    header = np.zeros(256, dtype='<i4')
+    header[:4] = nx, ny, nz, 2  # mode 2: float32
+    header[7:10] = nx, ny, nz
+    header[10:13] = (np.array([nx, ny, nz], dtype='<f4') * samplingRate).astype('<f4').view('<i4')
+    header[13:16] = np.array([90, 90, 90], dtype='<f4').view('<i4')
+    header[16:19] = 1, 2, 3
+    header[19:22] = np.array([data.min(), data.max(), data.mean()], dtype='<f4').view('<i4')
+    header[22] = 1 if isVolume else 0
+    headerBytes = bytearray(header.tobytes())
+    headerBytes[208:212] = b'MAP '
+    headerBytes[212:216] = b'\x44\x44\x00\x00'
+    with open(fileName, 'wb') as f:
+        f.write(headerBytes)
+        data.tofile(f)
+
+
+def countFiles(folder, extensions=('.jpg', '.png')):
+    return sum(1 for root, dirs, files in os.walk(folder)
+               for fn in files if fn.lower().endswith(extensions))
+
+
+def getPeakRss():
+    """ Peak resident memory (MB) of this process and of its children
+    (e.g. the thumbnail conversions). """
+    # ru_maxrss is in KB in Linux
+    return {'self': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            'children': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024}
+
+
+class SyntheticProject:
+    """ Build a Scipion project with protocols holding generated outputs.
+    The protocols are not run: each one is saved in the project, its
+    outputs are written and it is marked as finished. """
+    def __init__(self, name, micrographs=10, micSize=1024, particlesPerMic=100,
+                 boxSize=64, classes=10, volumes=1, volSize=128,
+                 samplingRate=1.0, seed=0):
+        self.name = name
+        self.micrographs = micrographs
+        self.micSize = micSize
+        self.particlesPerMic = particlesPerMic
+        self.boxSize = boxSize
+        self.classes = classes
+        self.volumes = volumes
+        self.volSize = volSize
+        self.samplingRate = samplingRate
+        self._random = np.random.default_rng(seed)
+        self.project = None
+        self.outputs = {}  # {output name: (protocol, output)}
+
+    def _noise(self, *shape):
+        return self._random.standard_normal(shape, dtype=np.float32)
+
+    def _newProtocol(self, label, **outputs):
+        from pyworkflow.protocol import STATUS_FINISHED
+        from pwem.protocols import EMProtocol
+        prot = self.project.newProtocol(EMProtocol, objLabel=label)
+        self.project.saveProtocol(prot)
+        prot.makePathsAndClean()
+        for name, outputFunc in outputs.items():
+            output = outputFunc(prot)
+            output.write()
+            prot._defineOutputs(**{name: output})
+            self.outputs[name] = (prot, output)
+        prot.setStatus(STATUS_FINISHED)
+        self.project._storeProtocol(prot)
+        return prot
+
+    def create(self):
+        from pyworkflow.project import Manager
+        self.project = Manager().createProject(self.name)
+        self._newProtocol('import micrographs', outputMicrographs=self._createMicrographs)
+        self._newProtocol('ctf estimation', outputCTF=self._createCtfs)
+        self._newProtocol('picking', outputCoordinates=self._createCoordinates)
+        self._newProtocol('extract particles', outputParticles=self._createParticles)
+        self._newProtocol('2D classification', outputClasses=self._createClasses)
+        self._newProtocol('import volumes', outputVolumes=self._createVolumes)
+        return self.project
+
+    def delete(self):
+        from pyworkflow.project import Manager
+        Manager().deleteProject(self.name)
+
+    def _createMicrographs(self, prot):
+        from pwem.objects import SetOfMicrographs, Micrograph, Acquisition
+        micSet = SetOfMicrographs.create(prot._getPath())
+        micSet.setSamplingRate(self.samplingRate)
+        micSet.setAcquisition(Acquisition(magnification=50000, voltage=300,
+                                          sphericalAberration=2.7, amplitudeContrast=0.1))
+        for i in range(1, self.micrographs + 1):
+            fileName = prot._getExtraPath(f'mic_{i:04d}.mrc')
+            writeMrc(fileName, self._noise(self.micSize, self.micSize), self.samplingRate)
+            mic = Micrograph(location=fileName)
+            mic.setMicName(os.path.basename(fileName))
+            micSet.append(mic)
+        return micSet
+
+    def _createCtfs(self, prot):
+        from pwem.objects import SetOfCTF, CTFModel
+        micSet = self.outputs['outputMicrographs'][1]
+        ctfSet = SetOfCTF.create(prot._getPath())
+        ctfSet.setMicrographs(micSet)
+        for mic in micSet:
+            psdFn = prot._getExtraPath(f'psd_{mic.getObjId():04d}.mrc')
+            writeMrc(psdFn, np.abs(self._noise(512, 512)), self.samplingRate)
+            ctf = CTFModel()
+            defocus = self._random.uniform(5000, 30000)
+            ctf.setStandardDefocus(defocus, defocus + 200, 45)
+            ctf.setMicrograph(mic)
+            ctf.setPsdFile(psdFn)
+            ctf.setResolution(self._random.uniform(3, 8))
+            ctfSet.append(ctf)
+        return ctfSet
+
+    def _createCoordinates(self, prot):
+        from pwem.objects import SetOfCoordinates, Coordinate
+        micSet = self.outputs['outputMicrographs'][1]
+        coordSet = SetOfCoordinates.create(prot._getPath())
+        coordSet.setMicrographs(micSet)
+        coordSet.setBoxSize(self.boxSize)
+        half = self.boxSize // 2
+        for mic in micSet:
+            for x, y in self._random.integers(half, self.micSize - half,
+                                              size=(self.particlesPerMic, 2)):
+                coord = Coordinate(x=int(x), y=int(y))
+                coord.setMicrograph(mic)
+                coordSet.append(coord)
+        return coordSet
+
+    def _createParticles(self, prot):
+        from pwem.objects import SetOfParticles, Particle
+        coordSet = self.outputs['outputCoordinates'][1]
+        partSet = SetOfParticles.create(prot._getPath())
+        partSet.setSamplingRate(self.samplingRate)
+        stackFn = prot._getExtraPath('particles.mrcs')
+        writeMrc(stackFn, self._noise(coordSet.getSize(), self.boxSize, self.boxSize),
+                 self.samplingRate)
+        for i, coord in enumerate(coordSet, 1):
+            part = Particle(location=(i, stackFn))
+            part.setCoordinate(coord)
+            part.setMicId(coord.getMicId())
+            partSet.append(part)
+        return partSet
+
+    def _createClasses(self, prot):
+        from pwem.objects import SetOfClasses2D, Class2D, Particle
+        partSet = self.outputs['outputParticles'][1]
+        classes = SetOfClasses2D.create(prot._getPath())
+        classes.setImages(partSet)
+        averagesFn = prot._getExtraPath('averages.mrcs')
+        writeMrc(averagesFn, self._noise(self.classes, self.boxSize, self.boxSize),
+                 self.samplingRate)
+        members = {ref: [] for ref in range(1, self.classes + 1)}
+        for part in partSet:
+            members[int(self._random.integers(1, self.classes + 1))].append(part.clone())
+        for ref, parts in members.items():
+            cls = Class2D()
+            cls.copyInfo(partSet)
+            cls.setObjId(ref)
+            cls.setRepresentative(Particle(location=(ref, averagesFn)))
+            classes.append(cls)
+            for part in parts:
+                cls.append(part)
+            classes.update(cls)
+        return classes
+
+    def _createVolumes(self, prot):
+        from pwem.objects import SetOfVolumes, Volume
+        volSet = SetOfVolumes.create(prot._getPath())
+        volSet.setSamplingRate(self.samplingRate)
+        for i in range(1, self.volumes + 1):
+            fileName = prot._getExtraPath(f'volume_{i:02d}.mrc')
+            writeMrc(fileName, self._noise(self.volSize, self.volSize, self.volSize),
+                     self.samplingRate, isVolume=True)
+            vol = Volume(location=fileName)
+            vol.setSamplingRate(self.samplingRate)
+            volSet.append(vol)
+        return volSet
+
+
+@contextmanager
+def timePhase(phases, name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        phases[name] = phases.get(name, 0) + time.perf_counter() - start
+
+
+def runBenchmark(synthetic, **depositorParams):
+    """ Create the project, run the deposition creation steps (without
+    depositing) and return the measurements as a dict. """
+    import pyworkflow.utils as pwutils
+    from pyworkflow.object import Pointer
+    from empiar.protocols import EmpiarDepositor
+    from empiar.constants import DIR_IMAGES, OUTPUT_WORKFLOW
+    from empiar.profiling import PhaseProfiler, getFolderSize
+
+    phases = {}
+    with timePhase(phases, 'project'):
+        project = synthetic.create()
+
+    depositor = project.newProtocol(EmpiarDepositor, objLabel='benchmark',
+                                    deposit=False, viewer=False, **depositorParams)
+    for name in ['outputMicrographs', 'outputParticles']:
+        prot = synthetic.outputs[name][0]
+        depositor.inputSets.append(Pointer(prot, extended=name))
+    project.saveProtocol(depositor)
+    depositor.makePathsAndClean()
+    depositor.entryTopLevel.set(depositor.entryTopLevel.get() or 'benchmark')
+    depositor._profiler = PhaseProfiler(enabled=True)
+
+    with timePhase(phases, 'total'):
+        pwutils.makePath(depositor.getTopLevelPath(DIR_IMAGES))
+        with timePhase(phases, 'exportWorkflow'):
+            depositor.exportWorkflow()
+        with timePhase(phases, 'analyzeDepositionTree'):
+            depositor.analyzeDepositionTree()
+        with timePhase(phases, 'processImageSets'):
+            depositor.processImageSets()
+
+    imagesDir = depositor.getTopLevelPath(DIR_IMAGES)
+    images = countFiles(imagesDir)
+    return {
+        'sizes': {'micrographs': synthetic.micrographs,
+                  'particles': synthetic.micrographs * synthetic.particlesPerMic,
+                  'classes': synthetic.classes, 'volumes': synthetic.volumes},
+        'phases': phases,
+        'images': images,
+        'imagesPerSecond': images / phases['exportWorkflow'] if phases['exportWorkflow'] else 0,
+        'peakRssMB': getPeakRss(),
+        'bytesWritten': {'images': getFolderSize(imagesDir)[0],
+                         'workflow': os.path.getsize(depositor.getTopLevelPath(OUTPUT_WORKFLOW)),
+                         'total': getFolderSize(depositor._getExtraPath())[0]},
+        'profile': depositor._profiler.getReport(),
+    }
+
+
+def printReport(report, out=sys.stdout):
+    out.write("Sizes: %s\n" % ", ".join(f"{k}={v}" for k, v in report['sizes'].items()))
+    out.write("Phases (s):\n")
+    for name, seconds in report['phases'].items():
+        out.write(f"  {name:<24}{seconds:10.2f}\n")
+    out.write(f"Images rendered: {report['images']} "
+              f"({report['imagesPerSecond']:.1f} images/s)\n")
+    out.write("Peak RSS (MB): self %(self).0f, children %(children).0f\n" % report['peakRssMB'])
+    out.write("Bytes written: %s\n" % ", ".join(f"{k}={v}" for k, v in report['bytesWritten'].items()))
+    out.write("Thumbnail subprocesses: %d\n"
+              % report['profile']['counters'].get('thumbnailSubprocesses', 0))
+    out.write("Time per output type (s):\n")
+    for outputType, seconds in report['profile']['outputTypes'].items():
+        out.write(f"  {outputType:<24}{seconds:10.2f}\n")
+
+
+def measureImportTime(modules=IMPORT_MODULES, baseline=IMPORT_BASELINE):
+    """ Import the plugin in a fresh interpreter with -X importtime.
+    :return: dict with the self time (ms) of each module loaded by the
+        plugin, i.e. not already loaded by the baseline modules
+    """
+    code = "; ".join(["import sys"] + [f"import {m}" for m in baseline]
+                     + [f"sys.stderr.write({IMPORT_MARK!r} + '\\n')"]
+                     + [f"import {m}" for m in modules])
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                            stderr=subprocess.PIPE, universal_newlines=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Could not import {', '.join(modules)}:\n{result.stderr}")
+
+    lines = result.stderr.splitlines()
+    times = {}
+    # lines are "import time: self [us] | cumulative | module"
+    for line in lines[lines.index(IMPORT_MARK) + 1:]:
+        if line.startswith('import time:') and '|' in line:
+            selfTime, _, module = line[len('import time:'):].split('|')
+            if selfTime.strip().isdigit():
+                times[module.strip()] = int(selfTime) / 1000
+    return times
+
+
+def checkImportTime(budget=IMPORT_BUDGET_MS, out=sys.stdout):
+    """ Report the plugin import time and return the list of problems:
+    budget exceeded or heavy modules loaded. """
+    times = measureImportTime()
+    total = sum(times.values())
+    out.write(f"Plugin import time: {total:.1f} ms (budget {budget} ms), "
+              f"{len(times)} modules\n")
+    for module, ms in sorted(times.items(), key=lambda t: -t[1])[:10]:
+        out.write(f"  {module:<40}{ms:10.1f}\n")
+
+    errors = []
+    if total > budget:
+        errors.append(f"Import time {total:.1f} ms exceeds the budget of {budget} ms")
+    heavy = sorted(m for m in times if m.split('.')[0] in HEAVY_MODULES)
+    if heavy:
+        errors.append("Heavy modules loaded at import: " + ", ".join(heavy))
+    for error in errors:
+        out.write(f"ERROR: {error}\n")
+    return errors
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Benchmark the EMPIAR deposition creation "
+                                                 "on a synthetic project")
+    parser.add_argument('--name', default='empiar_benchmark', help="Project name")
+    parser.add_argument('--micrographs', type=int, default=10)
+    parser.add_argument('--mic-size', type=int, default=1024, help="Micrograph side (px)")
+    parser.add_argument('--particles', type=int, default=1000,
+                        help="Total number of particles (spread over the micrographs)")
+    parser.add_argument('--box-size', type=int, default=64)
+    parser.add_argument('--classes', type=int, default=10)
+    parser.add_argument('--volumes', type=int, default=1)
+    parser.add_argument('--vol-size', type=int, default=128, help="Volume side (px)")
+    parser.add_argument('--sampling-policies', default=None,
+                        help="Sampling policies of the depositor (as in its form)")
+    parser.add_argument('--json', help="Also write the report to this json file")
+    parser.add_argument('--keep', action='store_true', help="Do not delete the project")
+    parser.add_argument('--import-time', action='store_true',
+                        help="Only check the plugin import time, failing if it "
+                             "exceeds the budget or loads heavy modules")
+    parser.add_argument('--import-budget', type=float, default=IMPORT_BUDGET_MS,
+                        help="Import time budget (ms)")
+    args = parser.parse_args(args)
+
+    if args.import_time:
+        return 1 if checkImportTime(args.import_budget) else 0
+
+    synthetic = SyntheticProject(args.name, micrographs=args.micrographs, micSize=args.mic_size,
+                                 particlesPerMic=max(args.particles // max(args.micrographs, 1), 1),
+                                 boxSize=args.box_size, classes=args.classes,
+                                 volumes=args.volumes, volSize=args.vol_size)
+    depositorParams = {}
+    if args.sampling_policies is not None:
+        depositorParams['samplingPolicies'] = args.sampling_policies
+    try:
+        report = runBenchmark(synthetic, **depositorParams)
+    finally:
+        if not args.keep and synthetic.project is not None:
+            synthetic.delete()
+
+    printReport(report)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=4)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,249 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+""" Local cache of remote files with a size limit. The files of a dataset
+are listed in a manifest (local path -> remote path, size) without being
+downloaded; each one is fetched the first time it is opened through the
+cache and the least recently used ones are removed to stay under the
+size limit. Pinned files (e.g. movies in use by a workflow) are never
+removed. The cache state is kept in a sqlite database inside the cache
+folder, so several processes can share it. E.g.:
+    python -m empiar.cache <cache folder> fetch [--pin OWNER] <movie files...>
+    python -m empiar.cache <cache folder> unpin [--owner OWNER] <movie files...>
+    python -m empiar.cache <cache folder> status
+"""
+
+import os
+import sys
+import time
+import fcntl
+import sqlite3
+import argparse
+from contextlib import contextmanager, closing
+
+CACHE_DB = '.empiar_cache.sqlite'
+LOCKS_DIR = '.locks'
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS manifest (path TEXT PRIMARY KEY, remote TEXT, size INTEGER);
+CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, last_access REAL);
+CREATE TABLE IF NOT EXISTS pins (path TEXT, owner TEXT, PRIMARY KEY (path, owner));
+"""
+
+
+class CacheFullError(Exception):
+    """ Raised when a file does not fit in the cache because the rest of
+    files are pinned. """
+    pass
+
+
+@contextmanager
+def fileLock(lockFn, blocking=True):
+    """ Exclusive lock (between processes) on a lock file.
+    :raise BlockingIOError: if not blocking and the lock is taken
+    """
+    with open(lockFn, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class LruFileCache:
+    """ Fetch on open cache of remote files, with LRU eviction.
+    :param folder: cache folder, local paths are relative to it
+    :param fetch: function(remote path, local file) downloading a file.
+    :param maxBytes: size limit, stored in the cache (None keeps the stored one)
+    """
+    def __init__(self, folder, fetch, maxBytes=None, server=None):
+        self.folder = os.path.realpath(folder)
+        os.makedirs(self.folder, exist_ok=True)
+        self._fetch = fetch
+        self._dbFn = os.path.join(self.folder, CACHE_DB)
+        with self._connect() as db:
+            db.executescript(SCHEMA)
+            if maxBytes is not None:
+                db.execute("INSERT OR REPLACE INTO settings VALUES ('maxBytes', ?)", (str(maxBytes),))
+            if server is not None:
+                db.execute("INSERT OR REPLACE INTO settings VALUES ('server', ?)", (server,))
+
+    @contextmanager
+    def _connect(self):
+        with closing(sqlite3.connect(self._dbFn, timeout=60)) as db:
+            with db:  # commit or rollback
+                yield db
+
+    def getSetting(self, key, default=None):
+        with self._connect() as db:
+            row = db.execute("SELECT value FROM settings WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    @property
+    def maxBytes(self):
+        return int(self.getSetting('maxBytes', 0)) or None
+
+    def getPath(self, relPath):
+        return os.path.join(self.folder, relPath)
+
+    def _relPath(self, path):
+        """ Path relative to the cache of a relative path, an absolute one
+        or a link to a file of the cache (e.g. the registered movies). """
+        if not os.path.isabs(path) and not os.path.islink(path):
+            return path
+        return os.path.relpath(os.path.realpath(path), self.folder)
+
+    def addToManifest(self, files):
+        """ Register remote files without fetching them.
+        :param files: iterable of (local relative path, remote path, size)
+        """
+        with self._connect() as db:
+            db.executemany("INSERT OR REPLACE INTO manifest VALUES (?, ?, ?)", files)
+
+    def open(self, path, pin=None):
+        """ Return the local file of a path of the cache, fetching it first
+        if it is not there yet.
+        :param pin: optional owner (e.g. a protocol folder) pinning the file,
+            so it is not removed until unpinned
+        :raise CacheFullError: if there is no room for the file
+        """
+        relPath = self._relPath(path)
+        localFn = self.getPath(relPath)
+        if not os.path.exists(localFn):
+            # only one process fetches a file, the others wait for it
+            os.makedirs(os.path.dirname(localFn), exist_ok=True)
+            with fileLock(self._getLockFn(relPath)):
+                if not os.path.exists(localFn):
+                    self._fetchFile(relPath, localFn)
+        with self._connect() as db:
+            # pinned in the same transaction it becomes evictable
+            db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?)",
+                       (relPath, os.path.getsize(localFn), time.time()))
+            if pin is not None:
+                db.execute("INSERT OR IGNORE INTO pins VALUES (?, ?)", (relPath, pin))
+        return localFn
+
+    def unpin(self, paths=None, owner=None):
+        """ Remove the pins of the given paths (all if None), only those of
+        an owner if given, so the files can be evicted again. """
+        query, args = "DELETE FROM pins WHERE 1", []
+        if owner is not None:
+            query += " AND owner = ?"
+            args.append(owner)
+        with self._connect() as db:
+            if paths is None:
+                db.execute(query, args)
+            else:
+                db.executemany(query + " AND path = ?",
+                               [args + [self._relPath(p)] for p in paths])
+
+    def _getLockFn(self, relPath):
+        locksFolder = os.path.join(self.folder, LOCKS_DIR)
+        os.makedirs(locksFolder, exist_ok=True)
+        return os.path.join(locksFolder, relPath.replace(os.sep, '__') + '.lock')
+
+    def _fetchFile(self, relPath, localFn):
+        with self._connect() as db:
+            row = db.execute("SELECT remote, size FROM manifest WHERE path = ?", (relPath,)).fetchone()
+        if row is None:
+            raise FileNotFoundError(f"{relPath} is not in the cache manifest")
+        remote, size = row
+        if not self.makeRoom(size or 0, keep=relPath):
+            raise CacheFullError(f"No room for {relPath} ({size} bytes) in the cache, "
+                                 f"the rest of files are pinned")
+        tmpFn = f'{localFn}.part{os.getpid()}'
+        try:
+            self._fetch(remote, tmpFn)
+            os.replace(tmpFn, localFn)
+        finally:
+            if os.path.exists(tmpFn):
+                os.remove(tmpFn)
+
+    def makeRoom(self, size, keep=None):
+        """ Remove the least recently used files, except the pinned ones,
+        until size more bytes fit. Return False if they do not fit. """
+        maxBytes = self.maxBytes
+        if not maxBytes:
+            return True
+        with self._connect() as db:
+            db.execute("BEGIN IMMEDIATE")  # one process evicting at a time
+            files = db.execute("SELECT path, size FROM files ORDER BY last_access").fetchall()
+            pinned = {row[0] for row in db.execute("SELECT DISTINCT path FROM pins")}
+            used = sum(fileSize for _, fileSize in files)
+            for relPath, fileSize in files:
+                if used + size <= maxBytes:
+                    break
+                if relPath == keep or relPath in pinned:
+                    continue
+                localFn = self.getPath(relPath)
+                if os.path.exists(localFn):
+                    os.remove(localFn)
+                db.execute("DELETE FROM files WHERE path = ?", (relPath,))
+                used -= fileSize
+        return used + size <= maxBytes
+
+    def getManifest(self):
+        """ Return the list of (local relative path, remote path, size). """
+        with self._connect() as db:
+            return db.execute("SELECT path, remote, size FROM manifest ORDER BY path").fetchall()
+
+    def getStatus(self):
+        with self._connect() as db:
+            files, used = db.execute("SELECT count(*), coalesce(sum(size), 0) FROM files").fetchone()
+            listed, total = db.execute("SELECT count(*), coalesce(sum(size), 0) FROM manifest").fetchone()
+            pinned = db.execute("SELECT count(DISTINCT path) FROM pins").fetchone()[0]
+        return {'files': files, 'bytes': used, 'maxBytes': self.maxBytes,
+                'pinnedFiles': pinned, 'manifestFiles': listed, 'manifestBytes': total}
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Fetch on open cache of EMPIAR files")
+    parser.add_argument('folder', help="Cache folder")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    fetch = subparsers.add_parser('fetch', help="Make sure the files are in the cache")
+    fetch.add_argument('--pin', metavar='OWNER', help="Pin the files (not evicted until unpinned)")
+    fetch.add_argument('files', nargs='+')
+    unpin = subparsers.add_parser('unpin', help="Let the files be evicted again")
+    unpin.add_argument('--owner', help="Only remove the pins of this owner")
+    unpin.add_argument('files', nargs='*', help="Files to unpin, all if none is given")
+    subparsers.add_parser('status', help="Cache usage")
+    args = parser.parse_args(args)
+
+    from empiar.utils import FTPDownloader
+    cache = LruFileCache(args.folder, fetch=None)
+    downloader = FTPDownloader(cache.getSetting('server'))
+    cache._fetch = downloader.fetchFile
+    if args.command == 'fetch':
+        for fn in args.files:
+            print(cache.open(fn, pin=args.pin))
+    elif args.command == 'unpin':
+        cache.unpin(args.files or None, owner=args.owner)
+    else:
+        for key, value in cache.getStatus().items():
+            print(f"{key}: {value}")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,319 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+""" Local catalog of EMPIAR entries, to search datasets offline.
+
+The metadata of the entries and their image sets is downloaded from the
+EMPIAR API only once (entries already in the catalog are skipped) and
+stored in a sqlite database with a full text index of the titles and
+image set descriptions. E.g.:
+    python -m empiar.catalog update --first 10001 --last 12000
+    python -m empiar.catalog search category=multiframe format=tiff maxPixel=1 minImages=5000
+"""
+
+import os
+import sys
+import json
+import time
+import sqlite3
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+from empiar.constants import EMPIAR_CATALOG, EMPIAR_CATALOG_DEFAULT
+
+EMPIAR_API_ENTRY = 'https://www.ebi.ac.uk/empiar/api/entry/'
+FETCH_THREADS = 8
+FETCH_TIMEOUT = 60  # seconds
+# entries not found are requested again after this time (they may have been
+# released since), those after the last entry in the catalog always are
+MISSING_RETRY_DAYS = 30
+COMMIT_EVERY = 50
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    entry_id TEXT PRIMARY KEY, title TEXT, release_date TEXT,
+    dataset_size TEXT, fetched REAL);
+CREATE TABLE IF NOT EXISTS imagesets (
+    entry_id TEXT, name TEXT, category TEXT, data_format TEXT,
+    voxel_type TEXT, pixel_width REAL, image_width INTEGER,
+    image_height INTEGER, frames INTEGER, images INTEGER, directory TEXT);
+CREATE INDEX IF NOT EXISTS imagesets_entry ON imagesets(entry_id);
+CREATE TABLE IF NOT EXISTS missing (entry_id TEXT PRIMARY KEY, checked REAL);
+"""
+FTS_SCHEMA = ("CREATE VIRTUAL TABLE IF NOT EXISTS entries_fts "
+              "USING fts5(entry_id UNINDEXED, title, details)")
+
+# query keys: (sql condition, value conversion)
+FILTERS = {
+    'category': ("i.category LIKE ?", lambda v: f'%{v}%'),
+    'format': ("i.data_format LIKE ?", lambda v: f'%{v}%'),
+    'voxelType': ("i.voxel_type LIKE ?", lambda v: f'%{v}%'),
+    'minPixel': ("i.pixel_width >= ?", float),
+    'maxPixel': ("i.pixel_width <= ?", float),
+    'minImages': ("i.images >= ?", int),
+    'maxImages': ("i.images <= ?", int),
+    'minFrames': ("i.frames >= ?", int),
+    'maxFrames': ("i.frames <= ?", int),
+}
+RESULT_COLUMNS = ['entry_id', 'title', 'name', 'category', 'data_format',
+                  'pixel_width', 'frames', 'images', 'directory']
+
+
+def fetchEntry(entryId):
+    """ Return the json of an entry from the EMPIAR API or None if it does
+    not exist. """
+    import requests
+    response = requests.get(EMPIAR_API_ENTRY + entryId, allow_redirects=True,
+                            timeout=FETCH_TIMEOUT)
+    if response.status_code == 404:
+        return None
+    response.raise_for_status()
+    return response.json()
+
+
+def _toNumber(value, func=float):
+    try:
+        return func(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def parseEntry(entryId, content):
+    """ Return the entry row and the image set rows of an API entry json. """
+    entry = content.get(f'EMPIAR-{entryId}', content)
+    entryRow = (entryId, entry.get('title'), entry.get('release_date'),
+                str(entry.get('dataset_size', '')), time.time())
+    imageSetRows = []
+    for imageSet in entry.get('imagesets', []):
+        imageSetRows.append((
+            entryId, imageSet.get('name'), imageSet.get('category'),
+            imageSet.get('data_format'), imageSet.get('voxel_type'),
+            _toNumber(imageSet.get('pixel_width')),
+            _toNumber(imageSet.get('image_width'), int),
+            _toNumber(imageSet.get('image_height'), int),
+            _toNumber(imageSet.get('frames_per_image'), int),
+            _toNumber(imageSet.get('num_images_or_tilt_series'), int),
+            imageSet.get('directory')))
+    details = ' '.join(str(imageSet.get(key) or '') for imageSet in entry.get('imagesets', [])
+                       for key in ('name', 'category', 'details'))
+    return entryRow, imageSetRows, details
+
+
+def ftsQuery(text):
+    """ Quote the words of a text search as FTS5 strings, so characters
+    like '-' or '"' are not read as query syntax. The operators AND, OR,
+    NOT and a trailing '*' (prefix search) are kept. """
+    terms = []
+    for token in text.split():
+        if token in ('AND', 'OR', 'NOT'):
+            terms.append(token)
+            continue
+        word = token.rstrip('*')
+        if word:
+            terms.append('"%s"%s' % (word.replace('"', '""'), '*' if word != token else ''))
+    # operators at the ends are not valid
+    while terms and terms[-1] in ('AND', 'OR', 'NOT'):
+        terms.pop()
+    while terms and terms[0] in ('AND', 'OR', 'NOT'):
+        terms.pop(0)
+    return ' '.join(terms)
+
+
+def parseQuery(query):
+    """ Parse a query like 'ribosome category=multiframe maxPixel=1' into
+    the keyword arguments of EmpiarCatalog.search. """
+    kwargs = {}
+    words = []
+    for token in query.replace(',', ' ').split():
+        key, sep, value = token.partition('=')
+        if sep and key in FILTERS:
+            kwargs[key] = value
+        elif sep:
+            raise ValueError(f"Unknown catalog filter '{key}', valid ones are: "
+                             f"{', '.join(FILTERS)}")
+        else:
+            words.append(token)
+    if words:
+        kwargs['text'] = ' '.join(words)
+    return kwargs
+
+
+class EmpiarCatalog:
+    """ sqlite catalog of EMPIAR entries and their image sets. """
+    def __init__(self, dbPath):
+        folder = os.path.dirname(os.path.abspath(dbPath))
+        os.makedirs(folder, exist_ok=True)
+        self._db = sqlite3.connect(dbPath)
+        self._db.executescript(SCHEMA)
+        try:
+            self._db.execute(FTS_SCHEMA)
+            self.hasFts = True
+        except sqlite3.OperationalError:  # sqlite built without FTS5
+            self.hasFts = False
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def getEntryIds(self):
+        return {row[0] for row in self._db.execute("SELECT entry_id FROM entries")}
+
+    def getMissingIds(self, checkedSince=None):
+        """ Ids of the entries found not to exist, only the ones checked
+        after the checkedSince time if given. """
+        return {row[0] for row in self._db.execute("SELECT entry_id FROM missing WHERE checked >= ?",
+                                                   (checkedSince or 0,))}
+
+    def store(self, entryId, content):
+        """ Add (or replace) an entry; content None means it does not exist. """
+        self._db.execute("DELETE FROM imagesets WHERE entry_id = ?", (entryId,))
+        if self.hasFts:
+            self._db.execute("DELETE FROM entries_fts WHERE entry_id = ?", (entryId,))
+        if content is None:
+            self._db.execute("DELETE FROM entries WHERE entry_id = ?", (entryId,))
+            self._db.execute("INSERT OR REPLACE INTO missing VALUES (?, ?)", (entryId, time.time()))
+            return
+        entryRow, imageSetRows, details = parseEntry(entryId, content)
+        self._db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)", entryRow)
+        self._db.executemany("INSERT INTO imagesets VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                             imageSetRows)
+        if self.hasFts:
+            self._db.execute("INSERT INTO entries_fts VALUES (?, ?, ?)",
+                             (entryId, entryRow[1], details))
+        self._db.execute("DELETE FROM missing WHERE entry_id = ?", (entryId,))
+
+    def update(self, entryIds, refresh=False, fetch=fetchEntry,
+               threads=FETCH_THREADS, retryDays=MISSING_RETRY_DAYS, log=print):
+        """ Download the entries that are not in the catalog yet (all of
+        them if refresh) using several threads. Entries found not to exist
+        are remembered too, and requested again when they were checked
+        more than retryDays ago or are after the last entry in the catalog.
+        Return the number of entries fetched. """
+        entryIds = [str(entryId) for entryId in entryIds]
+        if not refresh:
+            known = self.getEntryIds()
+            lastId = max((int(entryId) for entryId in known), default=0)
+            known |= {entryId for entryId in self.getMissingIds(time.time() - retryDays * 86400)
+                      if int(entryId) < lastId}
+            entryIds = [entryId for entryId in entryIds if entryId not in known]
+
+        def safeFetch(entryId):
+            try:
+                return entryId, fetch(entryId), None
+            except Exception as e:
+                return entryId, None, e
+
+        fetched = 0
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            # the database is only written from this thread
+            for entryId, content, error in executor.map(safeFetch, entryIds):
+                if error is not None:
+                    log(f"EMPIAR-{entryId} could not be read: {error}")
+                    continue
+                self.store(entryId, content)
+                fetched += 1
+                if fetched % COMMIT_EVERY == 0:
+                    self._db.commit()
+        self._db.commit()
+        return fetched
+
+    def search(self, text=None, limit=None, **filters):
+        """ Return the image sets (as dicts with RESULT_COLUMNS) matching
+        all the filters (see FILTERS) and, if given, the text (in the
+        entry title or image set names and details). """
+        conditions, args = [], []
+        for key, value in filters.items():
+            if value in (None, ''):
+                continue
+            if key not in FILTERS:
+                raise ValueError(f"Unknown catalog filter '{key}'")
+            condition, convert = FILTERS[key]
+            conditions.append(condition)
+            args.append(convert(value))
+        if text and self.hasFts:
+            text = ftsQuery(text)
+            if text:
+                conditions.append("e.entry_id IN (SELECT entry_id FROM entries_fts "
+                                  "WHERE entries_fts MATCH ?)")
+                args.append(text)
+        elif text:
+            conditions.append("e.title LIKE ?")
+            args.append(f'%{text}%')
+
+        query = ("SELECT %s FROM imagesets i JOIN entries e ON i.entry_id = e.entry_id"
+                 % ', '.join(f'e.{c}' if c in ('entry_id', 'title') else f'i.{c}'
+                             for c in RESULT_COLUMNS))
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY CAST(e.entry_id AS INTEGER) DESC"
+        if limit:
+            query += " LIMIT %d" % int(limit)
+        return [dict(zip(RESULT_COLUMNS, row)) for row in self._db.execute(query, args)]
+
+
+def formatResult(result):
+    """ One line description of a search result, starting with the entry id. """
+    return ("%(entry_id)s  %(title)s | %(name)s: %(category)s, %(data_format)s, "
+            "%(pixel_width)s A/px, %(images)s images x %(frames)s frames" % result)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Local catalog of EMPIAR entries")
+    parser.add_argument('--db', help="Catalog database (by default, the one in "
+                                      "the %s variable)" % EMPIAR_CATALOG,
+                        default=os.environ.get(EMPIAR_CATALOG,
+                                               os.path.expanduser(EMPIAR_CATALOG_DEFAULT)))
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    update = subparsers.add_parser('update', help="Add the entries not in the catalog yet")
+    update.add_argument('--first', type=int, default=10001, help="First entry id")
+    update.add_argument('--last', type=int, required=True, help="Last entry id")
+    update.add_argument('--refresh', action='store_true', help="Download all entries again")
+    update.add_argument('--threads', type=int, default=FETCH_THREADS)
+    update.add_argument('--retry-days', type=float, default=MISSING_RETRY_DAYS,
+                        help="Request again the entries not found this number of days ago")
+    search = subparsers.add_parser('search', help="Search the catalog, e.g. "
+                                                  "'ribosome format=tiff maxPixel=1'")
+    search.add_argument('query', nargs='*', help="Words and filters (%s)" % ', '.join(FILTERS))
+    search.add_argument('--limit', type=int)
+    args = parser.parse_args(args)
+
+    with EmpiarCatalog(args.db) as catalog:
+        if args.command == 'update':
+            fetched = catalog.update(range(args.first, args.last + 1),
+                                     refresh=args.refresh, threads=args.threads,
+                                     retryDays=args.retry_days)
+            print(f"{fetched} entries fetched, {len(catalog.getEntryIds())} in the catalog")
+        else:
+            for result in catalog.search(limit=args.limit, **parseQuery(' '.join(args.query))):
+                print(formatResult(result))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,150 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+""" Bulk, columnar reads of Scipion sets straight from their sqlite files.
+This avoids instantiating one Scipion object per row when only a few
+attributes of every item are needed (statistics, plots...). """
+
+import os
+import sqlite3
+from contextlib import closing
+
+import numpy as np
+
+# Columns of the Objects table that are not mapped in the Classes table
+RESERVED_COLUMNS = {'id': 'id', '_objId': 'id', 'enabled': 'enabled',
+                    'label': 'label', 'comment': 'comment',
+                    'creation': 'creation'}
+CHUNK_SIZE = 100000
+# values per IN (...) filter, under the sqlite limit of bound variables
+MAX_VARIABLES = 900
+
+
+def batches(values, size=MAX_VARIABLES):
+    """ Split a list of values (e.g. ids for an IN filter) into lists of
+    at most size values. """
+    values = list(values)
+    return [values[i:i + size] for i in range(0, len(values), size)]
+
+
+def normalizePrefix(prefix):
+    """ Return the prefix of the tables as SqliteFlatDb uses it, e.g. the
+    items of a class with prefix 'Class001' are in Class001_Objects. """
+    prefix = (prefix or '').strip()
+    if prefix and not prefix.endswith('_'):
+        prefix += '_'
+    return prefix
+
+
+class SetColumnReader:
+    """ Read some attributes of all items of a set as NumPy arrays.
+    Attributes are referred by their Scipion label (e.g. _defocusU or
+    _micObj._micName) and translated into the sqlite columns (c01, c02...)
+    through the Classes table of the set. """
+    def __init__(self, dbPath, prefix=''):
+        self._dbPath = dbPath
+        self._prefix = normalizePrefix(prefix)
+        self._columnsMap = None
+
+    @classmethod
+    def fromSet(cls, emSet):
+        """ Return a reader for the given set or None if its sqlite
+        is not available (e.g. the set is only in memory). """
+        dbPath = emSet.getFileName()
+        if not dbPath or not os.path.exists(dbPath):
+            return None
+        return cls(dbPath, emSet.getPrefix())
+
+    def _connect(self):
+        # read only, so it does not interfere with the protocol owning the set
+        return sqlite3.connect(f'file:{self._dbPath}?mode=ro', uri=True)
+
+    def getColumnsMap(self):
+        """ Return a dict {attribute label: sqlite column}. """
+        if self._columnsMap is None:
+            self._columnsMap = dict(RESERVED_COLUMNS)
+            with closing(self._connect()) as conn:
+                rows = conn.execute(f'SELECT label_property, column_name '
+                                    f'FROM {self._prefix}Classes')
+                for label, column in rows:
+                    if label != 'self':
+                        self._columnsMap[label] = column
+        return self._columnsMap
+
+    def hasColumns(self, *labels):
+        columnsMap = self.getColumnsMap()
+        return all(label in columnsMap for label in labels)
+
+    def _buildQuery(self, labels, filters):
+        columnsMap = self.getColumnsMap()
+        columns = ', '.join(columnsMap[label] for label in labels)
+        query = f'SELECT {columns} FROM {self._prefix}Objects'
+        args = []
+        conditions = []
+        for label, values in (filters or {}).items():
+            values = list(values)
+            conditions.append(f"{columnsMap[label]} IN ({','.join('?' * len(values))})")
+            args.extend(values)
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        return query + ' ORDER BY id', args
+
+    def iterChunks(self, *labels, filters=None, chunkSize=CHUNK_SIZE):
+        """ Yield lists of row tuples, with at most chunkSize rows each,
+        so memory stays bounded for very large sets.
+        :param labels: attribute labels to read
+        :param filters: optional dict {label: allowed values}. A filter with
+            many values is split into several queries (rows are then sorted
+            by id only within each of them)
+        """
+        filters = {label: list(values) for label, values in (filters or {}).items()}
+        # only the longest filter is split, the others must fit in one query
+        longest = max(filters, key=lambda label: len(filters[label]), default=None)
+        for values in batches(filters[longest]) if longest else [None]:
+            if longest:
+                filters[longest] = values
+            query, args = self._buildQuery(labels, filters)
+            with closing(self._connect()) as conn:
+                cursor = conn.execute(query, args)
+                while True:
+                    rows = cursor.fetchmany(chunkSize)
+                    if not rows:
+                        break
+                    yield rows
+
+    def read(self, *labels, filters=None, dtypes=None):
+        """ Read the given attributes and return a dict {label: array}.
+        :param dtypes: optional dict {label: dtype}, float64 by default;
+            use object for strings
+        """
+        dtypes = dtypes or {}
+        chunks = {label: [] for label in labels}
+        for rows in self.iterChunks(*labels, filters=filters):
+            for label, values in zip(labels, zip(*rows)):
+                chunks[label].append(np.asarray(values, dtype=dtypes.get(label, np.float64)))
+
+        return {label: (np.concatenate(arrays) if arrays
+                        else np.empty(0, dtype=dtypes.get(label, np.float64)))
+                for label, arrays in chunks.items()}
@@ -34,6 +34,10 @@ ASCP_PATH = "ASCP"
 ASPERA_PASS = "ASPERA_SCP_PASS"
 EMPIAR_TOKEN = "EMPIAR_TOKEN"
 EMPIAR_DEVEL_MODE = "EMPIAR_DEVEL_MODE"
+EMPIAR_CATALOG = "EMPIAR_CATALOG"
+EMPIAR_CATALOG_DEFAULT = '~/.empiar/catalog.sqlite'
+EMPIAR_STORE = "EMPIAR_STORE"
+EMPIAR_STORE_QUOTA = "EMPIAR_STORE_QUOTA"
 
 
 # Protocols constants below
@@ -45,6 +49,13 @@ DATA_FORMATS = {
     "HDF5": [".hdf"]
 }
 
+# Extensions of the files that can be converted into an item representation
+IMAGE_EXTENSIONS = {'.mrc', '.mrcs', '.map', '.st', '.stk', '.spi', '.vol',
+                    '.xmp', '.img', '.hed', '.em', '.hdf', '.tif', '.tiff',
+                    '.dm4', '.jpg', '.png'}
+# MRC files that are memory mapped instead of read with the image handler
+MRC_EXTENSIONS = ('.mrc', '.mrcs')
+
 IMAGESETFORMATS = {
     'mrc': 'T1',
     'mrcs': 'T2',
@@ -117,6 +128,30 @@ ITEM_REPRESENTATION = 'item_representation'
 
 DIR_IMAGES = 'images_representation'
 DIR_VIEWER = 'web-workflow-viewer'
+VIEWER_PID = 'viewer.pid'
+VIEWER_LOG = 'viewer.log'
+VIEWER_START_TIMEOUT = 10  # seconds
+WORKFLOW_INDEX = 'workflow_index.json'
+WORKFLOW_SHARDS_DIR = 'workflow_shards'
+PROFILE_REPORT = 'profile_report.json'
+PROFILE_STATS = 'profile.prof'
+PROFILE_TOP = 10
+PROFILE_NONE = 0
+PROFILE_TIMINGS = 1
+PROFILE_CPROFILE = 2
+SCAN_CACHE = 'image_headers_cache.json'
+SCAN_REPORT = 'image_sets_scan.json'
+# image sets whose files are stacks with a variable number of images
+STACK_SETS = ('SetOfParticles', 'SetOfAverages', 'SetOfMovieParticles')
+WORKFLOW_CACHE_DIR = 'workflow_cache'
+UPLOAD_DIR = 'upload'
+# aspera folders of the entries (as used by empiar-depositor)
+EMPIAR_UPLOAD_DIR = 'upload'
+EMPIAR_DEVEL_UPLOAD_DIR = 'tmp/andrii'
+TREE_REPORT = 'deposition_tree.json'
+
+WORKFLOW_ALL = 0
+WORKFLOW_ANCESTORS = 1
 
 SCIPION_WORKFLOW_KEY = 'workflow_file'
 SCIPION_WORKFLOW = 'path'
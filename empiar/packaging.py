@@ -0,0 +1,179 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+""" Place files into the deposition tree spending as little I/O and
+disk as the file system allows. """
+
+import os
+import gzip
+import shutil
+import fnmatch
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+REFLINK = 'reflink'
+HARDLINK = 'hardlink'
+COPY = 'copy'
+
+FICLONE = 0x40049409  # ioctl to share the file extents (btrfs, xfs...)
+
+KB = 1024
+MB = 1024 * KB
+GB = 1024 * MB
+# upper limits of the size histogram buckets
+SIZE_BUCKETS = [4 * KB, 64 * KB, MB, 16 * MB, 256 * MB, 4 * GB]
+# files that are usually not worth uploading
+INTERMEDIATE_PATTERNS = ['*/tmp/*', '*/Tmp/*', '*.tmp', '*_tmp.*', '*.bak', '*~',
+                         '*/__pycache__/*']
+
+LOG_COPY = 0
+LOG_GZIP = 1
+LOG_TAIL = 2
+
+
+def reflink(src, dst):
+    """ Clone src into dst (copy on write). Raise OSError if the file
+    system does not support it. """
+    if fcntl is None:
+        raise OSError("Reflinks are not supported on this platform")
+    with open(src, 'rb') as fSrc, open(dst, 'wb') as fDst:
+        try:
+            fcntl.ioctl(fDst.fileno(), FICLONE, fSrc.fileno())
+        except OSError:
+            fDst.close()
+            os.remove(dst)
+            raise
+
+
+def linkOrCopy(src, dst):
+    """ Make dst have the same content as src using, in order of preference,
+    a reflink, a hard link or a plain copy. Return the method used. """
+    if os.path.lexists(dst):
+        os.remove(dst)
+    src = os.path.realpath(src)
+
+    try:
+        reflink(src, dst)
+        return REFLINK
+    except OSError:
+        pass
+
+    try:
+        os.link(src, dst)
+        return HARDLINK
+    except OSError:  # e.g. different devices or not permitted
+        pass
+
+    shutil.copyfile(src, dst)
+    return COPY
+
+
+def packLog(src, dst, mode=LOG_COPY, tailSize=1024 * 1024):
+    """ Put a log file into the deposition tree. Logs are always copied,
+    never linked, since they may still be written (e.g. by running
+    protocols or this one).
+    :param mode: LOG_COPY (full copy), LOG_GZIP (compressed, .gz is added
+        to dst) or LOG_TAIL (only the last tailSize bytes)
+    :return: the path of the packed log
+    """
+    if mode == LOG_GZIP:
+        dst += '.gz'
+    # dst may be a link to src made by older versions
+    if os.path.lexists(dst):
+        os.remove(dst)
+    if mode == LOG_GZIP:
+        with open(src, 'rb') as fIn, gzip.open(dst, 'wb') as fOut:
+            shutil.copyfileobj(fIn, fOut)
+    elif mode == LOG_TAIL and os.path.getsize(src) > tailSize:
+        with open(src, 'rb') as fIn, open(dst, 'wb') as fOut:
+            fIn.seek(-tailSize, os.SEEK_END)
+            fIn.readline()  # skip the first, probably partial, line
+            fOut.write(b'[...]\n')
+            shutil.copyfileobj(fIn, fOut)
+    else:
+        shutil.copyfile(src, dst)
+    return dst
+
+
+def walkTree(rootDir, loops=None):
+    """ os.walk following links, as the upload does, with sorted names.
+    A folder reached again through another link is walked again (its
+    files are uploaded twice), only links to one of its own parent
+    folders are not entered.
+    :param loops: optional list where those links are appended
+    """
+    realParents = {}
+    for dirPath, dirNames, fileNames in os.walk(rootDir, followlinks=True):
+        parents = realParents.get(os.path.dirname(dirPath), ()) + (os.path.realpath(dirPath),)
+        realParents[dirPath] = parents
+        dirNames.sort()
+        for dirName in list(dirNames):
+            if os.path.realpath(os.path.join(dirPath, dirName)) in parents:
+                dirNames.remove(dirName)
+                if loops is not None:
+                    loops.append(os.path.relpath(os.path.join(dirPath, dirName), rootDir))
+        yield dirPath, dirNames, sorted(fileNames)
+
+
+def analyzeTree(rootDir, smallFileSize=MB, intermediatePatterns=INTERMEDIATE_PATTERNS):
+    """ Walk the tree once, following links as the upload does, and
+    describe its files: count, size histogram, small files and files
+    that look redundant (reached several times through different links
+    or matching the intermediate patterns).
+    """
+    histogram = [{'upTo': limit, 'files': 0, 'bytes': 0} for limit in SIZE_BUCKETS]
+    histogram.append({'upTo': None, 'files': 0, 'bytes': 0})
+    report = {'files': 0, 'bytes': 0, 'smallFiles': 0, 'histogram': histogram,
+              'duplicates': [], 'intermediates': [], 'brokenLinks': [], 'linkLoops': []}
+    seenFiles = set()
+
+    for dirPath, dirNames, fileNames in walkTree(rootDir, report['linkLoops']):
+        for fileName in fileNames:
+            path = os.path.join(dirPath, fileName)
+            relPath = os.path.relpath(path, rootDir)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                if os.path.islink(path):  # dangling link, not uploaded
+                    report['brokenLinks'].append(relPath)
+                    continue
+                raise
+            if (st.st_dev, st.st_ino) in seenFiles:
+                report['duplicates'].append(relPath)
+            seenFiles.add((st.st_dev, st.st_ino))
+            if any(fnmatch.fnmatch('/' + relPath, p) for p in intermediatePatterns):
+                report['intermediates'].append(relPath)
+
+            report['files'] += 1
+            report['bytes'] += st.st_size
+            report['smallFiles'] += st.st_size < smallFileSize
+            bucket = next((b for b in histogram if b['upTo'] is None or st.st_size < b['upTo']))
+            bucket['files'] += 1
+            bucket['bytes'] += st.st_size
+
+    return report
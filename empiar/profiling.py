@@ -0,0 +1,105 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+""" Optional instrumentation of the deposition creation. """
+
+import os
+import json
+import time
+from contextlib import contextmanager
+
+
+def getFolderSize(folder):
+    """ Return (bytes, number of files) of the regular files in a folder
+    (links are not followed). """
+    total = files = 0
+    for root, dirs, fileNames in os.walk(folder):
+        for fn in fileNames:
+            path = os.path.join(root, fn)
+            if not os.path.islink(path):
+                total += os.path.getsize(path)
+                files += 1
+    return total, files
+
+
+class PhaseProfiler:
+    """ Accumulate the wall time of named phases, optionally per protocol
+    and per output type, and some counters. When it is not enabled,
+    nothing is measured. """
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self._times = {}  # {(phase, protocol, output type): seconds}
+        self._counters = {}
+
+    @contextmanager
+    def phase(self, name, protocol='', outputType=''):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            key = (name, protocol, outputType)
+            self._times[key] = self._times.get(key, 0) + time.perf_counter() - start
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    def getReport(self):
+        """ Return the measurements as a json serializable dict. The
+        entries are sorted from the slowest. Protocol phases are nested
+        in the 'exportWorkflow' one. """
+        entries = [{'phase': name, 'protocol': protocol, 'outputType': outputType,
+                    'seconds': seconds}
+                   for (name, protocol, outputType), seconds in self._times.items()]
+        entries.sort(key=lambda e: e['seconds'], reverse=True)
+
+        def totals(key):
+            result = {}
+            for e in entries:
+                if e[key]:
+                    result[e[key]] = result.get(e[key], 0) + e['seconds']
+            return dict(sorted(result.items(), key=lambda item: item[1], reverse=True))
+
+        return {'entries': entries,
+                'phases': totals('phase'),
+                'protocols': totals('protocol'),
+                'outputTypes': totals('outputType'),
+                'counters': dict(self._counters)}
+
+    def save(self, path, **extra):
+        report = self.getReport()
+        report.update(extra)
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=4)
+        return report
+
+
+def formatEntry(entry):
+    """ Describe a report entry, e.g. 'outputs (2D classification, SetOfClasses2D): 3.21 s' """
+    context = ', '.join(v for v in (entry['protocol'], entry['outputType']) if v)
+    return f"{entry['phase']}{f' ({context})' if context else ''}: {entry['seconds']:.2f} s"
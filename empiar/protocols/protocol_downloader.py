@@ -26,6 +26,7 @@
 
 
 import os
+import time
 
 from pyworkflow.protocol import params, STEPS_PARALLEL
 from pyworkflow.object import String
@@ -33,11 +34,19 @@ import pyworkflow.utils as pwutils
 from pwem.objects import Movie, SetOfMovies, Acquisition
 from pwem.protocols import EMProtocol, ProtImportImages
 
+from empiar import Plugin
 from empiar.utils import FTPDownloader, readFromEmpiar
-from empiar.constants import DATA_FORMATS
+from empiar.constants import DATA_FORMATS, EMPIAR_CATALOG, EMPIAR_STORE, EMPIAR_STORE_QUOTA
+from empiar.catalog import FILTERS as CATALOG_FILTERS
+from empiar.cache import LruFileCache, CacheFullError
+from empiar.store import DownloadStore
+from empiar.upload import GB
+from empiar.transcode import MovieTranscoder, COMPRESSIONS, TRANSCODED_EXTENSION
 
 EMPIAR_REMOTE_ROOT = '/empiar/world_availability/'
 FTP_EBI_AC_UK = 'ftp.ebi.ac.uk'
+FETCH_WAIT = 60  # seconds between checks when the cache is full of pinned movies
+FETCH_MAX_WAIT = 2 * 3600  # seconds, then fetching fails
 
 
 class EmpiarDownloader(EMProtocol):
@@ -54,9 +63,23 @@ class EmpiarDownloader(EMProtocol):
         form.addParam("entryId", params.StringParam,
                       label="EMPIAR identifier",
                       default="10200",
-                      help="EMPIAR's entry identifier",
+                      help="EMPIAR's entry identifier. Use the wizard to "
+                           "choose it from the local EMPIAR catalog, filtered "
+                           "by the catalog query below.",
                       important=True)
 
+        form.addParam("catalogQuery", params.StringParam,
+                      label="Catalog query (Optional)", default="",
+                      expertLevel=params.LEVEL_ADVANCED,
+                      help="Words to look for in the entry titles and image "
+                           "sets, and filters (%s), used by the entry "
+                           "identifier wizard. E.g. 'category=multiframe "
+                           "format=tiff maxPixel=1 minImages=5000'.\n"
+                           "The catalog file is set by the %s variable and it "
+                           "is filled with: scipion3 python -m empiar.catalog "
+                           "update --last <last entry id>"
+                           % (', '.join(CATALOG_FILTERS), EMPIAR_CATALOG))
+
         form.addParam("downloadFolder", params.FolderParam,
                       label="Download folder", important=True,
                       help="Local folder to store downloaded files")
@@ -78,6 +101,68 @@ class EmpiarDownloader(EMProtocol):
                       help="If activated it will create a subfolder under "
                            "the 'Download folder' with the EMPIAR##### name")
 
+        form.addParam("useSharedStore", params.BooleanParam,
+                      label="Use the shared download store", default=False,
+                      help="If activated, files are downloaded into the store "
+                           "shared by all projects (the %s folder, limited to "
+                           "%s GB) and reflinked or hard linked into the "
+                           "download folder. Files already in the store are "
+                           "not downloaded again, and protocols downloading "
+                           "the same file at the same time wait for each other."
+                           % (EMPIAR_STORE, EMPIAR_STORE_QUOTA))
+
+        form.addParam("virtualMode", params.BooleanParam,
+                      label="Register without downloading", default=False,
+                      help="If activated, all the movies of the entry are "
+                           "listed from the remote folder (the number of files "
+                           "above is not used) into a size limited cache in "
+                           "the download folder, without downloading them.")
+
+        form.addParam("fetchMovies", params.BooleanParam,
+                      condition="virtualMode",
+                      label="Fetch movies in streaming", default=True,
+                      help="If activated, the listed movies are fetched one by "
+                           "one and each is added to the output only when "
+                           "it is local, so other protocols can use the output "
+                           "in streaming. The fetched movies are pinned, so "
+                           "the cache never removes them. When the cache is "
+                           "full, fetching waits (up to %d minutes, then the "
+                           "protocol fails and can be continued) until processed "
+                           "movies are unpinned with: scipion3 python -m "
+                           "empiar.cache <download folder> unpin <movie files>\n"
+                           "If not activated, all the movies are registered "
+                           "at once but they are NOT downloaded: the output "
+                           "can not be used directly by other protocols "
+                           "until its movies are fetched with: scipion3 python "
+                           "-m empiar.cache <download folder> fetch <movie files>"
+                           % (FETCH_MAX_WAIT // 60))
+
+        form.addParam("cacheSize", params.FloatParam,
+                      condition="virtualMode",
+                      label="Cache size (GB)", default=100,
+                      help="When the cache is full, the movies opened less "
+                           "recently are removed from it.")
+
+        form.addParam("transcode", params.BooleanParam,
+                      condition="not virtualMode",
+                      label="Compress MRC movies", default=False,
+                      help="If activated, MRC movies are compressed (lossless) "
+                           "into multi page TIFF files while the download goes "
+                           "on. The TIFF movies are registered and the MRC "
+                           "files deleted. Needs the tifffile package.")
+
+        form.addParam("compression", params.EnumParam,
+                      condition="transcode", expertLevel=params.LEVEL_ADVANCED,
+                      label="Compression", choices=COMPRESSIONS, default=0,
+                      display=params.EnumParam.DISPLAY_HLIST,
+                      help="TIFF compression. zlib only needs tifffile, lzw "
+                           "and zstd also need the imagecodecs package.")
+
+        form.addParam("transcodeWorkers", params.IntParam,
+                      condition="transcode", expertLevel=params.LEVEL_ADVANCED,
+                      label="Compression processes", default=2,
+                      help="Number of movies compressed at the same time.")
+
         form.addParam('downloadGain', params.BooleanParam,
                       label="Download gain file?", default=True,
                       help="Leave this empty if not required.")
@@ -125,6 +210,9 @@ class EmpiarDownloader(EMProtocol):
 
         downloadStepId = self._insertFunctionStep(self.downloadImagesStep,
                                                   prerequisites=stepDeps)
+        if self.virtualMode and self.fetchMovies:
+            downloadStepId = self._insertFunctionStep(self.fetchMoviesStep,
+                                                      prerequisites=[downloadStepId])
         self._insertFunctionStep(self.closeOutput,
                                  prerequisites=[downloadStepId])
 
@@ -157,7 +245,7 @@ class EmpiarDownloader(EMProtocol):
             downloadFolder = os.path.dirname(remoteFile.split(self.entryId.get() + "/")[1])
             downloadFolder = os.path.join(self._getRootDownloadFolder(), downloadFolder)
 
-            downloader = FTPDownloader(FTP_EBI_AC_UK)
+            downloader = FTPDownloader(FTP_EBI_AC_UK, **self._getStoreArgs())
             downloader.downloadFile(remoteFile, downloadFolder,
                                     fileReadyCallback=self.gainDownloaded)
 
@@ -175,9 +263,57 @@ class EmpiarDownloader(EMProtocol):
         directory = EMPIAR_REMOTE_ROOT + empiarFolder
         filter = self._getDownloadFilter()
         self.info(f"Filter by extension: {filter}")
-        ftpDownloader = FTPDownloader(FTP_EBI_AC_UK, fnFilter=filter)
-        ftpDownloader.downloadFolder(directory, downloadFolder, self.registerImage,
-                                     limit=self.amountOfImages.get())
+        if self.virtualMode:
+            self.registerVirtualMovies(directory, filter)
+            return
+
+        if not self.transcode:
+            ftpDownloader = FTPDownloader(FTP_EBI_AC_UK, fnFilter=filter, **self._getStoreArgs())
+            ftpDownloader.downloadFolder(directory, downloadFolder, self.registerImage,
+                                         limit=self.amountOfImages.get())
+            return
+
+        # movies are compressed in other processes while the download goes on
+        with MovieTranscoder(self.registerImage, workers=self.transcodeWorkers.get(),
+                             compression=self.getEnumText('compression'),
+                             log=self.info) as transcoder:
+            ftpDownloader = FTPDownloader(FTP_EBI_AC_UK, fnFilter=filter,
+                                          findLocalFile=transcoder.findLocalFile,
+                                          **self._getStoreArgs())
+            ftpDownloader.downloadFolder(directory, downloadFolder, transcoder.submit,
+                                         limit=self.amountOfImages.get())
+
+    def fetchMoviesStep(self):
+        """ Fetch the listed movies one by one, pinned in the cache, and
+        register each one once it is local. """
+        cache = self._getMoviesCache(FTPDownloader(FTP_EBI_AC_UK))
+        owner = os.path.abspath(self._getPath())
+        remoteFolder = EMPIAR_REMOTE_ROOT + self._getEntryRootFolder()
+        registered = ({movie.getMicName() for movie in self.outputMovies}
+                      if hasattr(self, 'outputMovies') else set())  # when continuing
+
+        for relPath, remote, _ in cache.getManifest():
+            if not remote.startswith(remoteFolder) or os.path.basename(relPath) in registered:
+                continue
+            waitStart = None
+            while True:
+                try:
+                    localFn = cache.open(relPath, pin=owner)
+                    break
+                except CacheFullError:
+                    if waitStart is None:
+                        self.warning(f"The cache is full of pinned movies, waiting for "
+                                     f"processed ones to be unpinned: scipion3 python -m "
+                                     f"empiar.cache {cache.folder} unpin <movie files>")
+                        waitStart = time.time()
+                    elif time.time() - waitStart > FETCH_MAX_WAIT:
+                        raise CacheFullError(
+                            f"No movie was unpinned in {FETCH_MAX_WAIT // 60} minutes and "
+                            f"the cache ({self.cacheSize.get()} GB) is full, so {relPath} "
+                            f"can not be fetched. Increase the cache size or unpin the "
+                            f"processed movies and continue this protocol.")
+                    time.sleep(FETCH_WAIT)
+            self.registerImage(localFn)
 
     def closeOutput(self):
         self.outputMovies.setStreamState(SetOfMovies.STREAM_CLOSED)
@@ -185,6 +321,19 @@ class EmpiarDownloader(EMProtocol):
         self._store()
 
     # --------------------------- INFO functions ------------------------------
+    def _validate(self):
+        errors = []
+        if self.useSharedStore and not Plugin.getVar(EMPIAR_STORE):
+            errors.append(f"The shared download store folder is not set, define "
+                          f"the {EMPIAR_STORE} variable in the Scipion config.")
+        if self.transcode:
+            try:
+                import tifffile
+            except ImportError:
+                errors.append("The tifffile package is needed to compress the movies "
+                              "(pip install tifffile).")
+        return errors
+
     def _summary(self):
         summary = []
 
@@ -194,6 +343,16 @@ class EmpiarDownloader(EMProtocol):
             summary.append(f"Sampling rate: {self.samplingRate}")
             summary.append(f"Data format: {self.dataFormat}")
             summary.append(f"Data at: {self.empiarDirectory}")
+            if self.virtualMode and self.fetchMovies:
+                summary.append(f"Movies fetched in streaming into the cache at "
+                               f"{self._getRootDownloadFolder()} (up to "
+                               f"{self.cacheSize.get()} GB), pinned until unpinned "
+                               f"with: scipion3 python -m empiar.cache <folder> unpin")
+            elif self.virtualMode:
+                summary.append(f"WARNING: movies registered WITHOUT downloading them, the "
+                               f"output can not be used by other protocols until they are "
+                               f"fetched into {self._getRootDownloadFolder()} with: "
+                               f"scipion3 python -m empiar.cache <folder> fetch <movie files>")
 
         return summary
 
@@ -209,6 +368,14 @@ class EmpiarDownloader(EMProtocol):
 
         self._store(outputset)
 
+    def _getStoreArgs(self):
+        """ FTPDownloader arguments to download through the shared store. """
+        if not self.useSharedStore:
+            return {}
+        quota = float(Plugin.getVar(EMPIAR_STORE_QUOTA) or 0) * GB
+        return {'store': DownloadStore(Plugin.getVar(EMPIAR_STORE), quotaBytes=int(quota)),
+                'entryId': self.entryId.get()}
+
     def _getDownloadFilter(self):
         """ Returns a list of extensions to be matched or None"""
         filter = DATA_FORMATS.get(self.dataFormat.get(), [])
@@ -229,7 +396,10 @@ class EmpiarDownloader(EMProtocol):
 
     def registerImage(self, file):
         """ Register a movie taking into account a file path. """
-        if pwutils.getExt(file) not in DATA_FORMATS.get(self.dataFormat.get()):
+        validExts = DATA_FORMATS.get(self.dataFormat.get(), [])
+        if self.transcode:
+            validExts = validExts + [TRANSCODED_EXTENSION]
+        if pwutils.getExt(file) not in validExts:
             return  # skip non-movie files
 
         # Create a link
@@ -249,6 +419,51 @@ class EmpiarDownloader(EMProtocol):
 
         self._store(outputset)
 
+    def _getMoviesCache(self, ftpDownloader):
+        return LruFileCache(self._getRootDownloadFolder(), ftpDownloader.fetchFile,
+                            maxBytes=int(self.cacheSize.get() * GB), server=FTP_EBI_AC_UK)
+
+    def registerVirtualMovies(self, directory, filter):
+        """ List all the movies of the remote directory in the cache
+        manifest. Unless they are fetched in streaming (fetchMoviesStep),
+        they are all registered now, downloading only the first one to
+        get the dimensions. """
+        ftpDownloader = FTPDownloader(FTP_EBI_AC_UK, fnFilter=filter)
+        movieExts = DATA_FORMATS.get(self.dataFormat.get(), [])
+        # local paths mirror the remote ones, as when downloading
+        remoteRoot = EMPIAR_REMOTE_ROOT + self.entryId.get()
+        movies = [(os.path.relpath(remote, remoteRoot), remote, size)
+                  for remote, size in ftpDownloader.listFiles(directory)
+                  if pwutils.getExt(remote) in movieExts]
+        if not movies:
+            raise FileNotFoundError(f"No movies found at {directory}")
+
+        cache = self._getMoviesCache(ftpDownloader)
+        cache.addToManifest(movies)
+        self.info(f"{len(movies)} movies listed "
+                  f"({pwutils.prettySize(sum(size for _, _, size in movies))})")
+        if self.fetchMovies:
+            return
+
+        self.warning("Movies registered without downloading them: other protocols "
+                     "can not use them until they are fetched with: scipion3 python "
+                     f"-m empiar.cache {cache.folder} fetch <movie files>")
+
+        # all movies are assumed to have the dimensions of the first one
+        dim = Movie(location=cache.open(movies[0][0])).getDim()
+        outputset = self._getMoviesOutputSet()
+        for relPath, _, _ in movies:
+            dest = self._getExtraPath(os.path.basename(relPath))
+            pwutils.createLink(cache.getPath(relPath), dest)
+            newImage = Movie(location=dest)
+            newImage.setFramesRange([1, dim[2], 1])
+            newImage.setSamplingRate(self.samplingRate.get())
+            newImage.setMicName(os.path.basename(dest))
+            outputset.append(newImage)
+
+        outputset.write()
+        self._store(outputset)
+
     def _getMoviesOutputSet(self):
         """ Returns the output set; if not available create an empty one. """
         if not hasattr(self, 'outputMovies'):
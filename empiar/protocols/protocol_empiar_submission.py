@@ -25,45 +25,49 @@
 # **************************************************************************
 
 import os
+import sys
+import time
 import json
+import cProfile
 import copy
-import requests
 import subprocess
-from pkg_resources import resource_filename
-import jsonschema
-from PIL import Image as ImagePIL
-from PIL import ImageDraw
-from empiar_depositor import empiar_depositor
+from importlib.util import find_spec
 
 from pyworkflow.protocol import params
 from pyworkflow.object import String, Set
 import pyworkflow.utils as pwutils
 from pyworkflow.project import config
-from pwem import Domain, emlib
+from pwem import Domain
 from pwem.protocols import EMProtocol
 from pwem.objects import (Class2D, Class3D, Image, CTFModel, Volume,
-                          Micrograph, Movie, Particle, SetOfCoordinates, SetOfCTF, SetOfMicrographs, SetOfVolumes)
-from pwem.viewers import EmPlotter
-import emtable as md
-from math import sqrt
-import numpy as np
-import shutil
+                          Micrograph, Particle, SetOfCoordinates, SetOfCTF, SetOfMicrographs, SetOfVolumes)
 
 from empiar import Plugin
 from empiar.constants import *
-
-DEPOSITION_TEMPLATE = resource_filename('empiar', '/'.join(('templates', 'empiar_deposition_template.json')))
-DEPOSITION_SCHEMA = resource_filename('empiar_depositor', '/empiar_deposition.schema.json')
-VIEWER_FILES = resource_filename('empiar', '/viewer_files')
-
+from empiar.packaging import linkOrCopy, packLog, analyzeTree, LOG_COPY, LOG_TAIL
+from empiar.upload import UploadOrchestrator, GB
+from empiar import server as viewerServer
+from empiar.server import stopServer
+from empiar.workflow import (JsonListWriter, WorkflowCache, WorkflowIndexWriter,
+                             getAncestors)
+from empiar.scan import HeaderCache, scanFiles, findOutliers, HEADER_KEYS
+from empiar.profiling import PhaseProfiler, getFolderSize, formatEntry
+
+# Heavy modules (numpy, PIL, xmipp, matplotlib, jsonschema, the depositor...)
+# are imported by the steps that use them, so loading the plugin is cheap.
+EMPIAR_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEPOSITION_TEMPLATE = os.path.join(EMPIAR_FOLDER, 'templates', 'empiar_deposition_template.json')
+VIEWER_FILES = os.path.join(EMPIAR_FOLDER, 'viewer_files')
+
+# emlib data type names, resolved when the first voxel type is requested
 VOXELTYPES = {
-    emlib.DT_UCHAR: 'T1',  # 'UNSIGNED BYTE'
-    emlib.DT_SCHAR: 'T2',  # 'SIGNED BYTE'
-    emlib.DT_USHORT: 'T3',  # 'UNSIGNED 16 BIT INTEGER'
-    emlib.DT_SHORT: 'T4',  # 'SIGNED 16 BIT INTEGER'
-    emlib.DT_UINT: 'T5',  # 'UNSIGNED 32 BIT INTEGER'
-    emlib.DT_INT: 'T6',  # 'SIGNED 32 BIT INTEGER'
-    emlib.DT_FLOAT: 'T7',  # '32 BIT FLOAT'
+    'DT_UCHAR': 'T1',  # 'UNSIGNED BYTE'
+    'DT_SCHAR': 'T2',  # 'SIGNED BYTE'
+    'DT_USHORT': 'T3',  # 'UNSIGNED 16 BIT INTEGER'
+    'DT_SHORT': 'T4',  # 'SIGNED 16 BIT INTEGER'
+    'DT_UINT': 'T5',  # 'UNSIGNED 32 BIT INTEGER'
+    'DT_INT': 'T6',  # 'SIGNED 32 BIT INTEGER'
+    'DT_FLOAT': 'T7',  # '32 BIT FLOAT'
     #'T8' - 'BIT',
     #'T9' - '4 BIT INTEGER',
     # 'OT' - other, in this case please specify the header format in the second element in capital letters.",
@@ -85,10 +89,22 @@ IMAGESETCATEGORIES = {
     # 'OT' : 'other, in this case please specify the category in the second element.'
 }
 
-with pwutils.weakImport("tomo"):
-    import tomo.objects
-    IMAGESETCATEGORIES["SetOfTiltSeries"] = 'T9',  # : 'tilt series',
-    IMAGESETCATEGORIES["SetOfSubTomograms"] = 'T14'  # 'subtomograms'
+# tomo sets are matched by class name, no need to import the tomo plugin
+IMAGESETCATEGORIES["SetOfTiltSeries"] = 'T9'  # : 'tilt series',
+IMAGESETCATEGORIES["SetOfSubTomograms"] = 'T14'  # 'subtomograms'
+
+
+def isInstanceByName(obj, className):
+    """ isinstance for classes of plugins that may not be installed
+    (e.g. tomo), checking the class names of the hierarchy. """
+    return any(cls.__name__ == className for cls in type(obj).__mro__)
+
+
+def getDepositionSchema():
+    """ Path of the deposition schema shipped with empiar-depositor,
+    located without importing the package. """
+    return os.path.join(find_spec('empiar_depositor').submodule_search_locations[0],
+                        'empiar_deposition.schema.json')
 
 
 class EmpiarMappingError(Exception):
@@ -102,7 +118,14 @@ class EmpiarDepositor(EMProtocol):
     Deposits image sets to EMPIAR.
     """
     _label = 'empiar deposition'
-    _ih = emlib.image.ImageHandler()
+    _imageHandler = None
+
+    @property
+    def _ih(self):
+        if EmpiarDepositor._imageHandler is None:
+            from pwem.emlib.image import ImageHandler
+            EmpiarDepositor._imageHandler = ImageHandler()
+        return EmpiarDepositor._imageHandler
 
     _workflowTemplate = {
         SCIPION_WORKFLOW: ""
@@ -139,6 +162,9 @@ class EmpiarDepositor(EMProtocol):
         self.depositionJsonPath = String()
         self.entryID = String()
         self.uniqueDir = String()
+        self._stackThumbnails = {}
+        self._psdThumbnails = []
+        self._profiler = PhaseProfiler()
 
     # --------------- DEFINE param functions ----------------------------------
 
@@ -152,10 +178,11 @@ class EmpiarDepositor(EMProtocol):
                       label="Deploy workflow viewer locally", default=False,
                       help="Set to true to deploy the workflow viewer locally "
                            "(in http://localhost:<port chosen>) to understand how "
-                           "it will look in EMPIAR.\nWhen you want to stop it, "
-                           "you will have to do it manually by running in your "
-                           "terminal something like: lsof -i tcp:<port chosen> | "
-                           "awk 'NR > 1 {print $2}' | xargs kill")
+                           "it will look in EMPIAR.\nThe server keeps running after "
+                           "the protocol finishes and it is restarted when the "
+                           "protocol is run again. When you want to stop it, run "
+                           "in your terminal: kill $(cat <protocol extra folder>/%s)"
+                           % VIEWER_PID)
         form.addParam("port", params.IntParam, label="Viewer port",
                       default=9000, condition="viewer",
                       help="The workflow web viewer will be deployed at this "
@@ -170,6 +197,26 @@ class EmpiarDepositor(EMProtocol):
                            "entry will be submitted and no future changes can "
                            "be done (except for providing the EMDB codes related "
                            "with the EMPIAR entry).")
+        form.addParam("chunkedUpload", params.BooleanParam,
+                      label="Upload in chunks", default=False,
+                      condition='deposit', expertLevel=params.LEVEL_ADVANCED,
+                      help="Upload the data in chunks with several aspera "
+                           "transfers. If the upload fails, running the "
+                           "protocol again (continue) only uploads the chunks "
+                           "that were not finished.")
+        form.addParam("uploadChunkSize", params.IntParam,
+                      label="Chunk size (GB)", default=100,
+                      condition='deposit and chunkedUpload',
+                      expertLevel=params.LEVEL_ADVANCED)
+        form.addParam("uploadConcurrency", params.IntParam,
+                      label="Simultaneous transfers", default=2,
+                      condition='deposit and chunkedUpload',
+                      expertLevel=params.LEVEL_ADVANCED)
+        form.addParam("uploadRate", params.StringParam,
+                      label="Target rate per transfer", default='1000M',
+                      condition='deposit and chunkedUpload',
+                      expertLevel=params.LEVEL_ADVANCED,
+                      help="Aspera target rate (-l), e.g. 300M for 300 Mbps.")
         form.addParam('jsonTemplate', params.PathParam,
                       label="Custom json (Optional)", allowsNull=True,
                       help="Path to a customized template of the EMPIAR "
@@ -242,10 +289,94 @@ class EmpiarDepositor(EMProtocol):
                                             minNumObjects=1,
                                             help='Select one set (of micrographs, particles,'
                                                  ' volumes, etc.) to be deposited to EMPIAR.')
+        form.addParam('strictImageSets', params.BooleanParam,
+                      label="Stop if image sets are not homogeneous", default=True,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      help="The headers of all the files of each image set are "
+                           "read to check that they share format, dimensions, "
+                           "number of frames and voxel type, as EMPIAR rejects "
+                           "heterogeneous sets. The files that differ (or can "
+                           "not be read) are reported in extra/%s. If set to "
+                           "Yes, the deposition is stopped when there are any."
+                           % SCAN_REPORT)
         # form.addParam('micSet', params.PointerParam, pointerClass='SetOfMicrographs,SetOfMovies,SetOfParticles',
         #               label='Image set', important=False,
         #               help='Image set to be uploaded to EMPIAR\n')
 
+        form.addSection(label='Workflow')
+        form.addParam('workflowMode', params.EnumParam,
+                      label="Protocols to export",
+                      choices=['all project protocols', 'input sets ancestors'],
+                      default=WORKFLOW_ALL, display=params.EnumParam.DISPLAY_HLIST,
+                      help="Export all the protocols of the project or only "
+                           "the ones the input sets come from (discarding "
+                           "abandoned branches, failed tests, etc.).")
+        form.addParam('extraProtocols', params.StringParam,
+                      label="Extra protocol ids (Optional)", allowsNull=True,
+                      condition='workflowMode == %d' % WORKFLOW_ANCESTORS,
+                      help="Comma separated ids of other protocols to be "
+                           "exported too, together with the protocols they "
+                           "come from.")
+        form.addParam('workflowIndent', params.BooleanParam,
+                      label="Indent workflow json", default=True,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      help="Set to False to write a compact workflow json "
+                           "(smaller, but not human readable).")
+        form.addParam('workflowGzip', params.BooleanParam,
+                      label="Write compressed workflow json copy", default=False,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      help="Write also a gzip compressed copy of the workflow "
+                           "json (%s.gz) next to it." % OUTPUT_WORKFLOW)
+        form.addParam('samplingPolicies', params.StringParam,
+                      label="Items to represent (Optional)", allowsNull=True,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      help="Which items of each output set are represented in "
+                           "the workflow viewer, as semicolon separated "
+                           "'SetClass: policy' entries, e.g.\n"
+                           "SetOfClasses3D: first 10; SetOfParticles: random 15 7; "
+                           "SetOfCTF: stratified 5 _defocusU\n"
+                           "Policies are: all, first N, random N [seed] and "
+                           "stratified N column (N items evenly spread over "
+                           "the sorted values of the column, an attribute "
+                           "label such as _defocusU; sets without that column "
+                           "get random items and a warning).\nBy default 3 "
+                           "micrographs, movies, CTFs and micrographs with "
+                           "coordinates and 15 particles are represented, and "
+                           "all the items of any other set.")
+        form.addParam('logMode', params.EnumParam,
+                      label="Protocol logs",
+                      choices=['full', 'gzip compressed', 'tail'],
+                      default=LOG_COPY, expertLevel=params.LEVEL_ADVANCED,
+                      display=params.EnumParam.DISPLAY_HLIST,
+                      help="How the protocols stdout logs are included in the "
+                           "deposition: the full log (copied), "
+                           "gzip compressed or only its last part.")
+        form.addParam('logTailSize', params.IntParam,
+                      label="Log tail size (KB)", default=1024,
+                      condition='logMode == %d' % LOG_TAIL,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      help="Size of the last part of each log to be deposited.")
+        form.addParam('incrementalExport', params.BooleanParam,
+                      label="Reuse unchanged protocols", default=True,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      help="Protocols that did not change since the last time "
+                           "this deposition was created (same status, end "
+                           "time and outputs) are not processed again; their "
+                           "previous workflow information is reused.")
+        form.addParam('profiling', params.EnumParam,
+                      label="Profile the deposition creation",
+                      choices=['no', 'timings', 'timings and cProfile'],
+                      default=PROFILE_NONE, expertLevel=params.LEVEL_ADVANCED,
+                      display=params.EnumParam.DISPLAY_HLIST,
+                      help="Measure the time spent in each phase (summaries, "
+                           "outputs per type, plots, logs, validation...) per "
+                           "protocol, the thumbnail subprocesses launched and "
+                           "the bytes written in %s. The report is saved in "
+                           "extra/%s and the slowest phases are shown in the "
+                           "summary. With cProfile, the python profile is "
+                           "also dumped to extra/%s (open it with pstats or "
+                           "snakeviz)." % (DIR_IMAGES, PROFILE_REPORT, PROFILE_STATS))
+
         form.addSection(label="Principal investigator")
         form.addParam('piFirstName', params.StringParam, label='First name',
                       help="PI first name e.g. Juan. "
@@ -325,12 +456,30 @@ class EmpiarDepositor(EMProtocol):
 
     # --------------- STEPS functions -----------------------------------------
     def createDepositionStep(self):
+        self._profiler = PhaseProfiler(enabled=self.profiling.get() != PROFILE_NONE)
+        profile = cProfile.Profile() if self.profiling.get() == PROFILE_CPROFILE else None
+        if profile is not None:
+            profile.enable()
+        try:
+            self.createDeposition()
+        finally:
+            if profile is not None:
+                profile.disable()
+                profile.dump_stats(self._getExtraPath(PROFILE_STATS))
+            if self._profiler.enabled:
+                self.saveProfile()
+
+    def createDeposition(self):
+        from empiar.schema import DepositionTemplate
         # make folder in extra
         pwutils.makePath(self._getExtraPath(self.entryTopLevel.get()))
         pwutils.makePath(self.getTopLevelPath(DIR_IMAGES))
 
         # export workflow json
-        self.exportWorkflow()
+        with self._profiler.phase('exportWorkflow'):
+            self.exportWorkflow()
+        with self._profiler.phase('analyzeDepositionTree'):
+            self.analyzeDepositionTree()
 
         # If deposition is not happening
         if not self.deposit:
@@ -351,12 +500,11 @@ class EmpiarDepositor(EMProtocol):
         self.releaseDate = self.getEnumText('releaseDate')
         self.experimentType = self.experimentType.get() + 1
 
-        with open(jsonTemplatePath, 'rb') as jsonTemplate:
-            jsonStr = jsonTemplate.read().decode('utf-8')
-            jsonStr = jsonStr % self.__dict__
-            depoDict = json.loads(jsonStr)
+        with self._profiler.phase('template'):
+            depoDict = DepositionTemplate.load(jsonTemplatePath).render(self.__dict__)
 
-        imageSets = self.processImageSets()
+        with self._profiler.phase('imageSets'):
+            imageSets = self.processImageSets()
         if len(imageSets) > 0:
             self.debug("Imagesets is not empty")
             depoDict[IMGSET_KEY] = imageSets
@@ -375,45 +523,100 @@ class EmpiarDepositor(EMProtocol):
         self.info(f"Deposition JSON saved: {depoJson}")
 
         self._store()
-        self.validateDepoJson(depoDict)
+        with self._profiler.phase('validation'):
+            self.validateDepoJson(depoDict)
 
     def deployWorkflowViewerStep(self):
         viewerDir = self._getExtraPath(DIR_VIEWER)
         pwutils.makePath(viewerDir)
 
-        cmd = [f"cd {viewerDir} &&"]
         # create links to static viewer files
         for fn in ['css', 'js', 'index.html', 'img', 'scipion-workflow.html']:
-            cmd.append(f"ln -s {'/'.join([VIEWER_FILES, fn])} &&")
+            pwutils.createLink(os.path.join(VIEWER_FILES, fn), os.path.join(viewerDir, fn))
         # create links to 'workflow.json' file and 'images_representation' thumbnails folder
-        cmd.append(f"ln -s {os.path.abspath(self.getTopLevelPath(DIR_IMAGES))} &&")
-        cmd.append(f"ln -s {os.path.abspath(self.getTopLevelPath(OUTPUT_WORKFLOW))}")
-
-        cmds = " ".join(cmd)
-        subprocess.run(cmds, shell=True)
-
-        # serve index.html
-        existing_deployment = subprocess.run("lsof -i tcp:%s | awk 'NR > 1 {print $2}'" %
-                                             self.port, shell=True, stdout=subprocess.PIPE)
-        if existing_deployment.stdout.decode('utf-8') != '':
-            subprocess.run("kill -9 %s" % existing_deployment.stdout.decode('utf-8'), shell=True)
-        cmd = f"cd {viewerDir} && python3 -m http.server {self.port}"
-        subprocess.Popen(cmd, shell=True)
+        for path in [self.getTopLevelPath(DIR_IMAGES), self.getTopLevelPath(OUTPUT_WORKFLOW)]:
+            pwutils.createLink(os.path.abspath(path),
+                               os.path.join(viewerDir, os.path.basename(path)))
+
+        # stop the server of a previous run of this protocol, if any
+        pidFile = os.path.abspath(self._getExtraPath(VIEWER_PID))
+        if stopServer(pidFile):
+            self.info("Previous workflow viewer stopped")
+
+        # serve the viewer folder with a detached threaded server that
+        # outlives this step; it removes the pid file when stopped
+        cmd = [sys.executable, os.path.abspath(viewerServer.__file__),
+               '--dir', os.path.abspath(viewerDir), '--port', str(self.port),
+               '--pidfile', pidFile]
+        logFile = self._getExtraPath(VIEWER_LOG)
+        with open(logFile, 'w') as log:
+            process = subprocess.Popen(cmd, start_new_session=True,
+                                       stdout=log, stderr=subprocess.STDOUT)
+        waitUntil = time.time() + VIEWER_START_TIMEOUT
+        while not os.path.exists(pidFile) and process.poll() is None and time.time() < waitUntil:
+            time.sleep(0.1)
+        if process.poll() is not None:
+            with open(logFile) as log:
+                raise Exception(f"Workflow viewer could not be started at port "
+                                f"{self.port}:\n{log.read()}")
 
         self.info(f"Workflow web viewer deployed at: http://localhost:{self.port}")
+        self.info(f"To stop it run: kill $(cat {pidFile})")
 
     def makeDepositionStep(self):
+        if not self.chunkedUpload:
+            self.runDepositor(self.getTopLevelPath(), submit=self.submit.get())
+            return
+
+        # The entry is created with no data, the data is uploaded in chunks
+        # and then the entry is updated to be submitted (if required).
+        # The depositor uploads the (empty) placeholder folder, named as the
+        # top level folder so it is the same folder the chunks go to.
+        uploadDir = self._getExtraPath(UPLOAD_DIR)
+        emptyDir = os.path.join(uploadDir, 'empty', self.entryTopLevel.get())
+        pwutils.cleanPath(emptyDir)
+        pwutils.makePath(emptyDir)
+        orchestrator = UploadOrchestrator(self.getTopLevelPath(), None,
+                                          Plugin.getVar(ASCP_PATH), uploadDir,
+                                          chunkSize=self.uploadChunkSize.get() * GB,
+                                          concurrency=self.uploadConcurrency.get(),
+                                          targetRate=self.uploadRate.get(),
+                                          log=self.info)
+        entry = orchestrator.journal.get('entry')
+        if entry is None:
+            self.runDepositor(emptyDir, submit=False)
+            orchestrator.journal.set('entry', [self.entryID.get(), self.uniqueDir.get()])
+        else:
+            self.info(f"Resuming upload to entry {entry[0]}")
+            self.entryID.set(entry[0])
+            self.uniqueDir.set(entry[1])
+
+        orchestrator.destination = self.getUploadDestination()
+        orchestrator.run()
+        self.runDepositor(emptyDir, submit=self.submit.get(), resume=True)
+
+    def getUploadDestination(self):
+        """ Aspera folder of the entry data, the same one empiar-depositor
+        uploads to (it changes in development mode). """
+        uploadDir = (EMPIAR_DEVEL_UPLOAD_DIR if os.environ.get(EMPIAR_DEVEL_MODE, False)
+                     else EMPIAR_UPLOAD_DIR)
+        return f'{uploadDir}/{self.uniqueDir.get()}/data'
+
+    def runDepositor(self, dataDir, submit=False, resume=False):
+        """ Call empiar-depositor to create or update the entry with
+        the data in dataDir. """
+        from empiar_depositor import empiar_depositor
         depositorCall = '%(resume)s %(token)s %(depoJson)s %(ascp)s %(devel)s %(data)s -o %(submit)s %(grant)s'
         grantCall = "%(basedOn)s %(userID)s:1"
         grantArgs = {'basedOn': '-ge' if self.getEnumText('ownershipBasedOn') == 'email' else '-gu',
                      'userID': self.newOwnerId}
-        args = {'resume': '-r %s %s' % (self.entryID, self.uniqueDir) if self.resume else "",
+        args = {'resume': '-r %s %s' % (self.entryID, self.uniqueDir) if self.resume or resume else "",
                 'token': os.environ[EMPIAR_TOKEN],
                 'depoJson': os.path.abspath(self.depositionJsonPath.get()),
                 'ascp': '-a %s' % Plugin.getVar(ASCP_PATH),
                 'devel': '-d' if os.environ.get(EMPIAR_DEVEL_MODE, False) else '',
-                'data': os.path.abspath(self.getTopLevelPath()),
-                'submit': '' if self.submit else '-s',
+                'data': os.path.abspath(dataDir),
+                'submit': '' if submit else '-s',
                 'grant': grantCall % grantArgs if self.newOwnerId != '' else ''
                 }
 
@@ -430,6 +633,7 @@ class EmpiarDepositor(EMProtocol):
     def provideEMDBcodesStep(self):
         # This function requests to EMPIAR annotators a post-submission change
         # for provide the EMDB entry/ies code/s related with the EMPIAR entry
+        import requests
         requests.packages.urllib3.disable_warnings()
         if os.environ.get(EMPIAR_DEVEL_MODE, False):
             url = 'https://wwwdev.ebi.ac.uk/pdbe/emdb/external_test/master/empiar/deposition/api/v1/request_changes/'
@@ -451,7 +655,26 @@ class EmpiarDepositor(EMProtocol):
 
     # --------------- INFO functions ------------------------------------------
     def _validate(self):
+        from empiar.sampling import parsePolicies
         errors = []
+        try:
+            policies = parsePolicies(self.samplingPolicies.get())
+        except ValueError as e:
+            errors.append(f"Wrong items to represent: {e}")
+        else:
+            for className, policy in policies.items():
+                # set attributes are always stored with a leading underscore
+                if policy.column and not (policy.column == 'id' or policy.column.startswith('_')):
+                    errors.append(f"Wrong items to represent: '{policy.column}' of "
+                                  f"{className} is not an attribute label, did you "
+                                  f"mean _{policy.column}?")
+
+        if self.workflowMode.get() == WORKFLOW_ANCESTORS:
+            try:
+                self.getExtraProtocolIds()
+            except ValueError:
+                errors.append("Extra protocol ids must be comma separated integers.")
+
         if self.deposit:
             if Plugin.getVar(EMPIAR_TOKEN) is None:
                 errors.append(f"Environment variable {EMPIAR_TOKEN} not set.")
@@ -481,6 +704,13 @@ class EmpiarDepositor(EMProtocol):
         else:
             summary.append('No deposition files generated yet')
 
+        reportFn = self._getExtraPath(PROFILE_REPORT)
+        if os.path.exists(reportFn):
+            with open(reportFn) as f:
+                report = json.load(f)
+            summary.append(f'Slowest phases ([[{reportFn}][full report]]):')
+            summary.extend(f'- {formatEntry(entry)}' for entry in report['entries'][:PROFILE_TOP])
+
         return summary
 
     def _methods(self):
@@ -496,10 +726,11 @@ class EmpiarDepositor(EMProtocol):
 
     def exportWorkflow(self):
         project = self.getProject()
-        workflowProts = project.getRuns()
-        # workflow prots are all prots if no json provided
+        # Protocols that did not change since the last export are not processed again
+        workflowProts = self.getWorkflowProtocols()
         workflowJsonPath = self.getProjectPath(self.getTopLevelPath(OUTPUT_WORKFLOW))
         protDicts = project.getProtocolsDict(workflowProts)
+        protLabels = {objId: protDict['object.label'] for objId, protDict in protDicts.items()}
 
         # labels and colors
         settingsPath = self.getProjectPath(project.settingsPath)
@@ -519,82 +750,205 @@ class EmpiarDepositor(EMProtocol):
                 for label in protConfigInfo['labels']:
                     protsLabelsDict[protConfigInfo['id']].append(label)
 
-        # Add extra info to protocolsDict
-        for prot in workflowProts:
-            objId = prot.getObjId()
-            # Get summary and add input and output information
+        # Link the input sets files in the top level folder
+        filesPaths = {}
+        for inputSetPointer in self.inputSets:
+            inputSet = inputSetPointer.get()
+            setName = inputSet.getObjName()
+            setParentId = inputSet.getObjParentId()
+            setParentObj = project.getObject(setParentId)
+            filesPaths[setParentId] = os.path.join('.', setName)
+            pwutils.createLink(setParentObj._getExtraPath(), self.getTopLevelPath(setName))
+
+        # Protocols that did not change since the last export are not processed again
+        cache = WorkflowCache(self._getExtraPath(WORKFLOW_CACHE_DIR)) if self.incrementalExport else None
+
+        # The viewer index (with the precomputed layout) and the per protocol
+        # details are written in the local viewer folder
+        viewerDir = self._getExtraPath(DIR_VIEWER)
+        shardsDir = os.path.join(viewerDir, WORKFLOW_SHARDS_DIR)
+        pwutils.cleanPath(shardsDir)
+
+        # Add extra info to protocolsDict, writing each protocol as soon as it is done
+        with JsonListWriter(workflowJsonPath,
+                            indent=4 if self.workflowIndent else None,
+                            gzipCopy=self.workflowGzip.get()) as writer, \
+                WorkflowIndexWriter(os.path.join(viewerDir, WORKFLOW_INDEX), shardsDir) as indexWriter:
+            for prot in workflowProts:
+                protDict = protDicts.pop(prot.getObjId())
+                if cache is None:
+                    protDict.update(self.getProtocolFragment(prot, protLabels))
+                else:
+                    fingerprint = self.getProtocolFingerprint(prot)
+                    fragment = cache.get(prot.getObjId(), fingerprint)
+                    if fragment is None:
+                        fragment = self.getProtocolFragment(prot, protLabels)
+                        cache.set(prot.getObjId(), fingerprint, fragment)
+                    else:
+                        self.debug(f"Reusing workflow info of {prot.getRunName()}")
+                    protDict.update(fragment)
+
+                # labels
+                objId = prot.getObjId()
+                if objId in protsLabelsDict.keys():
+                    protDict['label'] = protsLabelsDict[objId]
+                    protDict['labelColor'] = []
+                    for label in protDict['label']:
+                        protDict['labelColor'].append(labelsDict[label])
+
+                if objId in filesPaths:
+                    protDict['filesPath'] = filesPaths[objId]
+
+                writer.write(protDict)
+                indexWriter.write(protDict)
+
+        if cache is not None:
+            cache.save()
+        self.workflowPath.set(workflowJsonPath)
+        self.info(f"Workflow JSON saved: {workflowJsonPath}")
+
+    def getWorkflowProtocols(self):
+        """ Return the protocols to be exported: all the project ones or
+        only those needed to produce the input sets (and the extra
+        protocols requested). """
+        runs = self.getProject().getRuns()
+        if self.workflowMode.get() == WORKFLOW_ALL:
+            return runs
+
+        startIds = [inputSetPointer.get().getObjParentId() for inputSetPointer in self.inputSets]
+        startIds.extend(self.getExtraProtocolIds())
+        selectedIds = getAncestors(self.getParentsIndex(runs), startIds)
+        return [prot for prot in runs if prot.getObjId() in selectedIds]
+
+    def getExtraProtocolIds(self):
+        extraProts = self.extraProtocols.get() or ''
+        return [int(protId) for protId in extraProts.replace(' ', '').split(',') if protId]
+
+    def getParentsIndex(self, prots):
+        """ Return {protocol id: set of ids of the protocols it takes inputs from}
+        going once over the input pointers of every protocol. """
+        parentsIndex = {}
+        for prot in prots:
+            parents = parentsIndex.setdefault(prot.getObjId(), set())
+            for name, item in prot.iterInputAttributes():
+                try:
+                    parents.add(int(item.getUniqueId().split('.')[0]))
+                except (AttributeError, ValueError) as e:
+                    self.warning(f"Input {name} of {prot.getRunName()} is not "
+                                 f"taken into account: {e}")
+        return parentsIndex
+
+    def getProtocolFingerprint(self, prot):
+        """ Describe the protocol state: status, end time and the size and
+        modification time of its outputs, plus the params of this protocol
+        that change the fragments (e.g. the top level folder is part of the
+        images_representation paths). """
+        outputs = []
+        for name, output in prot.iterOutputAttributes():
+            fileName = output.getFileName() if hasattr(output, 'getFileName') else None
+            outputs.append([name,
+                            output.getSize() if isinstance(output, Set) else None,
+                            os.path.getmtime(fileName) if fileName and os.path.exists(fileName) else None])
+        return [prot.getStatus(), str(getattr(prot, 'endTime', '')), outputs,
+                self.samplingPolicies.get(), self.logMode.get(), self.logTailSize.get(),
+                self.entryTopLevel.get()]
+
+    def getProtocolFragment(self, prot, protLabels):
+        """ Return the summary, outputs, plots, log and plugin info of a
+        protocol to be added to its workflow dict. """
+        objId = prot.getObjId()
+        runName = prot.getRunName()
+        protDict = {}
+        # Get summary and add input and output information
+        with self._profiler.phase('summary', runName):
             summary = prot.summary()
             for a, item in prot.iterInputAttributes():
                 if item.isPointer():
                     try:
-                        inputLabel = protDicts[int(item.getUniqueId().split('.')[0])]['object.label']
+                        inputLabel = protLabels[int(item.getUniqueId().split('.')[0])]
                         inputLabel = f" (from {inputLabel}) "
                     except:
                         inputLabel = ''
                 itemName = item.getUniqueId() if item.isPointer() else item.getObjName()
                 summary.append(f"Input: {itemName}{inputLabel} - {str(item.get())}")
 
-            protDicts[objId]['output'] = []
+        protDict['output'] = []
 
-            for a, output in prot.iterOutputAttributes():
-                protDicts[objId]['output'].append(self.getOutputDict(output))
-                summary.append(f"Output: {output.getObjName()} - {str(output)}")
+        for a, output in prot.iterOutputAttributes():
+            with self._profiler.phase('outputs', runName, output.getClassName()):
+                protDict['output'].append(self.getOutputDict(output))
+            summary.append(f"Output: {output.getObjName()} - {str(output)}")
 
-            # additional plots
+        # additional plots
+        with self._profiler.phase('plots', runName):
             additionalPlots = self.getAdditionalPlots(prot)
-            for plotName, plotPath in additionalPlots.items():
-                protDicts[objId]['output'].append({OUTPUT_NAME: plotName,
-                                                   OUTPUT_ITEMS: [{ITEM_REPRESENTATION: plotPath}]})
-
-            protDicts[objId]['summary'] = '\n'.join(summary)
-
-            # Get log (stdout)
-            outputs = []
-            stdout = prot.getStdoutLog()
-            if pwutils.exists(stdout):
-                logPath = self.getTopLevelPath(DIR_IMAGES,
-                                               "%s_%s.log" % (objId, prot.getClassName()))
-                pwutils.copyFile(stdout, logPath)
-                outputs = logPath
-
-            protDicts[objId]['log'] = outputs
-
-            # labels
-            if objId in protsLabelsDict.keys():
-                protDicts[objId]['label'] = protsLabelsDict[objId]
-                protDicts[objId]['labelColor'] = []
-                for label in protDicts[objId]['label']:
-                    protDicts[objId]['labelColor'].append(labelsDict[label])
-
-            # Get plugin and binary version
-            try:
-                protDicts[objId]['plugin'] = prot.getPlugin().getName()
-                package = self.getClassPackage()
-                if hasattr(package, "__version__"):
-                    protDicts[objId]['pluginVersion'] = package.__version__
-                protDicts[objId]['pluginBinaryVersion'] = prot.getPlugin().getActiveVersion()
-            except:
-                pass
+        for plotName, plotPath in additionalPlots.items():
+            protDict['output'].append({OUTPUT_NAME: plotName,
+                                       OUTPUT_ITEMS: [{ITEM_REPRESENTATION: plotPath}]})
 
-        for inputSetPointer in self.inputSets:
-            inputSet = inputSetPointer.get()
-            setName = inputSet.getObjName()
-            setParentId = inputSet.getObjParentId()
-            setParentObj = project.getObject(setParentId)
-            protDicts[setParentId]['filesPath'] = os.path.join('.', setName)
-            pwutils.createLink(setParentObj._getExtraPath(), self.getTopLevelPath(setName))
+        protDict['summary'] = '\n'.join(summary)
 
-        with open(workflowJsonPath, 'w') as f:
-            f.write(json.dumps(list(protDicts.values()), indent=4, separators=(',', ': ')))
+        # Get log (stdout)
+        outputs = []
+        stdout = prot.getStdoutLog()
+        if pwutils.exists(stdout):
+            logPath = self.getTopLevelPath(DIR_IMAGES,
+                                           "%s_%s.log" % (objId, prot.getClassName()))
+            with self._profiler.phase('log', runName):
+                outputs = packLog(stdout, logPath, mode=self.logMode.get(),
+                                  tailSize=self.logTailSize.get() * 1024)
 
-        self.workflowPath.set(workflowJsonPath)
-        self.info(f"Workflow JSON saved: {workflowJsonPath}")
+        protDict['log'] = outputs
 
-    def validateDepoJson(self, depoDict):
-        with open(DEPOSITION_SCHEMA) as f:
-            schema = json.load(f)
+        # Get plugin and binary version
+        try:
+            protDict['plugin'] = prot.getPlugin().getName()
+            package = self.getClassPackage()
+            if hasattr(package, "__version__"):
+                protDict['pluginVersion'] = package.__version__
+            protDict['pluginBinaryVersion'] = prot.getPlugin().getActiveVersion()
+        except:
+            pass
+
+        return protDict
+
+    def analyzeDepositionTree(self):
+        """ Report the files that will be uploaded, warning about those
+        that look redundant. """
+        report = analyzeTree(self.getTopLevelPath())
+        reportFn = self._getExtraPath(TREE_REPORT)
+        with open(reportFn, 'w') as f:
+            json.dump(report, f, indent=4)
+
+        self.info(f"Deposition tree: {report['files']} files, "
+                  f"{pwutils.prettySize(report['bytes'])}, "
+                  f"{report['smallFiles']} of them smaller than 1 MB. "
+                  f"Details at {reportFn}")
+        for key, description in [('duplicates', 'reached more than once through links'),
+                                 ('intermediates', 'that look like intermediate files'),
+                                 ('brokenLinks', 'that are broken links (skipped)'),
+                                 ('linkLoops', 'that link to one of their parent folders (skipped)')]:
+            if report[key]:
+                self.warning(f"{len(report[key])} files {description}, e.g. "
+                             f"{', '.join(report[key][:5])}")
+
+    def saveProfile(self):
+        """ Write the profiling report, adding what was written in the
+        images representation folder. """
+        imagesBytes, imagesFiles = getFolderSize(self.getTopLevelPath(DIR_IMAGES))
+        reportFn = self._getExtraPath(PROFILE_REPORT)
+        report = self._profiler.save(reportFn, imagesRepresentation={'bytes': imagesBytes,
+                                                                      'files': imagesFiles})
+        self.info(f"Profiling report saved: {reportFn}")
+        for entry in report['entries'][:PROFILE_TOP]:
+            self.info(formatEntry(entry))
 
-        jsonschema.validate(depoDict, schema)  # raises exception if not valid
+    def validateDepoJson(self, depoDict):
+        import jsonschema
+        from empiar.schema import getValidationErrors
+        errors = getValidationErrors(depoDict, getDepositionSchema())
+        if errors:  # report all the problems at once
+            raise jsonschema.ValidationError("Deposition json is not valid:\n" + "\n".join(errors))
 
     # --------------- imageSet utils -------------------------
     def getEmpiarCategory(self, imageSet):
@@ -615,8 +969,10 @@ class EmpiarDepositor(EMProtocol):
             return imgFormat, ''
 
     def getVoxelType(self, imageObj):
+        from pwem import emlib
         dataType = self._ih.getDataType(imageObj)
-        empiarType = VOXELTYPES.get(dataType, None)
+        voxelTypes = {getattr(emlib, name): value for name, value in VOXELTYPES.items()}
+        empiarType = voxelTypes.get(dataType, None)
         if empiarType is None:
             raise EmpiarMappingError('Could not map voxel type for '
                                      f'image {imageObj.getFilename()}')
@@ -645,15 +1001,47 @@ class EmpiarDepositor(EMProtocol):
     def processImageSets(self):
         inputSets = [s.get() for s in self.inputSets]
         imgSetDicts = []
-        for imgSet in inputSets:
-            try:
-                imgSetDict = self.getImageSetDict(imgSet)
-            except:
-                pass
-            else:
-                imgSetDicts.append(imgSetDict)
+        scanReport = {}
+        with HeaderCache(self._getExtraPath(SCAN_CACHE)) as cache:
+            for imgSet in inputSets:
+                try:
+                    imgSetDict = self.getImageSetDict(imgSet)
+                except Exception as e:
+                    self.warning(f"Image set {imgSet.getObjName()} will not be "
+                                 f"described in the deposition: {e}")
+                else:
+                    imgSetDicts.append(imgSetDict)
+                scanReport[imgSet.getObjName()] = self.scanImageSet(imgSet, cache)
+
+        reportFn = self._getExtraPath(SCAN_REPORT)
+        with open(reportFn, 'w') as f:
+            json.dump(scanReport, f, indent=4)
+        heterogeneous = [name for name, report in scanReport.items() if report['outliers']]
+        if heterogeneous and self.strictImageSets:
+            raise EmpiarMappingError(f"Image sets with files that differ from the rest or "
+                                     f"can not be read: {', '.join(heterogeneous)}. "
+                                     f"Details at {reportFn}")
         return imgSetDicts
 
+    def scanImageSet(self, imageSet, cache):
+        """ Read the headers of all the files of the set and report those
+        that differ from the most common format, dimensions, frames and
+        voxel type. """
+        keys = HEADER_KEYS
+        if imageSet.getClassName() in STACK_SETS:
+            # stacks may hold a different number of images each
+            keys = tuple(key for key in keys if key != 'frames')
+        files = [self.getProjectPath(fn) for fn in imageSet.getFiles()]
+        report = findOutliers(scanFiles(files, cache), keys)
+
+        self.info(f"Image set {imageSet.getObjName()}: {report['files']} files, "
+                  f"{pwutils.prettySize(report['bytes'])}, {report['reference']}")
+        for outlier in report['outliers'][:10]:
+            self.warning(f"{outlier['path']}: {outlier.get('error') or outlier['differences']}")
+        if len(report['outliers']) > 10:
+            self.warning(f"... {len(report['outliers']) - 10} more files differ")
+        return report
+
     def getScipionWorkflow(self):
         workflowDict = copy.deepcopy(self._workflowTemplate)
         workflowDict[SCIPION_WORKFLOW] = "%s/%s/%s" % (ENTRY_DIR,
@@ -662,6 +1050,7 @@ class EmpiarDepositor(EMProtocol):
         return workflowDict
 
     def getOutputDict(self, output):
+        from empiar.sampling import getPolicy, parsePolicies
         self.outputName = output.getObjName()
         outputDict = {
             OUTPUT_NAME: output.getObjName(),
@@ -672,64 +1061,72 @@ class EmpiarDepositor(EMProtocol):
         # If output is a Set get a list with all items
         if isinstance(output, Set):
             outputDict[OUTPUT_SIZE] = output.getSize()
-            count = 0
             if isinstance(output, SetOfCoordinates):
-                coordinatesDict = {}
-                for micrograph in output.getMicrographs():  # get the first three micrographs
-                    micFn = micrograph.getFileName()
-                    count += 1
-                    repPath = self.getTopLevelPath(DIR_IMAGES, '%s_%s' % (
-                        self.outputName, pwutils.replaceBaseExt(micFn, 'jpg')))
-                    self.createThumbnail(micFn, repPath, type=Micrograph)
-                    coordinatesDict[micrograph.getMicName()] = {'path': repPath,
-                                                                'Xdim': micrograph.getXDim(),
-                                                                'Ydim': micrograph.getYDim()}
-
-                    items.append({ITEM_REPRESENTATION: repPath})
-                    if count == 3:
-                        break
-
-                for coordinate in output:  #  for each micrograph, get its coordinates
-                    if coordinate.getMicName() in coordinatesDict:
-                        coordinatesDict[coordinate.getMicName()].setdefault('coords', []).append(
-                            [coordinate.getX(), coordinate.getY()])
-
-                for micrograph, values in coordinatesDict.items():  # draw coordinates in micrographs jpgs
-                    if 'coords' in values:
-                        image = ImagePIL.open(values['path']).convert('RGB')
-                        W_mic = values['Xdim']
-                        H_mic = values['Ydim']
-                        W_jpg, H_jpg = image.size
-                        draw = ImageDraw.Draw(image)
-                        r = W_jpg / 256
-                        for coord in values['coords']:
-                            x = coord[0] * (W_jpg / W_mic)
-                            y = coord[1] * (H_jpg / H_mic)
-                            draw.ellipse((x - r, y - r, x + r, y + r), fill=(0, 255, 0))
-                        image.save(values['path'], quality=95)
+                items.extend(self.getCoordinatesItems(output))
 
             else:
-                for item in output.iterItems():
-                    count += 1
-                    itemDict = self.getItemDict(item, count)
-                    items.append(itemDict)
-                    # In some types get only a limited number of items
-                    if (isinstance(item, Micrograph) or
-                        isinstance(item, Movie) or
-                        isinstance(item, CTFModel)) and count == 3:
-                        break
-                    if isinstance(item, Particle) and count == 15:
-                        break
+                # only the items chosen by the sampling policy are loaded
+                policy = getPolicy(output, parsePolicies(self.samplingPolicies.get()))
+                for count, item in enumerate(policy.iterItems(output, log=self.warning), start=1):
+                    items.append(self.getItemDict(item, count))
 
         # If it is a single object then only one item is present
         else:
             items.append(self.getItemDict(output))
 
+        self.writeQueuedThumbnails()
         outputDict[OUTPUT_ITEMS] = items
 
         return outputDict
 
+    def getCoordinatesItems(self, coordSet):
+        """ Thumbnail some micrographs of a SetOfCoordinates (the first three
+        by default) and draw over them their coordinates. Only the coordinates
+        of those micrographs are queried from the set (filtering by _micId). """
+        import numpy as np
+        from empiar.columns import SetColumnReader, batches
+        from empiar.representation import drawCoordinates
+        from empiar.sampling import getPolicy, parsePolicies
+        items = []
+        coordinatesDict = {}
+        policy = getPolicy(coordSet, parsePolicies(self.samplingPolicies.get()))
+        for micrograph in policy.iterItems(coordSet.getMicrographs(), log=self.warning):
+            micFn = micrograph.getFileName()
+            repPath = self.getTopLevelPath(DIR_IMAGES, '%s_%s' % (
+                self.outputName, pwutils.replaceBaseExt(micFn, 'jpg')))
+            self.createThumbnail(micFn, repPath, type=Micrograph)
+            coordinatesDict[micrograph.getObjId()] = {'path': repPath,
+                                                      'dims': (micrograph.getXDim(),
+                                                               micrograph.getYDim()),
+                                                      'coords': []}
+            items.append({ITEM_REPRESENTATION: repPath})
+
+        reader = SetColumnReader.fromSet(coordSet)
+        if reader is not None and reader.hasColumns('_micId', '_x', '_y'):
+            columns = reader.read('_micId', '_x', '_y',
+                                  filters={'_micId': list(coordinatesDict)})
+            for micId, values in coordinatesDict.items():
+                inMic = columns['_micId'] == micId
+                values['coords'] = np.column_stack((columns['_x'][inMic], columns['_y'][inMic]))
+        else:
+            # pyworkflow only translates 'label=value' terms joined by AND/OR
+            # into sqlite columns, and sqlite limits the depth of the OR chain
+            for micIds in batches(coordinatesDict, size=500):
+                where = ' OR '.join(f'_micId={micId}' for micId in micIds)
+                for coordinate in coordSet.iterItems(where=where):
+                    coordinatesDict[coordinate.getMicId()]['coords'].append(
+                        (coordinate.getX(), coordinate.getY()))
+
+        for values in coordinatesDict.values():  # draw coordinates in micrographs jpgs
+            if len(values['coords']) > 0:
+                drawCoordinates(values['path'], values['coords'], values['dims'])
+
+        return items
+
     def getItemDict(self, item, count=None):
+        from PIL import Image as ImagePIL
+        from pwem import emlib
+        from empiar.representation import writeLabel
         attributes = item.getAttributes()
         # Skip attributes that are Pointer
         itemDict = {k: str(v) for k, v in attributes if not v.isPointer()}
@@ -737,21 +1134,22 @@ class EmpiarDepositor(EMProtocol):
 
         try:
             # Get item representation
-            if isinstance(item, Class2D):
+            if isInstanceByName(item, 'TiltSeries'):
+                itemDict[ITEM_REPRESENTATION] = self.getTiltSeriesMontage(item)
+
+            elif isInstanceByName(item, 'SubTomogram'):
+                itemDict[ITEM_REPRESENTATION] = self.getSubTomogramSlices(item)
+
+            elif isinstance(item, Class2D):
                 # use representative as item representation
                 rep = item.getRepresentative()
                 repPath = self.getTopLevelPath(DIR_IMAGES, '%s_%s_%s' % (
                     self.outputName, rep.getIndex(),
                     pwutils.replaceBaseExt(rep.getFileName(), 'jpg')))
-                self._ih.convert(rep.getLocation(), self.getProjectPath(repPath))
-
-                if '_size' in itemDict:  # write number of particles over the class
-                    text = itemDict['_size'] + " ptcls"
-                    image = ImagePIL.open(repPath).convert('RGB')
-                    W, H = image.size
-                    draw = ImageDraw.Draw(image)
-                    draw.text((5, H - 15), text, fill=(0, 255, 0))
-                    image.save(repPath, quality=95)
+                # write number of particles over the class
+                label = itemDict['_size'] + " ptcls" if '_size' in itemDict else None
+                if not self.queueStackThumbnail(rep.getFileName(), rep.getIndex(), repPath, label):
+                    self.convertThumbnail(rep.getLocation(), repPath, label)
 
                 itemDict[ITEM_REPRESENTATION] = repPath
 
@@ -771,12 +1169,9 @@ class EmpiarDepositor(EMProtocol):
                 self.writeSlices(V, os.path.join(repDir, 'slicesZ'), 'Z')
 
                 if '_size' in itemDict:  # write number of particles over a class image
-                    text = itemDict['_size'] + " ptcls"
-                    image = ImagePIL.open(os.path.join(repDir, 'slicesX_0000.jpg')).convert('RGB')
-                    W, H = image.size
-                    draw = ImageDraw.Draw(image)
-                    draw.text((5, H - 15), text, fill=(0, 255, 0))
-                    image.save(os.path.join(repDir, 'slicesX_0000.jpg'), quality=95)
+                    slicePath = os.path.join(repDir, 'slicesX_0000.jpg')
+                    image = writeLabel(ImagePIL.open(slicePath), itemDict['_size'] + " ptcls")
+                    image.save(slicePath, quality=95)
 
                 itemDict[ITEM_REPRESENTATION] = [os.path.join(repDir, file) for file in sorted(os.listdir(repDir))]
 
@@ -808,9 +1203,12 @@ class EmpiarDepositor(EMProtocol):
                                                '%s_%s_%s' % (self.outputName,
                                                              item.getIndex(),
                                                              pwutils.replaceBaseExt(itemFn, 'jpg')))
-                self.createThumbnail(itemFn, repPath,
-                                     Micrograph if isinstance(item, Micrograph) else Particle if isinstance(item, Particle) else None,
-                                     count)
+                # particles from MRC stacks are written later, all at once
+                if not (isinstance(item, Particle) and
+                        self.queueStackThumbnail(itemFn, item.getIndex(), repPath)):
+                    self.createThumbnail(itemFn, repPath,
+                                         Micrograph if isinstance(item, Micrograph) else Particle if isinstance(item, Particle) else None,
+                                         item.getIndex() or count)
                 itemDict[ITEM_REPRESENTATION] = repPath
 
             elif isinstance(item, CTFModel):
@@ -828,15 +1226,8 @@ class EmpiarDepositor(EMProtocol):
                                                    '%s_%s' % (self.outputName,
                                                               pwutils.replaceBaseExt(itemPath, 'jpg')))
 
-                    image = emlib.Image(itemPath)
-                    data = image.getData()
-
-                    GAMMA = 2.2 # apply a gamma correction
-                    data = data ** (1/GAMMA)
-                    data = np.fft.fftshift(data)
-
-                    image.setData(data)
-                    image.write(repPath)
+                    # rendered later together with the other PSDs of the output
+                    self._psdThumbnails.append((itemPath, repPath))
 
                 itemDict[ITEM_REPRESENTATION] = repPath
 
@@ -844,7 +1235,8 @@ class EmpiarDepositor(EMProtocol):
                 # in any other case look for a representation on attributes
                 for key, value in attributes:
                     itemPath = str(value)
-                    if os.path.exists(itemPath):
+                    # only check on disk the values that look like images
+                    if pwutils.getExt(itemPath).lower() in IMAGE_EXTENSIONS and os.path.exists(itemPath):
                         repPath = self.getTopLevelPath(DIR_IMAGES,
                                                        '%s_%s' % (self.outputName,
                                                                   pwutils.replaceBaseExt(itemPath, 'png')))
@@ -857,6 +1249,100 @@ class EmpiarDepositor(EMProtocol):
 
         return itemDict
 
+    def getTiltSeriesMontage(self, tiltSeries):
+        """ Montage of a few tilts (evenly spread over the tilt range) of a
+        tilt series, downsampled and read one at a time. Only the metadata
+        of the rest of tilts is loaded. """
+        from empiar.representation import (MrcStack, getMrcFileName, sampleIndexes,
+                                           writeMontage)
+        tilts = sorted((tiltImage.getTiltAngle(), tiltImage.getIndex() or 1,
+                        tiltImage.getFileName()) for tiltImage in tiltSeries.iterItems())
+        tilts = [tilts[i] for i in sampleIndexes(len(tilts))]
+        stacks = {}
+
+        def readTilts():
+            for _, index, fileName in tilts:
+                mrcFn = getMrcFileName(fileName)
+                if mrcFn is None:
+                    yield self._ih.read((index, fileName)).getData()
+                else:
+                    if mrcFn not in stacks:
+                        stacks[mrcFn] = MrcStack(mrcFn)
+                    yield stacks[mrcFn].getImage(index)
+
+        tsId = tiltSeries.getTsId() if hasattr(tiltSeries, 'getTsId') else tiltSeries.getObjId()
+        repPath = self.getTopLevelPath(DIR_IMAGES, f'{self.outputName}_{tsId}_montage.jpg')
+        writeMontage(readTilts(), len(tilts), self.getProjectPath(repPath),
+                     labels=[f'{angle:+.0f}' for angle, _, _ in tilts])
+        return repPath
+
+    def getSubTomogramSlices(self, subTomogram):
+        """ Central X, Y and Z slices of a subtomogram. MRC files are memory
+        mapped so only those slices are read; stacks of volumes not marked
+        as such in their header are read with the image handler. """
+        import numpy as np
+        from empiar.representation import MrcStack, getMrcFileName, writeCentralSlices
+        fileName = subTomogram.getFileName()
+        mrcFn = getMrcFileName(fileName)
+        volume = None
+        if mrcFn is not None:
+            try:
+                volume = MrcStack(mrcFn).getVolume(subTomogram.getIndex())
+            except IndexError:
+                pass
+        if volume is None:
+            volume = np.squeeze(self._ih.read(subTomogram.getLocation()).getData())
+
+        repRoot = '%s_%s_%s' % (self.outputName, subTomogram.getIndex() or 1,
+                                pwutils.removeBaseExt(fileName))
+        repPaths = [self.getTopLevelPath(DIR_IMAGES, f'{repRoot}_slice{axis}.jpg')
+                    for axis in 'XYZ']
+        writeCentralSlices(volume, [self.getProjectPath(p) for p in repPaths])
+        return repPaths
+
+    def queueStackThumbnail(self, fileName, index, repPath, label=None):
+        """ Leave the thumbnail of an image of an MRC stack to be written
+        together with the rest of images of the same stack.
+        Return False if the image is not in an MRC file. """
+        from empiar.representation import getMrcFileName
+        mrcFn = getMrcFileName(fileName)
+        if mrcFn is None:
+            return False
+        self._stackThumbnails.setdefault(mrcFn, []).append((index or 1, repPath, label, fileName))
+        return True
+
+    def writeQueuedThumbnails(self):
+        """ Write the queued thumbnails, reading each MRC stack only once,
+        and the queued PSDs. """
+        from pwem import emlib
+        from empiar.representation import writeStackThumbnails, writePsdThumbnails
+        for mrcFn, thumbnails in self._stackThumbnails.items():
+            try:
+                writeStackThumbnails(mrcFn, [(index, self.getProjectPath(repPath), label)
+                                             for index, repPath, label, _ in thumbnails])
+            except Exception as e:
+                self.warning(f"Cannot read {mrcFn} as a MRC stack ({e}), "
+                             "converting images one by one.")
+                for index, repPath, label, fileName in thumbnails:
+                    self.convertThumbnail((index, fileName), repPath, label)
+        self._stackThumbnails = {}
+
+        errors = writePsdThumbnails([(psdFn, self.getProjectPath(repPath))
+                                     for psdFn, repPath in self._psdThumbnails],
+                                    lambda psdFn: emlib.Image(psdFn).getData())
+        for psdFn, e in errors:
+            self.error(f"Cannot obtain item representation for {psdFn}: {e}")
+        self._psdThumbnails = []
+
+    def convertThumbnail(self, location, repPath, label=None):
+        """ Convert a single image into a jpg, with an optional label. """
+        from PIL import Image as ImagePIL
+        from empiar.representation import writeLabel
+        self._ih.convert(location, self.getProjectPath(repPath))
+        if label:
+            image = writeLabel(ImagePIL.open(repPath), label)
+            image.save(repPath, quality=95)
+
     def createThumbnail(self, inputFn, outputFn, type, count=None):
         """ Apply a low pass filter and make a jpg thumbnail. """
         outputFn = self.getProjectPath(outputFn)
@@ -864,6 +1350,7 @@ class EmpiarDepositor(EMProtocol):
         #     self._ih.convert(inputFn, outputFn)
         x, y, z, n = self._ih.getDimensions(inputFn)
         getEnviron = Domain.importFromPlugin('xmipp3', 'Plugin', doRaise=True).getEnviron
+        self._profiler.count('thumbnailSubprocesses')
         if type == Particle:
             args = f" -i {inputFn if n == 1 else f'{count}@{inputFn}'} -o {outputFn}"
             self.runJob('xmipp_image_convert', args, env=getEnviron())
@@ -873,17 +1360,18 @@ class EmpiarDepositor(EMProtocol):
 
     def getAdditionalPlots(self, prot):
         """ Generate additional plots apart from basic thumbnails. """
+        from empiar.statistics import defocusStats
         def getMRCVolume(output, outputName):
             itemFn = output.getFileName()
             if itemFn.endswith('mrc'):
                 itemFn = itemFn.replace(':mrc', '')
                 repPath = self.getTopLevelPath(DIR_IMAGES,
                                                f"{outputName}_{pwutils.removeBaseExt(itemFn)}.mrc")
-                shutil.copy(itemFn, repPath)
+                linkOrCopy(itemFn, repPath)
             if itemFn.endswith('.map'):
                 repPath = self.getTopLevelPath(DIR_IMAGES,
                                                f"{outputName}_{pwutils.removeBaseExt(itemFn)}.map")
-                shutil.copy(itemFn, repPath)
+                linkOrCopy(itemFn, repPath)
             if itemFn.endswith('.vol'): # already copied (because it was previously converted to mrc)
                 repPath = self.getTopLevelPath(DIR_IMAGES,
                                                f"{outputName}_{pwutils.removeBaseExt(itemFn)}.mrc")
@@ -893,62 +1381,22 @@ class EmpiarDepositor(EMProtocol):
         for a, output in prot.iterOutputAttributes():
             # alignment methods
             if isinstance(output, SetOfMicrographs):
-                shiftsX, shiftsY, totalShifts = [], [], []
-                for item in output.iterItems():
-                    # XmippProtFlexAlign, XmippProtMovieMaxShift...
-                    if item.hasAttribute('_xmipp_ShiftX') and item.hasAttribute('_xmipp_ShiftY'):
-                        shiftsX = [float(x) for x in item.getAttributeValue('_xmipp_ShiftX').split(',')]
-                        shiftsY = [float(y) for y in item.getAttributeValue('_xmipp_ShiftY').split(',')]
-
-                    # ProtRelionMotioncor
-                    elif os.path.exists(os.path.join(prot._getExtraPath(), pwutils.replaceBaseExt(item.getMicName(), 'star'))):
-                        starFile = os.path.join(prot._getExtraPath(), pwutils.replaceBaseExt(item.getMicName(), 'star'))
-                        table = md.Table(fileName=starFile, tableName='global_shift')
-
-                        for i, row in enumerate(table):
-                            shiftsX.append(float(row.rlnMicrographShiftX))
-                            shiftsY.append(float(row.rlnMicrographShiftY))
-
-                    if len(shiftsX) > 0 and len(shiftsY) > 0:
-                        # relative shifts
-                        relativeShiftsX = [shiftsX[i] - shiftsX[i-1] for i in range(1, len(shiftsX))]
-                        relativeShiftsY = [shiftsY[i] - shiftsY[i-1] for i in range(1, len(shiftsY))]
-
-                        totalShifts.append(sqrt(sum((x**2 + y**2) for x, y in zip(relativeShiftsX, relativeShiftsY))))
-
-                        numberOfBins = 10
-                        plotterShifts = EmPlotter()
-                        plotterShifts.createSubPlot("Total shifts histogram", "Drift (pixels)", "#")
-                        plotterShifts.plotHist(totalShifts, nbins=numberOfBins)
-                        repPath = self.getTopLevelPath(DIR_IMAGES, f'{output.getObjName()}_shifts_histogram.jpg')
-                        plotterShifts.savefig(os.path.join(self.getProject().path, repPath))
-                        plotterShifts.close()
-                        plotPaths[f'{output.getObjName()}_shifts_histogram'] = repPath
+                drifts = self.getDrifts(prot, output)
+                if len(drifts) > 0:
+                    name = f'{output.getObjName()}_shifts_histogram'
+                    plotPaths[name] = self.saveHistogram(drifts, f'{name}.jpg',
+                                                         "Total shifts histogram", "Drift (pixels)")
 
             # CTF methods
             if isinstance(output, SetOfCTF):
-                defocusU = [ctf.getDefocusU() for ctf in output]
-                defocusV = [ctf.getDefocusV() for ctf in output]
-                defocus = [(defU + defV)/2 for defU, defV in zip(defocusU, defocusV)]
-                astigmatism = [abs(defU - defV)/2 for defU, defV in zip(defocusU, defocusV)]
-
-                numberOfBins = 10
-                plotterDefocus = EmPlotter()
-                plotterAstigmatism = EmPlotter()
-
-                plotterDefocus.createSubPlot("Defocus histogram", "Defocus (A)", "#")
-                plotterDefocus.plotHist(defocus, nbins=numberOfBins)
-                repPath = self.getTopLevelPath(DIR_IMAGES, f'{output.getObjName()}_defocus_histogram.jpg')
-                plotterDefocus.savefig(os.path.join(self.getProject().path, repPath))
-                plotterDefocus.close()
-                plotPaths[f'{output.getObjName()}_defocus_histogram'] = repPath
-
-                plotterAstigmatism.createSubPlot("Astigmatism histogram", "Astigmatism (A)", "#")
-                plotterAstigmatism.plotHist(astigmatism, nbins=numberOfBins)
-                repPath = self.getTopLevelPath(DIR_IMAGES, f'{output.getObjName()}_defocus_astigmatism.jpg')
-                plotterAstigmatism.savefig(os.path.join(self.getProject().path, repPath))
-                plotterAstigmatism.close()
-                plotPaths[f'{output.getObjName()}_defocus_astigmatism.jpg'] = repPath
+                defocus, astigmatism = defocusStats(*self.getDefocus(output))
+
+                name = f'{output.getObjName()}_defocus_histogram'
+                plotPaths[name] = self.saveHistogram(defocus, f'{name}.jpg',
+                                                     "Defocus histogram", "Defocus (A)")
+                name = f'{output.getObjName()}_defocus_astigmatism'
+                plotPaths[f'{name}.jpg'] = self.saveHistogram(astigmatism, f'{name}.jpg',
+                                                              "Astigmatism histogram", "Astigmatism (A)")
 
             # Volumes
             if isinstance(output, Volume):
@@ -962,8 +1410,87 @@ class EmpiarDepositor(EMProtocol):
 
         return plotPaths
 
+    def getDrifts(self, prot, micSet):
+        """ Return an array with the total drift of each micrograph. Columns
+        are read in bulk from the set sqlite when possible. """
+        import numpy as np
+        from empiar.columns import SetColumnReader
+        from empiar.statistics import totalDrifts
+        reader = SetColumnReader.fromSet(micSet)
+        if reader is None:
+            return self._getDriftsFromItems(prot, micSet)
+
+        # XmippProtFlexAlign, XmippProtMovieMaxShift...
+        if reader.hasColumns('_xmipp_ShiftX', '_xmipp_ShiftY'):
+            columns = reader.read('_xmipp_ShiftX', '_xmipp_ShiftY',
+                                  dtypes={'_xmipp_ShiftX': object, '_xmipp_ShiftY': object})
+            shiftsX, shiftsY = columns['_xmipp_ShiftX'], columns['_xmipp_ShiftY']
+            valid = np.not_equal(shiftsX, None) & np.not_equal(shiftsY, None)
+            return totalDrifts(shiftsX[valid], shiftsY[valid])
+
+        # ProtRelionMotioncor
+        micNames = reader.read('_micName', dtypes={'_micName': object})['_micName']
+        return self._getRelionDrifts(prot, micNames)
+
+    def _getDriftsFromItems(self, prot, micSet):
+        import numpy as np
+        from empiar.statistics import ColumnAccumulator, parseShifts, totalDrift
+        stats = ColumnAccumulator('drift')
+        micNames = []
+        for item in micSet.iterItems():
+            # XmippProtFlexAlign, XmippProtMovieMaxShift...
+            if item.hasAttribute('_xmipp_ShiftX') and item.hasAttribute('_xmipp_ShiftY'):
+                shiftsX = parseShifts(item.getAttributeValue('_xmipp_ShiftX'))
+                shiftsY = parseShifts(item.getAttributeValue('_xmipp_ShiftY'))
+                if len(shiftsX) > 0 and len(shiftsY) > 0:
+                    stats.append(drift=totalDrift(shiftsX, shiftsY))
+            # ProtRelionMotioncor
+            else:
+                micNames.append(item.getMicName())
+
+        return np.concatenate((stats.getArray('drift'),
+                               self._getRelionDrifts(prot, micNames)))
+
+    def _getRelionDrifts(self, prot, micNames):
+        """ Total drifts from the star files that RELION motioncor writes
+        in its extra folder. Parsed shifts are cached in the project Tmp. """
+        import numpy as np
+        from empiar.statistics import StarShiftsReader, totalDrift
+        cacheFile = self.getProject().getTmpPath(f'empiar_shifts_{prot.getObjId()}.json')
+        starReader = StarShiftsReader(prot._getExtraPath(), cacheFile=cacheFile)
+        return np.array([totalDrift(shiftsX, shiftsY)
+                         for shiftsX, shiftsY in starReader.readShifts(micNames)
+                         if len(shiftsX) > 0 and len(shiftsY) > 0])
+
+    def getDefocus(self, ctfSet):
+        """ Return the defocusU and defocusV arrays of a SetOfCTF. """
+        from empiar.columns import SetColumnReader
+        from empiar.statistics import ColumnAccumulator
+        reader = SetColumnReader.fromSet(ctfSet)
+        if reader is not None and reader.hasColumns('_defocusU', '_defocusV'):
+            columns = reader.read('_defocusU', '_defocusV')
+            return columns['_defocusU'], columns['_defocusV']
+
+        stats = ColumnAccumulator('defocusU', 'defocusV')
+        for ctf in ctfSet.iterItems():
+            stats.append(defocusU=ctf.getDefocusU(), defocusV=ctf.getDefocusV())
+        return stats.getArray('defocusU'), stats.getArray('defocusV')
+
+    def saveHistogram(self, values, fileName, title, xlabel, numberOfBins=10):
+        """ Plot a histogram into images_representation and return its path. """
+        from pwem.viewers import EmPlotter
+        plotter = EmPlotter()
+        plotter.createSubPlot(title, xlabel, "#")
+        plotter.plotHist(values, nbins=numberOfBins)
+        repPath = self.getTopLevelPath(DIR_IMAGES, fileName)
+        plotter.savefig(self.getProjectPath(repPath))
+        plotter.close()
+        return repPath
+
     def writeSlices(self, V, fnRoot, direction):
         """ Generate volume slices for x, y and z axis. """
+        import numpy as np
+        from PIL import Image as ImagePIL
         V = np.squeeze(V) # for volumes with numpy arrays with 4 dims
         m = np.min(V)
         M = np.max(V)
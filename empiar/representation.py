@@ -0,0 +1,244 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+""" Helpers to build the images shown in the workflow viewer. """
+
+import numpy as np
+from PIL import Image as ImagePIL
+from PIL import ImageDraw
+
+from empiar.constants import MRC_EXTENSIONS
+
+COORDINATE_COLOR = (0, 255, 0)
+LABEL_COLOR = (0, 255, 0)
+
+THUMBNAIL_SIZE = 256
+MONTAGE_TILE = 128
+MONTAGE_IMAGES = 9  # at most this number of tilts in a tilt series montage
+GAMMA = 2.2
+GAMMA_LUT_SIZE = 4096
+
+MRC_HEADER_SIZE = 1024
+MRC_MODES = {0: np.int8, 1: np.int16, 2: np.float32,
+             6: np.uint16, 12: np.float16}
+MRC_VOLUME_STACK = 401  # space group of the stacks of volumes
+
+
+def diskOffsets(radius):
+    """ Return the (dy, dx) offsets of the pixels inside a disk. """
+    r = max(int(round(radius)), 1)
+    dy, dx = np.mgrid[-r:r + 1, -r:r + 1]
+    inside = dx ** 2 + dy ** 2 <= r ** 2
+    return dy[inside], dx[inside]
+
+
+def drawCoordinates(jpgPath, coords, micDims, color=COORDINATE_COLOR):
+    """ Draw the coordinates over a micrograph thumbnail in a single pass.
+    :param jpgPath: thumbnail to be overwritten
+    :param coords: Nx2 array with (x, y) in micrograph pixels
+    :param micDims: (Xdim, Ydim) of the original micrograph
+    """
+    data = np.array(ImagePIL.open(jpgPath).convert('RGB'))
+    H, W = data.shape[:2]
+    coords = np.asarray(coords, dtype=np.float32).reshape(-1, 2)
+
+    # Scale all centers at once and stamp a disk around each of them
+    xs = np.rint(coords[:, 0] * (W / micDims[0])).astype(np.int64)
+    ys = np.rint(coords[:, 1] * (H / micDims[1])).astype(np.int64)
+    dy, dx = diskOffsets(W / 256)
+    px = (xs[:, None] + dx[None, :]).ravel()
+    py = (ys[:, None] + dy[None, :]).ravel()
+    valid = (px >= 0) & (px < W) & (py >= 0) & (py < H)
+    data[py[valid], px[valid]] = color
+
+    ImagePIL.fromarray(data).save(jpgPath, quality=95)
+
+
+def getMrcFileName(fileName):
+    """ Return the MRC file name without the Scipion format suffix
+    (e.g. ':mrc') or None if the file is not an MRC file. """
+    fileName = fileName.split(':')[0]
+    return fileName if fileName.lower().endswith(MRC_EXTENSIONS) else None
+
+
+class MrcStack:
+    """ Memory mapped access to the images of an MRC stack. The file is
+    opened once and the images are returned as NumPy views, so only the
+    requested images are actually read from disk. """
+    def __init__(self, fileName):
+        header = np.fromfile(fileName, dtype=np.uint8, count=MRC_HEADER_SIZE)
+        # the machine stamp tells the byte order (0x44 little, 0x11 big endian)
+        byteOrder = '>' if header[212] == 0x11 else '<'
+        ints = header[:96].view(byteOrder + 'i4')
+        nx, ny, nz, mode = ints[:4]
+        mz, spaceGroup, extendedHeader = ints[9], ints[22], ints[23]
+        if mode not in MRC_MODES:
+            raise ValueError(f"Unsupported MRC mode {mode} in {fileName}")
+        dtype = np.dtype(MRC_MODES[mode]).newbyteorder(byteOrder)
+        self.data = np.memmap(fileName, dtype=dtype, mode='r',
+                              offset=MRC_HEADER_SIZE + int(extendedHeader),
+                              shape=(int(nz), int(ny), int(nx)))
+        # in stacks of volumes the sections of each volume are mz
+        isVolumeStack = spaceGroup == MRC_VOLUME_STACK and 0 < mz and nz % mz == 0
+        self.volumeDepth = int(mz) if isVolumeStack else int(nz)
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    def getImage(self, index):
+        """ Return the image at the given Scipion index (starting at 1). """
+        return self.data[max(index, 1) - 1]
+
+    def getVolume(self, index=None):
+        """ Return the volume at the given Scipion index (starting at 1, None
+        for the only volume of the file). """
+        index = max(index or 1, 1)
+        volumes = self.data.shape[0] // self.volumeDepth
+        if index > volumes:
+            raise IndexError(f"Volume {index} requested from a file with {volumes} volumes")
+        return self.data[(index - 1) * self.volumeDepth:index * self.volumeDepth]
+
+
+def toUint8(data):
+    """ Scale the values of an image to 0-255. """
+    data = np.asarray(data, dtype=np.float32)
+    m, M = data.min(), data.max()
+    if M > m:
+        # rounded, float32 errors would truncate the maximum to 254
+        data = np.rint((data - m) * (255 / (M - m)))
+    else:
+        data = np.zeros_like(data)
+    return data.astype(np.uint8)
+
+
+def writeLabel(image, text):
+    """ Write a text (e.g. number of particles) at the image bottom left. """
+    image = image.convert('RGB')
+    W, H = image.size
+    ImageDraw.Draw(image).text((5, H - 15), text, fill=LABEL_COLOR)
+    return image
+
+
+def writeStackThumbnails(fileName, thumbnails):
+    """ Write the jpg thumbnails of several images of the same MRC stack,
+    opening the stack only once.
+    :param thumbnails: list of (index, output jpg, label or None)
+    """
+    stack = MrcStack(fileName)
+    for index, outputFn, label in thumbnails:
+        image = ImagePIL.fromarray(toUint8(stack.getImage(index)))
+        if label:
+            image = writeLabel(image, label)
+        image.save(outputFn, quality=95)
+
+
+def downsample(data, size=THUMBNAIL_SIZE):
+    """ Average blocks of pixels so the largest side gets close to size. """
+    factor = max(data.shape) // size
+    if factor > 1:
+        H, W = (dim // factor * factor for dim in data.shape)
+        data = data[:H, :W].reshape(H // factor, factor, W // factor, factor).mean(axis=(1, 3))
+    return data
+
+
+_gammaLut = None
+
+
+def getGammaLut():
+    """ Lookup table with the gamma corrected values of [0, 1] as uint8. """
+    global _gammaLut
+    if _gammaLut is None:
+        x = np.linspace(0, 1, GAMMA_LUT_SIZE, dtype=np.float32)
+        _gammaLut = np.rint(255 * x ** (1 / GAMMA)).astype(np.uint8)
+    return _gammaLut
+
+
+def renderPsd(data, outputFn, size=THUMBNAIL_SIZE):
+    """ Write a jpg thumbnail of a PSD: centered (fftshift), downsampled
+    and with a gamma correction to make the Thon rings visible. """
+    data = np.fft.fftshift(np.squeeze(np.asarray(data, dtype=np.float32)))
+    data = downsample(data, size)
+    M = data.max()
+    data = np.clip(data / M, 0, 1) if M > 0 else np.zeros_like(data)
+    image = ImagePIL.fromarray(toUint8(getGammaLut()[(data * (GAMMA_LUT_SIZE - 1)).astype(np.uint16)]))
+    image.thumbnail((size, size))
+    image.save(outputFn, quality=95)
+
+
+def sampleIndexes(size, count=MONTAGE_IMAGES):
+    """ Return at most count indexes evenly spread over range(size),
+    always including the first and the last one. """
+    if size <= count:
+        return list(range(size))
+    return sorted(set(np.rint(np.linspace(0, size - 1, count)).astype(int).tolist()))
+
+
+def writeMontage(images, count, outputFn, labels=None, tileSize=MONTAGE_TILE):
+    """ Write a jpg grid with a downsampled tile per image. The images are
+    consumed one at a time (e.g. from a generator of memory mapped views),
+    so only one of them is in memory at any time.
+    :param images: iterable of 2D arrays
+    :param count: number of images, to size the grid
+    :param labels: optional list with the text written over each tile
+    """
+    columns = max(int(np.ceil(np.sqrt(count))), 1)
+    rows = max(int(np.ceil(count / columns)), 1)
+    montage = ImagePIL.new('RGB', (columns * tileSize, rows * tileSize))
+    for i, data in enumerate(images):
+        tile = ImagePIL.fromarray(toUint8(downsample(np.squeeze(data), tileSize)))
+        tile.thumbnail((tileSize, tileSize))
+        if labels:
+            tile = writeLabel(tile, labels[i])
+        montage.paste(tile, ((i % columns) * tileSize, (i // columns) * tileSize))
+    montage.save(outputFn, quality=95)
+
+
+def writeCentralSlices(volume, outputFns, size=THUMBNAIL_SIZE):
+    """ Write the central X, Y and Z slices of a volume as jpgs. With a
+    memory mapped volume (see MrcStack) only those slices are read.
+    :param outputFns: jpg paths for the (X, Y, Z) slices
+    """
+    Z, Y, X = volume.shape
+    for data, outputFn in zip((volume[:, :, X // 2], volume[:, Y // 2, :], volume[Z // 2]),
+                              outputFns):
+        ImagePIL.fromarray(toUint8(downsample(data, size))).save(outputFn, quality=95)
+
+
+def writePsdThumbnails(psds, readData):
+    """ Render the thumbnails of several PSDs.
+    :param psds: list of (psd file, output jpg)
+    :param readData: function returning the PSD data of a file, used for
+        non-MRC files (MRC ones are memory mapped)
+    :return: list of (psd file, exception) for the PSDs that failed
+    """
+    errors = []
+    for psdFn, outputFn in psds:
+        try:
+            mrcFn = getMrcFileName(psdFn)
+            data = MrcStack(mrcFn).getImage(1) if mrcFn else readData(psdFn)
+            renderPsd(data, outputFn)
+        except Exception as e:
+            errors.append((psdFn, e))
+    return errors
@@ -0,0 +1,184 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+""" Policies to choose which items of an output set are represented in the
+workflow viewer. Only the chosen items are loaded from the set. """
+
+import inspect
+from itertools import islice
+
+import numpy as np
+
+from empiar.columns import SetColumnReader, batches
+
+FIRST = 'first'
+RANDOM = 'random'
+STRATIFIED = 'stratified'
+ALL = 'all'
+
+
+class SamplingPolicy:
+    """ Select the items of a set to be represented:
+        - all: every item
+        - first N: the first N items
+        - random N [seed]: N random items, reproducible with the seed
+        - stratified N column: N items evenly spread over the sorted
+          values of a column (e.g. stratified 5 _defocusU)
+    """
+    def __init__(self, mode=ALL, size=None, column=None, seed=0):
+        self.mode = mode
+        self.size = size
+        self.column = column
+        self.seed = seed
+
+    @classmethod
+    def parse(cls, text):
+        """ Build a policy from its text form, e.g. 'random 15 7'. """
+        words = text.split()
+        if not words or words[0] not in (FIRST, RANDOM, STRATIFIED, ALL):
+            raise ValueError(f"Unknown sampling policy: '{text}'")
+        mode = words[0]
+        if mode == ALL:
+            return cls()
+        if len(words) < 2:
+            raise ValueError(f"Missing number of items in sampling policy: '{text}'")
+        size = int(words[1])
+        if mode == RANDOM:
+            return cls(mode, size, seed=int(words[2]) if len(words) > 2 else 0)
+        if mode == STRATIFIED:
+            if len(words) < 3:
+                raise ValueError(f"Missing column in sampling policy: '{text}'")
+            return cls(mode, size, column=words[2])
+        return cls(mode, size)
+
+    def __str__(self):
+        if self.mode == ALL:
+            return ALL
+        extra = {RANDOM: f' {self.seed}', STRATIFIED: f' {self.column}'}.get(self.mode, '')
+        return f'{self.mode} {self.size}{extra}'
+
+    def iterItems(self, emSet, log):
+        """ Iterate only over the selected items of the set.
+        :param log: function to warn when the policy can not be applied
+        """
+        if self.mode == ALL or self.size is None:
+            yield from emSet.iterItems()
+        elif self.mode == FIRST:
+            if _acceptsArgs(emSet, 'limit'):
+                yield from emSet.iterItems(limit=self.size)
+            else:
+                yield from islice(emSet.iterItems(), self.size)
+        elif _acceptsArgs(emSet, 'where'):
+            # several queries for many ids, so the sql does not grow unbounded
+            for ids in batches(self.selectIds(emSet, log)):
+                idsStr = ','.join(str(objId) for objId in ids)
+                yield from emSet.iterItems(where=f'id IN ({idsStr})')
+        else:
+            # e.g. SetOfClasses, whose items get the mapper of their own images
+            for objId in self.selectIds(emSet, log):
+                yield emSet[objId]
+
+    def selectIds(self, emSet, log):
+        """ Return the ids of the selected items, reading only the needed
+        columns of the set. """
+        reader = SetColumnReader.fromSet(emSet)
+        if self.mode == STRATIFIED:
+            ids = self._selectStratified(emSet, reader, log)
+            if ids is not None:
+                return ids
+
+        if reader is not None:
+            ids = reader.read('id', dtypes={'id': np.int64})['id']
+        else:
+            ids = np.array([item.getObjId() for item in emSet.iterItems()], dtype=np.int64)
+        rng = np.random.default_rng(self.seed)
+        return sorted(int(i) for i in rng.choice(ids, min(self.size, len(ids)), replace=False))
+
+    def _selectStratified(self, emSet, reader, log):
+        """ Return the ids evenly spread over the values of the column or
+        None (after warning) if the column can not be used. """
+        if reader is None:
+            reason = 'can not be read by columns'
+        elif not reader.hasColumns(self.column):
+            reason = 'has no column ' + self.column
+        else:
+            columns = reader.read('id', self.column, dtypes={'id': np.int64,
+                                                             self.column: object})
+            try:
+                values = columns[self.column].astype(np.float64)
+            except (TypeError, ValueError):  # text or empty values
+                values = None
+            if values is not None:
+                ids = columns['id'][np.argsort(values, kind='stable')]
+                positions = np.linspace(0, len(ids) - 1, min(self.size, len(ids)))
+                return sorted(int(ids[p]) for p in np.unique(np.rint(positions).astype(int)))
+            reason = f'column {self.column} is not numeric'
+        log(f"Set {emSet.getObjName()} {reason}, items chosen at random "
+            f"instead of with policy '{self}'")
+        return None
+
+
+def _acceptsArgs(emSet, *names):
+    """ Whether the iterItems of the set accepts the given keyword arguments
+    (pyworkflow's Set does, SetOfClasses does not). """
+    try:
+        parameters = inspect.signature(emSet.iterItems).parameters
+    except (TypeError, ValueError):
+        return False
+    return all(name in parameters for name in names)
+
+
+# Policies used for the classes not given by the user,
+# items of other sets are all represented
+DEFAULT_POLICIES = {
+    'SetOfMicrographsBase': SamplingPolicy(FIRST, 3),  # micrographs and movies
+    'SetOfCTF': SamplingPolicy(FIRST, 3),
+    'SetOfCoordinates': SamplingPolicy(FIRST, 3),  # micrographs to draw coordinates on
+    'SetOfParticles': SamplingPolicy(FIRST, 15),
+}
+
+
+def parsePolicies(text):
+    """ Parse 'SetOfClasses3D: first 10; SetOfParticles: random 15' into a
+    dict {class name: SamplingPolicy}. """
+    policies = {}
+    for entry in (text or '').split(';'):
+        if entry.strip():
+            className, sep, policy = entry.partition(':')
+            if not sep:
+                raise ValueError(f"Expected 'Class: policy', got '{entry.strip()}'")
+            policies[className.strip()] = SamplingPolicy.parse(policy)
+    return policies
+
+
+def getPolicy(emSet, policies=None):
+    """ Return the policy for the set, looking also at its base classes.
+    A policy given by the user for any of them wins over the defaults. """
+    classNames = [cls.__name__ for cls in type(emSet).__mro__]
+    for candidates in (policies or {}, DEFAULT_POLICIES):
+        for className in classNames:
+            if className in candidates:
+                return candidates[className]
+    return SamplingPolicy()
@@ -0,0 +1,227 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+""" Header only scan of the files of an image set, to check that they
+are homogeneous (EMPIAR rejects image sets whose files differ in format,
+dimensions, number of frames or voxel type) before depositing them. """
+
+import os
+import json
+import struct
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+SCAN_WORKERS = min(8, os.cpu_count() or 1)
+SCAN_CHUNK = 64  # files sent to a worker at once
+
+MRC_HEADER_SIZE = 1024
+# MRC mode: (voxel type, bytes per voxel)
+MRC_MODES = {0: ('int8', 1), 1: ('int16', 2), 2: ('float32', 4), 3: ('complex16', 4),
+             4: ('complex32', 8), 6: ('uint16', 2), 12: ('float16', 2), 101: ('uint4', 0.5)}
+
+TIFF_EXTENSIONS = ('.tif', '.tiff', '.eer')
+TIFF_WIDTH, TIFF_LENGTH, TIFF_BITS, TIFF_COMPRESSION, TIFF_SAMPLE_FORMAT = 256, 257, 258, 259, 339
+TIFF_SAMPLE_KINDS = {1: 'uint', 2: 'int', 3: 'float'}
+EER_COMPRESSIONS = (65000, 65001, 65002)
+
+# keys compared between the files of a set
+HEADER_KEYS = ('format', 'dims', 'frames', 'voxelType')
+
+
+def readMrcHeader(path, size):
+    with open(path, 'rb') as f:
+        header = f.read(MRC_HEADER_SIZE)
+    if len(header) < MRC_HEADER_SIZE:
+        raise ValueError("file shorter than the MRC header")
+    byteOrder = '>' if header[212] == 0x11 else '<'
+    nx, ny, nz, mode = struct.unpack(byteOrder + '4i', header[:16])
+    extended = struct.unpack(byteOrder + 'i', header[92:96])[0]
+    if mode not in MRC_MODES:
+        raise ValueError(f"unknown MRC mode {mode}")
+    voxelType, voxelBytes = MRC_MODES[mode]
+    expected = MRC_HEADER_SIZE + extended + int(nx * ny * nz * voxelBytes)
+    if size < expected:
+        raise ValueError(f"truncated file ({size} bytes, {expected} expected)")
+    return [nx, ny], nz, voxelType
+
+
+def readTiffHeader(path):
+    """ Read the first directory (image) of a TIFF (or EER) file and count
+    the directories, without reading the image data. """
+    with open(path, 'rb') as f:
+        order = {b'II': '<', b'MM': '>'}.get(f.read(2))
+        if order is None:
+            raise ValueError("not a TIFF file")
+        version = struct.unpack(order + 'H', f.read(2))[0]
+        if version == 42:  # classic TIFF
+            countFmt, entryFmt, offsetFmt = 'H', 'HHI4s', 'I'
+            offset = struct.unpack(order + 'I', f.read(4))[0]
+        elif version == 43:  # BigTIFF
+            countFmt, entryFmt, offsetFmt = 'Q', 'HHQ8s', 'Q'
+            f.read(4)
+            offset = struct.unpack(order + 'Q', f.read(8))[0]
+        else:
+            raise ValueError(f"unknown TIFF version {version}")
+        countSize = struct.calcsize(order + countFmt)
+        entrySize = struct.calcsize(order + entryFmt)
+        offsetSize = struct.calcsize(order + offsetFmt)
+
+        tags = {}
+        frames = 0
+        while offset:
+            f.seek(offset)
+            count = struct.unpack(order + countFmt, f.read(countSize))[0]
+            if not frames:
+                for _ in range(count):
+                    tag, fieldType, n, value = struct.unpack(order + entryFmt, f.read(entrySize))
+                    # short (3) or long (4) values stored in the entry itself
+                    fmt = 'H' if fieldType == 3 else 'I'
+                    tags[tag] = struct.unpack_from(order + fmt, value)[0]
+            else:
+                f.seek(count * entrySize, os.SEEK_CUR)
+            frames += 1
+            offset = struct.unpack(order + offsetFmt, f.read(offsetSize))[0]
+
+    bits = tags.get(TIFF_BITS, 1)
+    if tags.get(TIFF_COMPRESSION) in EER_COMPRESSIONS:
+        voxelType = 'eer'
+    elif bits == 1:
+        voxelType = 'bit'
+    else:
+        voxelType = f"{TIFF_SAMPLE_KINDS.get(tags.get(TIFF_SAMPLE_FORMAT, 1), 'uint')}{bits}"
+    return [tags.get(TIFF_WIDTH), tags.get(TIFF_LENGTH)], frames, voxelType
+
+
+def readHeader(path):
+    """ Return a dict with the format, dims ([x, y]), frames (or sections),
+    voxel type and bytes of an image file. For the formats whose header is
+    not read, only the format and the bytes are filled. Errors are stored
+    in the 'error' key. """
+    path = path.split(':')[0]  # remove Scipion format suffixes (e.g. :mrcs)
+    ext = os.path.splitext(path)[1].lower()
+    header = {'path': path, 'format': ext.strip('.'), 'dims': None,
+              'frames': None, 'voxelType': None, 'bytes': None}
+    try:
+        header['bytes'] = size = os.path.getsize(path)
+        if ext in ('.mrc', '.mrcs', '.st', '.map'):
+            header['dims'], header['frames'], header['voxelType'] = readMrcHeader(path, size)
+        elif ext in TIFF_EXTENSIONS:
+            header['dims'], header['frames'], header['voxelType'] = readTiffHeader(path)
+    except Exception as e:
+        header['error'] = str(e)
+    return header
+
+
+class HeaderCache:
+    """ Headers already read, kept in a json file and valid while the
+    file size and modification time do not change. """
+    def __init__(self, cacheFile):
+        self._cacheFile = cacheFile
+        self._headers = {}
+        if cacheFile and os.path.exists(cacheFile):
+            try:
+                with open(cacheFile) as f:
+                    self._headers = json.load(f)
+            except ValueError:
+                pass
+
+    @staticmethod
+    def getKey(path):
+        st = os.stat(path)
+        return [st.st_size, st.st_mtime_ns]
+
+    def get(self, path):
+        cached = self._headers.get(path)
+        try:
+            if cached is not None and cached[0] == self.getKey(path):
+                return cached[1]
+        except OSError:
+            pass
+        return None
+
+    def set(self, path, header):
+        if 'error' not in header:
+            self._headers[path] = [self.getKey(path), header]
+
+    def save(self):
+        if self._cacheFile:
+            with open(self._cacheFile, 'w') as f:
+                json.dump(self._headers, f)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.save()
+
+
+def scanFiles(paths, cache=None, workers=SCAN_WORKERS):
+    """ Read the headers of the given files (in a process pool) and
+    return them in the same order. """
+    paths = [os.path.abspath(path.split(':')[0]) for path in paths]
+    headers = {}
+    missing = []
+    for path in paths:
+        header = cache.get(path) if cache is not None else None
+        if header is None:
+            missing.append(path)
+        else:
+            headers[path] = header
+
+    if len(missing) > SCAN_CHUNK and workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            newHeaders = list(executor.map(readHeader, missing, chunksize=SCAN_CHUNK))
+    else:
+        newHeaders = [readHeader(path) for path in missing]
+
+    for path, header in zip(missing, newHeaders):
+        headers[path] = header
+        if cache is not None:
+            cache.set(path, header)
+    return [headers[path] for path in paths]
+
+
+def findOutliers(headers, keys=HEADER_KEYS):
+    """ Compare the headers of the files of a set with the most common
+    values and return a report with the total bytes, the reference values
+    and the files that differ (or could not be read). """
+    reference = {}
+    for key in keys:
+        values = Counter(json.dumps(h[key]) for h in headers if 'error' not in h)
+        reference[key] = json.loads(values.most_common(1)[0][0]) if values else None
+
+    outliers = []
+    for h in headers:
+        if 'error' in h:
+            outliers.append({'path': h['path'], 'error': h['error']})
+            continue
+        differences = {key: h[key] for key in keys if h[key] != reference[key]}
+        if differences:
+            outliers.append({'path': h['path'], 'differences': differences})
+
+    return {'files': len(headers),
+            'bytes': sum(h['bytes'] or 0 for h in headers),
+            'reference': reference,
+            'outliers': outliers}
@@ -0,0 +1,92 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+""" Rendering of the deposition json template and validation against
+the EMPIAR deposition schema. Templates and compiled validators are
+cached by (path, mtime), so many depositions can be checked cheaply. """
+
+import os
+import re
+import json
+
+import jsonschema
+
+_validators = {}
+_templates = {}
+
+
+def getValidator(schemaPath):
+    """ Return the validator of a json schema, compiled only once
+    while the schema file does not change. """
+    key = (schemaPath, os.path.getmtime(schemaPath))
+    if key not in _validators:
+        with open(schemaPath) as f:
+            schema = json.load(f)
+        validatorClass = jsonschema.validators.validator_for(schema)
+        validatorClass.check_schema(schema)
+        _validators[key] = validatorClass(schema)
+    return _validators[key]
+
+
+def getValidationErrors(depoDict, schemaPath):
+    """ Return all the problems of a deposition dict (empty if valid),
+    as 'path: message' strings. """
+    errors = sorted(getValidator(schemaPath).iter_errors(depoDict),
+                    key=lambda e: list(map(str, e.absolute_path)))
+    return ['%s: %s' % ('/'.join(map(str, e.absolute_path)) or '<root>', e.message)
+            for e in errors]
+
+
+def validateDepositions(depoDicts, schemaPath):
+    """ Validate several deposition dicts with the same compiled schema.
+    Return a list with the errors of each of them. """
+    return [getValidationErrors(depoDict, schemaPath) for depoDict in depoDicts]
+
+
+class DepositionTemplate:
+    """ A deposition json template with %(key)s placeholders. """
+    KEY_REGEX = re.compile(r'%\((\w+)\)')
+
+    def __init__(self, text):
+        self.text = text
+        self.keys = sorted(set(self.KEY_REGEX.findall(text)))
+
+    @classmethod
+    def load(cls, templatePath):
+        """ Return the template of a file, read only once while it
+        does not change. """
+        key = (templatePath, os.path.getmtime(templatePath))
+        if key not in _templates:
+            with open(templatePath, 'rb') as f:
+                _templates[key] = cls(f.read().decode('utf-8'))
+        return _templates[key]
+
+    def render(self, values):
+        """ Fill the template with the values (only its keys are looked up)
+        and return the resulting deposition dict. """
+        return json.loads(self.text % {key: values[key] for key in self.keys})
+
+    def renderMany(self, valuesList):
+        return [self.render(values) for values in valuesList]
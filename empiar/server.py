@@ -0,0 +1,252 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+""" Local web server for the workflow viewer. It serves the viewer folder
+with several threads, compresses text files, answers conditional and
+range requests, and records its pid in a file so it can be stopped.
+
+It only uses the standard library, so it can run detached as a script:
+    python server.py --dir <viewer folder> --port 9000 --pidfile <file>
+"""
+
+import os
+import sys
+import gzip
+import time
+import signal
+import argparse
+import subprocess
+import threading
+from io import BytesIO
+from functools import partial
+from http import HTTPStatus
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+GZIP_EXTENSIONS = ('.json', '.html', '.js', '.css', '.log', '.txt')
+
+
+class LimitedReader:
+    """ File wrapper that reads at most length bytes. """
+    def __init__(self, f, length):
+        self._f = f
+        self._left = length
+
+    def read(self, size=-1):
+        if self._left <= 0:
+            return b''
+        size = self._left if size < 0 else min(size, self._left)
+        data = self._f.read(size)
+        self._left -= len(data)
+        return data
+
+    def close(self):
+        self._f.close()
+
+
+def parseRange(rangeHeader, fileSize):
+    """ Return (start, end) of a single 'bytes=' range, None if the header
+    can not be used (the whole file is sent) or raise ValueError if the
+    range is not satisfiable. """
+    if not rangeHeader or not rangeHeader.startswith('bytes=') or ',' in rangeHeader:
+        return None
+    start, sep, end = rangeHeader[6:].strip().partition('-')
+    try:
+        if not start:  # last bytes: bytes=-N
+            start, end = max(fileSize - int(end), 0), fileSize - 1
+        else:
+            start = int(start)
+            end = min(int(end), fileSize - 1) if end else fileSize - 1
+    except ValueError:
+        return None
+    if start >= fileSize or start > end:
+        raise ValueError(rangeHeader)
+    return start, end
+
+
+class ViewerRequestHandler(SimpleHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep alive, the viewer loads many images
+    _gzipCache = {}  # {path: (etag, compressed data)}
+    _gzipLock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass  # do not fill the log with one line per image
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        if os.path.isdir(path):
+            return super().send_head()  # directory listings used by the viewer
+        try:
+            f = open(path, 'rb')
+        except OSError:
+            self.send_error(HTTPStatus.NOT_FOUND, "File not found")
+            return None
+
+        try:
+            st = os.fstat(f.fileno())
+            etag = '"%x-%x"' % (st.st_size, st.st_mtime_ns)
+            if self.headers.get('If-None-Match') == etag:
+                f.close()
+                self.send_response(HTTPStatus.NOT_MODIFIED)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return None
+
+            ctype = self.guess_type(path)
+            try:
+                byteRange = parseRange(self.headers.get('Range'), st.st_size)
+            except ValueError:
+                f.close()
+                self.send_response(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+                self.send_header('Content-Range', 'bytes */%d' % st.st_size)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return None
+
+            if byteRange is not None:
+                start, end = byteRange
+                f.seek(start)
+                self.send_response(HTTPStatus.PARTIAL_CONTENT)
+                self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, st.st_size))
+                body, length = LimitedReader(f, end - start + 1), end - start + 1
+            elif (path.endswith(GZIP_EXTENSIONS) and
+                  'gzip' in self.headers.get('Accept-Encoding', '')):
+                data = self._getGzipped(path, etag, f)
+                f.close()
+                self.send_response(HTTPStatus.OK)
+                self.send_header('Content-Encoding', 'gzip')
+                body, length = BytesIO(data), len(data)
+            else:
+                self.send_response(HTTPStatus.OK)
+                body, length = f, st.st_size
+
+            self.send_header('Content-Type', ctype)
+            self.send_header('Content-Length', str(length))
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('Vary', 'Accept-Encoding')
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', self.date_time_string(st.st_mtime))
+            # thumbnails and jsons change on each deposition: always revalidate
+            # (answered with 304 while the ETag does not change)
+            self.send_header('Cache-Control', 'no-cache')
+            self.end_headers()
+            return body
+        except Exception:
+            f.close()
+            raise
+
+    def _getGzipped(self, path, etag, f):
+        """ Compress a file only once while it does not change. """
+        with self._gzipLock:
+            cached = self._gzipCache.get(path)
+            if cached is None or cached[0] != etag:
+                cached = (etag, gzip.compress(f.read(), compresslevel=6))
+                self._gzipCache[path] = cached
+            return cached[1]
+
+
+def serve(directory, port, pidFile=None):
+    """ Serve the directory until SIGTERM/SIGINT is received. """
+    handler = partial(ViewerRequestHandler, directory=directory)
+    server = ThreadingHTTPServer(('', port), handler)
+    server.daemon_threads = True
+
+    def stop(*args):
+        # shutdown waits for serve_forever, so it can not run in this thread
+        threading.Thread(target=server.shutdown).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    if pidFile:  # written atomically, never seen empty or truncated
+        tmpFile = pidFile + '.tmp'
+        with open(tmpFile, 'w') as f:
+            f.write(str(os.getpid()))
+        os.replace(tmpFile, pidFile)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if pidFile and os.path.exists(pidFile):
+            os.remove(pidFile)
+
+
+def getCommandLine(pid):
+    """ Return the command line of a process or None if it is not running. """
+    try:
+        with open(f'/proc/{pid}/cmdline', 'rb') as f:
+            return f.read().replace(b'\0', b' ').decode(errors='replace')
+    except FileNotFoundError:
+        if os.path.isdir('/proc'):
+            return None
+    except OSError:
+        return None
+    # no /proc (e.g. macOS)
+    result = subprocess.run(['ps', '-o', 'command=', '-p', str(pid)],
+                            stdout=subprocess.PIPE, universal_newlines=True)
+    return result.stdout.strip() or None
+
+
+def isViewerServer(pid, pidFile):
+    """ Check that the process is the server started with this pid file,
+    not an unrelated process that reused a stale pid. """
+    cmdline = getCommandLine(pid)
+    return (cmdline is not None and os.path.basename(__file__) in cmdline
+            and os.path.basename(pidFile) in cmdline)
+
+
+def stopServer(pidFile, timeout=10):
+    """ Stop the server whose pid is in pidFile, if it is running. """
+    if not os.path.exists(pidFile):
+        return False
+    with open(pidFile) as f:
+        content = f.read().strip()
+    pid = int(content) if content.isdigit() else 0
+    # pid 0 or negative would signal a whole process group
+    if pid <= 0 or not isViewerServer(pid, pidFile):
+        os.remove(pidFile)  # stale or broken pid file
+        return False
+    try:
+        os.kill(pid, signal.SIGTERM)
+    except (ProcessLookupError, PermissionError):
+        os.remove(pidFile)
+        return False
+
+    waitUntil = time.time() + timeout
+    while os.path.exists(pidFile) and time.time() < waitUntil:
+        time.sleep(0.1)
+    return True
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Serve the EMPIAR workflow viewer")
+    parser.add_argument('--dir', required=True, help="Folder to serve")
+    parser.add_argument('--port', type=int, default=9000)
+    parser.add_argument('--pidfile', help="File to write the server pid to")
+    args = parser.parse_args(args)
+    serve(args.dir, args.port, args.pidfile)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,164 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+""" Statistics gathered from the protocols outputs to be plotted in the
+workflow viewer. """
+
+import os
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import emtable
+
+
+class ColumnAccumulator:
+    """ Collect values of several columns while streaming the items of a
+    set once, and give them back as NumPy arrays. """
+    def __init__(self, *names):
+        self._columns = {name: [] for name in names}
+
+    def append(self, **values):
+        for name, value in values.items():
+            self._columns[name].append(value)
+
+    def __len__(self):
+        return max((len(c) for c in self._columns.values()), default=0)
+
+    def getArray(self, name, dtype=np.float64):
+        return np.asarray(self._columns[name], dtype=dtype)
+
+
+def parseShifts(shiftsStr):
+    """ Parse a comma separated string of shifts (e.g. _xmipp_ShiftX). """
+    return np.array(shiftsStr.split(','), dtype=np.float64)
+
+
+def totalDrift(shiftsX, shiftsY):
+    """ Compute the total drift of a movie from its per-frame
+    global shifts, using the shifts relative to the previous frame. """
+    shiftsX = np.asarray(shiftsX, dtype=np.float64)
+    shiftsY = np.asarray(shiftsY, dtype=np.float64)
+    n = min(len(shiftsX), len(shiftsY))
+    relative = np.hypot(np.diff(shiftsX[:n]), np.diff(shiftsY[:n]))
+    return float(np.sqrt(np.sum(relative ** 2)))
+
+
+def parseShiftsColumn(shiftsStrs):
+    """ Parse a whole column of comma separated shifts strings at once.
+    Return the concatenated shifts and the number of shifts of each item. """
+    shiftsStrs = np.asarray(shiftsStrs, dtype=str)
+    if shiftsStrs.size == 0:
+        return np.empty(0), np.empty(0, dtype=np.int64)
+    counts = np.char.count(shiftsStrs, ',') + 1
+    return np.array(','.join(shiftsStrs).split(','), dtype=np.float64), counts
+
+
+def totalDrifts(shiftsXStrs, shiftsYStrs):
+    """ Vectorised version of totalDrift for a column of movies, given
+    their comma separated shifts strings. """
+    shiftsX, countsX = parseShiftsColumn(shiftsXStrs)
+    shiftsY, countsY = parseShiftsColumn(shiftsYStrs)
+    if not np.array_equal(countsX, countsY):
+        return np.array([totalDrift(parseShifts(x), parseShifts(y))
+                         for x, y in zip(shiftsXStrs, shiftsYStrs)])
+
+    # movie index of each shift; only differences inside a movie count
+    movies = np.repeat(np.arange(len(countsX)), countsX)
+    sameMovie = movies[1:] == movies[:-1]
+    relative = np.hypot(np.diff(shiftsX), np.diff(shiftsY))[sameMovie]
+    sums = np.bincount(movies[1:][sameMovie], weights=relative ** 2,
+                       minlength=len(countsX))
+    return np.sqrt(sums)
+
+
+def defocusStats(defocusU, defocusV):
+    """ Return the mean defocus and the astigmatism arrays. """
+    defocusU = np.asarray(defocusU, dtype=np.float64)
+    defocusV = np.asarray(defocusV, dtype=np.float64)
+    return (defocusU + defocusV) / 2, np.abs(defocusU - defocusV) / 2
+
+
+class StarShiftsReader:
+    """ Read the global shifts of RELION motion correction star files,
+    one star file per micrograph in the given folder. The folder is listed
+    once, the files are parsed in a thread pool and the parsed shifts are
+    cached by (file, mtime) so next calls only read the modified files. """
+    STAR_EXT = '.star'
+
+    def __init__(self, folder, cacheFile=None, threads=8):
+        self._folder = folder
+        self._cacheFile = cacheFile
+        self._threads = threads
+        self._cache = self._loadCache()
+
+    def _loadCache(self):
+        if self._cacheFile and os.path.exists(self._cacheFile):
+            try:
+                with open(self._cacheFile) as f:
+                    return json.load(f)
+            except ValueError:
+                pass  # corrupted cache, it will be regenerated
+        return {}
+
+    def _saveCache(self):
+        if self._cacheFile:
+            os.makedirs(os.path.dirname(self._cacheFile), exist_ok=True)
+            with open(self._cacheFile, 'w') as f:
+                json.dump(self._cache, f)
+
+    def _listStarFiles(self):
+        """ Return {file name: mtime} for the star files of the folder. """
+        if not os.path.isdir(self._folder):
+            return {}
+        with os.scandir(self._folder) as entries:
+            return {e.name: e.stat().st_mtime for e in entries
+                    if e.name.endswith(self.STAR_EXT)}
+
+    def _parse(self, fileName):
+        table = emtable.Table(fileName=os.path.join(self._folder, fileName),
+                              tableName='global_shift')
+        return (table.getColumnValues('rlnMicrographShiftX'),
+                table.getColumnValues('rlnMicrographShiftY'))
+
+    def readShifts(self, micNames):
+        """ Return a list of (shiftsX, shiftsY) arrays for the micrographs
+        that have a star file in the folder. """
+        starFiles = self._listStarFiles()
+        fileNames = [os.path.splitext(os.path.basename(m))[0] + self.STAR_EXT
+                     for m in micNames]
+        fileNames = [fn for fn in fileNames if fn in starFiles]
+
+        toParse = [fn for fn in set(fileNames)
+                   if self._cache.get(fn, [None])[0] != starFiles[fn]]
+        if toParse:
+            with ThreadPoolExecutor(max_workers=self._threads) as executor:
+                for fn, (shiftsX, shiftsY) in zip(toParse, executor.map(self._parse, toParse)):
+                    self._cache[fn] = [starFiles[fn], shiftsX, shiftsY]
+            self._saveCache()
+
+        return [(np.asarray(self._cache[fn][1], dtype=np.float64),
+                 np.asarray(self._cache[fn][2], dtype=np.float64))
+                for fn in fileNames]
@@ -0,0 +1,160 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+""" Download store shared by several projects (and users) of a facility.
+
+Each remote file is stored once, keyed by (entry, remote path, size,
+modification time), and put into the projects with a reflink or a hard
+link (a copy only when none is possible). When several protocols need the
+same file at the same time, a file lock makes only one of them download it.
+A quota can be set: the least recently used files are removed from the
+store when it is exceeded (files hard linked from projects are removed
+last, as removing them does not free any space).
+"""
+
+import os
+import time
+import hashlib
+import sqlite3
+from contextlib import contextmanager, closing
+
+from empiar.cache import fileLock
+from empiar.packaging import linkOrCopy
+
+STORE_DB = 'store.sqlite'
+OBJECTS_DIR = 'objects'
+LOCKS_DIR = 'locks'
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS objects (
+    key TEXT PRIMARY KEY, entry TEXT, remote TEXT, size INTEGER,
+    mtime TEXT, last_access REAL);
+"""
+# files and folders writable by the group, so the store can be shared
+FILE_MODE = 0o664
+DIR_MODE = 0o2775
+
+
+def getKey(entryId, remotePath, size, mtime):
+    text = '\0'.join(str(v) for v in (entryId, remotePath, size, mtime))
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+class DownloadStore:
+    """ Content addressed store of downloaded files.
+    :param folder: store folder, shared between projects
+    :param quotaBytes: maximum size of the store (None or 0 for no limit)
+    """
+    def __init__(self, folder, quotaBytes=None):
+        self.folder = folder
+        self.quotaBytes = quotaBytes
+        for path in [folder, os.path.join(folder, OBJECTS_DIR), os.path.join(folder, LOCKS_DIR)]:
+            self._makeDir(path)
+        with self._connect() as db:
+            db.executescript(SCHEMA)
+
+    @staticmethod
+    def _makeDir(path):
+        if not os.path.exists(path):
+            os.makedirs(path, exist_ok=True)
+            try:
+                os.chmod(path, DIR_MODE)
+            except OSError:
+                pass
+
+    @contextmanager
+    def _connect(self):
+        with closing(sqlite3.connect(os.path.join(self.folder, STORE_DB), timeout=60)) as db:
+            with db:
+                yield db
+
+    def getObjectPath(self, key):
+        return os.path.join(self.folder, OBJECTS_DIR, key[:2], key)
+
+    def fetch(self, entryId, remotePath, size, mtime, download, dest):
+        """ Put the remote file at dest, downloading it into the store first
+        if it is not there yet.
+        :param download: function(local file) that downloads the remote file
+        :return: the method used to put it at dest (see linkOrCopy)
+        """
+        key = getKey(entryId, remotePath, size, mtime)
+        objectFn = self.getObjectPath(key)
+        # the lock is held until the file is linked, makeRoom (maybe in other
+        # process) does not remove objects whose lock is taken
+        with fileLock(self._getLockFn(key)):
+            # another process may have downloaded it while waiting
+            if not os.path.exists(objectFn):
+                self.makeRoom(size)
+                self._makeDir(os.path.dirname(objectFn))
+                tmpFn = f'{objectFn}.part{os.getpid()}'
+                try:
+                    download(tmpFn)
+                    os.chmod(tmpFn, FILE_MODE)
+                    os.replace(tmpFn, objectFn)
+                finally:
+                    if os.path.exists(tmpFn):
+                        os.remove(tmpFn)
+
+            with self._connect() as db:
+                db.execute("INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?, ?)",
+                           (key, str(entryId), remotePath, size, str(mtime), time.time()))
+            return linkOrCopy(objectFn, dest)
+
+    def _getLockFn(self, key):
+        return os.path.join(self.folder, LOCKS_DIR, key + '.lock')
+
+    def getUsage(self):
+        with self._connect() as db:
+            return db.execute("SELECT count(*), coalesce(sum(size), 0) FROM objects").fetchone()
+
+    def makeRoom(self, size):
+        """ Remove the least recently used files until size more bytes fit
+        in the quota. """
+        if not self.quotaBytes:
+            return
+        with self._connect() as db:
+            db.execute("BEGIN IMMEDIATE")  # one process evicting at a time
+            objects = db.execute("SELECT key, size FROM objects ORDER BY last_access").fetchall()
+            used = sum(objSize for _, objSize in objects)
+
+            def linkCount(key):
+                try:
+                    return os.stat(self.getObjectPath(key)).st_nlink
+                except OSError:
+                    return 1
+
+            # files only in the store first, then the ones hard linked from projects
+            objects.sort(key=lambda obj: linkCount(obj[0]) > 1)
+            for key, objSize in objects:
+                if used + size <= self.quotaBytes:
+                    break
+                try:
+                    with fileLock(self._getLockFn(key), blocking=False):
+                        objectFn = self.getObjectPath(key)
+                        if os.path.exists(objectFn):
+                            os.remove(objectFn)
+                except BlockingIOError:
+                    continue  # being linked into a project right now
+                db.execute("DELETE FROM objects WHERE key = ?", (key,))
+                used -= objSize
@@ -0,0 +1,105 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+""" Fake Scipion sets stored in sqlite files with the same layout as
+pyworkflow's SqliteFlatDb: a Classes table mapping the attribute labels
+to the columns of an Objects table. """
+
+import sqlite3
+from contextlib import closing
+
+
+def createSetDb(dbPath, labels, rows, prefix=''):
+    """ Write a set with the given attribute labels and rows (tuples with
+    the id followed by the values of the labels). The prefix is used as
+    SqliteFlatDb does, e.g. 'Class001' for the tables Class001_Objects. """
+    if prefix and not prefix.endswith('_'):
+        prefix += '_'
+    columns = ['c%02d' % (i + 1) for i in range(len(labels))]
+    with closing(sqlite3.connect(dbPath)) as conn:
+        conn.execute(f'CREATE TABLE {prefix}Classes (id INTEGER PRIMARY KEY, '
+                     f'label_property TEXT, column_name TEXT, class_name TEXT)')
+        conn.execute(f"INSERT INTO {prefix}Classes VALUES (1, 'self', 'self', 'Particle')")
+        conn.executemany(f'INSERT INTO {prefix}Classes VALUES (?, ?, ?, ?)',
+                         [(i + 2, label, column, 'Float')
+                          for i, (label, column) in enumerate(zip(labels, columns))])
+        conn.execute(f"CREATE TABLE {prefix}Objects (id INTEGER PRIMARY KEY, enabled INTEGER, "
+                     f"label TEXT, comment TEXT, creation DATE, {', '.join(columns)})")
+        conn.executemany(f"INSERT INTO {prefix}Objects VALUES (?, 1, '', '', '', "
+                         f"{', '.join('?' * len(labels))})", rows)
+        conn.commit()
+
+
+class FakeItem:
+    def __init__(self, objId, values):
+        self._objId = objId
+        self.values = values
+
+    def getObjId(self):
+        return self._objId
+
+
+class FakeSet:
+    """ Set with the accessors used to read it by columns and the
+    iterItems of pyworkflow's Set (with where and limit). """
+    def __init__(self, dbPath, labels, rows, prefix=None):
+        self._dbPath = dbPath
+        self._prefix = prefix
+        self.items = {row[0]: FakeItem(row[0], row[1:]) for row in rows}
+        self.queries = []
+
+    def getFileName(self):
+        return self._dbPath
+
+    def getPrefix(self):
+        return self._prefix
+
+    def getObjName(self):
+        return 'outputSet'
+
+    def __getitem__(self, objId):
+        return self.items[objId]
+
+    def iterItems(self, orderBy='id', direction='ASC', where=None, limit=None):
+        self.queries.append((where, limit))
+        ids = sorted(self.items)
+        if where:  # only 'id IN (...)' is used
+            selected = {int(i) for i in where[where.index('(') + 1:-1].split(',')}
+            ids = [i for i in ids if i in selected]
+        for objId in ids[:limit]:
+            yield self.items[objId]
+
+
+class FakeSetOfClasses(FakeSet):
+    """ Like pwem's SetOfClasses, iterItems does not accept where nor limit
+    and the items get their own mapper path when accessed by id. """
+    def __getitem__(self, objId):
+        self.queries.append(('getitem', objId))
+        return self.items[objId]
+
+    def iterItems(self, orderBy='id', direction='ASC', rowFilter=None):
+        self.queries.append(('iterItems', None))
+        for objId in sorted(self.items):
+            yield self.items[objId]
@@ -0,0 +1,106 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+""" Small synthetic image files (MRC and TIFF) for the tests. """
+
+import struct
+
+import numpy as np
+
+MRC_MODES = {np.dtype(np.int8): 0, np.dtype(np.int16): 1, np.dtype(np.float32): 2,
+             np.dtype(np.uint16): 6, np.dtype(np.float16): 12}
+
+
+def writeMrc(fileName, data, mz=None, spaceGroup=0, extendedHeader=b'',
+             bigEndian=False, voxelSize=1.0):
+    """ Write a 3D array (sections, rows, columns) as an MRC file. """
+    data = np.asarray(data)
+    byteOrder = '>' if bigEndian else '<'
+    nz, ny, nx = data.shape
+    ints = np.zeros(56, dtype=byteOrder + 'i4')
+    ints[:4] = nx, ny, nz, MRC_MODES[data.dtype]
+    ints[7:10] = nx, ny, mz or nz
+    ints[22] = spaceGroup
+    ints[23] = len(extendedHeader)
+    floats = ints.view(byteOrder + 'f4')
+    floats[10:13] = nx * voxelSize, ny * voxelSize, (mz or nz) * voxelSize
+    ints[16:19] = 1, 2, 3
+    header = bytearray(ints.tobytes()) + bytearray(1024 - ints.nbytes)
+    header[208:212] = b'MAP '
+    header[212:214] = b'\x11\x11' if bigEndian else b'\x44\x44'
+    with open(fileName, 'wb') as f:
+        f.write(bytes(header) + extendedHeader)
+        f.write(data.astype(data.dtype.newbyteorder(byteOrder)).tobytes())
+
+
+TIFF_SAMPLE_FORMATS = {'u': 1, 'i': 2, 'f': 3}
+
+
+def writeTiff(fileName, data, compression=1, bigTiff=False, bigEndian=False):
+    """ Write a 3D array as a multi page TIFF (one uncompressed strip per
+    page, whatever the compression tag says). """
+    data = np.asarray(data)
+    order = '>' if bigEndian else '<'
+    frames, height, width = data.shape
+    pages = [data[i].astype(data.dtype.newbyteorder(order)).tobytes() for i in range(frames)]
+    if bigTiff:
+        header = struct.pack(order + '2sHHHQ', b'MM' if bigEndian else b'II', 43, 8, 0, 0)
+        countFmt, entryFmt, offsetFmt, valueSize = 'Q', 'HHQ', 'Q', 8
+    else:
+        header = struct.pack(order + '2sHI', b'MM' if bigEndian else b'II', 42, 0)
+        countFmt, entryFmt, offsetFmt, valueSize = 'H', 'HHI', 'I', 4
+
+    offset = len(header)
+    dataOffsets = []
+    for page in pages:
+        dataOffsets.append(offset)
+        offset += len(page)
+    ifds = []
+    for i, page in enumerate(pages):
+        # (tag, type: 3 short or 4 long, value)
+        tags = [(256, 4, width), (257, 4, height), (258, 3, data.dtype.itemsize * 8),
+                (259, 3, compression), (273, 4, dataOffsets[i]), (277, 3, 1),
+                (278, 4, height), (279, 4, len(page)),
+                (339, 3, TIFF_SAMPLE_FORMATS[data.dtype.kind])]
+        ifdSize = (struct.calcsize(order + countFmt) + len(tags) * (struct.calcsize(order + entryFmt)
+                                                                  + valueSize)
+                   + struct.calcsize(order + offsetFmt))
+        nextOffset = offset + ifdSize if i < frames - 1 else 0
+        ifd = struct.pack(order + countFmt, len(tags))
+        for tag, fieldType, value in tags:
+            valueBytes = struct.pack(order + ('H' if fieldType == 3 else 'I'), value)
+            ifd += struct.pack(order + entryFmt, tag, fieldType, 1) + valueBytes.ljust(valueSize, b'\0')
+        ifd += struct.pack(order + offsetFmt, nextOffset)
+        ifds.append((offset, ifd))
+        offset += ifdSize
+
+    firstIfd = struct.pack(order + offsetFmt, ifds[0][0])
+    header = header[:-len(firstIfd)] + firstIfd
+    with open(fileName, 'wb') as f:
+        f.write(header)
+        for page in pages:
+            f.write(page)
+        for _, ifd in ifds:
+            f.write(ifd)
@@ -0,0 +1,154 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+""" Catalog built from entries recorded from the EMPIAR API: incremental
+updates, query parsing and the search filters. """
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+from empiar.catalog import EmpiarCatalog, parseQuery, ftsQuery
+
+ENTRIES_FN = os.path.join(os.path.dirname(__file__), 'data', 'empiar_entries.json')
+
+
+class RecordedApi:
+    """ Fetch function answering with the recorded entries (None for the
+    ones that do not exist) and remembering the ids requested. """
+    def __init__(self):
+        with open(ENTRIES_FN) as f:
+            self.entries = json.load(f)
+        self.requested = []
+
+    def __call__(self, entryId):
+        self.requested.append(entryId)
+        if entryId not in self.entries:
+            raise IOError(f"EMPIAR-{entryId} is not recorded")
+        return self.entries[entryId]
+
+
+class TestEmpiarCatalog(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.catalog = EmpiarCatalog(os.path.join(self.folder, 'catalog.sqlite'))
+        self.api = RecordedApi()
+        self.catalog.update(self.api.entries, fetch=self.api, threads=2, log=lambda msg: None)
+
+    def tearDown(self):
+        self.catalog.close()
+        shutil.rmtree(self.folder)
+
+    def searchIds(self, query):
+        return sorted({(r['entry_id'], r['name']) for r in self.catalog.search(**parseQuery(query))})
+
+    def testUpdate(self):
+        self.assertEqual(self.catalog.getEntryIds(), {'10028', '10061'})
+        self.assertEqual(self.catalog.getMissingIds(), {'10029'})
+
+        # known and missing entries are not requested again
+        api = RecordedApi()
+        errors = []
+        fetched = self.catalog.update(range(10028, 10062), fetch=api, log=errors.append)
+        self.assertEqual(fetched, 0)
+        self.assertEqual(len(api.requested), 31)
+        self.assertEqual(len(errors), 31)
+        self.assertNotIn('10028', api.requested)
+        self.assertNotIn('10029', api.requested)
+
+        # entries after the last one in the catalog may have been released since
+        api = RecordedApi()
+        api.entries['10070'] = None
+        self.catalog.update(['10029', '10070'], fetch=api, log=lambda msg: None)
+        self.catalog.update(['10029', '10070'], fetch=api, log=lambda msg: None)
+        self.assertEqual(api.requested, ['10070', '10070'])
+        # and the others are requested again after some time
+        self.catalog.update(['10029'], fetch=api, retryDays=0, log=lambda msg: None)
+        self.assertEqual(api.requested[-1], '10029')
+
+        # unless refreshing, which also forgets the entries that now exist
+        api.entries['10029'] = api.entries.pop('10028')
+        fetched = self.catalog.update(['10028', '10029'], refresh=True, fetch=api,
+                                      log=lambda msg: None)
+        self.assertEqual(fetched, 1)
+        self.assertEqual(self.catalog.getEntryIds(), {'10028', '10029', '10061'})
+        self.assertEqual(self.catalog.getMissingIds(), {'10070'})
+
+    def testParseQuery(self):
+        self.assertEqual(parseQuery('ribosome category=multiframe maxPixel=1,minImages=500'),
+                         {'text': 'ribosome', 'category': 'multiframe',
+                          'maxPixel': '1', 'minImages': '500'})
+        self.assertEqual(parseQuery(''), {})
+        with self.assertRaises(ValueError):
+            parseQuery('ribosome resolution=3')
+
+    def testFilters(self):
+        self.assertEqual(len(self.catalog.search()), 3)
+        self.assertEqual(self.searchIds('category=multiframe'),
+                         [('10028', 'Motion corrected micrographs of Plasmodium '
+                                    'falciparum 80S ribosomes'),
+                          ('10061', 'Unaligned movie frames of beta-galactosidase')])
+        self.assertEqual([r['entry_id'] for r in self.catalog.search(category='multiframe')],
+                         ['10061', '10028'])
+        self.assertEqual(len(self.catalog.search(category='multiframe', limit=1)), 1)
+        self.assertEqual(self.searchIds('format=tiff')[0][0], '10061')
+        self.assertEqual(len(self.searchIds('format=mrc maxPixel=1')), 0)
+        self.assertEqual(len(self.searchIds('minPixel=1 minImages=1000')), 2)
+        self.assertEqual(len(self.searchIds('minImages=1000 maxImages=2000')), 2)
+        self.assertEqual(len(self.searchIds('minFrames=20')), 1)
+        self.assertEqual(len(self.searchIds('maxFrames=1')), 1)
+        self.assertEqual(len(self.searchIds('voxelType=byte')), 1)
+        with self.assertRaises(ValueError):
+            self.catalog.search(resolution=3)
+
+    def testText(self):
+        # words in the title, in the image set details or by prefix
+        self.assertEqual({r['entry_id'] for r in self.catalog.search('emetine')}, {'10028'})
+        if not self.catalog.hasFts:
+            self.skipTest("sqlite built without FTS5")
+        self.assertEqual({r['entry_id'] for r in self.catalog.search('Falcon')}, {'10028'})
+        self.assertEqual({r['entry_id'] for r in self.catalog.search('galacto*')}, {'10061'})
+        self.assertEqual({r['entry_id'] for r in self.catalog.search('ribosome OR K2')},
+                         {'10028', '10061'})
+        self.assertEqual(self.searchIds('super* format=tiff minFrames=30'),
+                         [('10061', 'Unaligned movie frames of beta-galactosidase')])
+        self.assertEqual(self.searchIds('super* format=mrc'), [])
+
+        # FTS5 syntax characters are searched as words
+        self.assertEqual({r['entry_id'] for r in self.catalog.search('beta-galactosidase')},
+                         {'10061'})
+        for text in ('C-terminal', '"ribosome', 'ribosome AND (', 'OR', '*'):
+            self.catalog.search(text)
+        self.assertEqual(len(self.catalog.search('"ribosome')), 2)
+        self.assertEqual(len(self.catalog.search('*')), 3)
+
+    def testFtsQuery(self):
+        self.assertEqual(ftsQuery('beta-galactosidase'), '"beta-galactosidase"')
+        self.assertEqual(ftsQuery('galacto* OR K2'), '"galacto"* OR "K2"')
+        self.assertEqual(ftsQuery('say "hi'), '"say" """hi"')
+        self.assertEqual(ftsQuery('NOT ribosome AND'), '"ribosome"')
+        self.assertEqual(ftsQuery('* **'), '')
@@ -0,0 +1,94 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+""" Columnar reads of set sqlite files, including sets of items stored
+with a table prefix (e.g. the particles of a class). """
+
+import os
+import shutil
+import tempfile
+import unittest
+from types import SimpleNamespace
+
+import numpy as np
+
+from empiar.columns import SetColumnReader, MAX_VARIABLES, batches, normalizePrefix
+from empiar.tests.fakesets import createSetDb
+
+LABELS = ['_defocusU', '_micObj._micName']
+
+
+class TestSetColumnReader(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.dbPath = os.path.join(self.folder, 'classes.sqlite')
+        # a set of classes: the classes and, with a prefix, the items of one of them
+        createSetDb(self.dbPath, ['_size'], [(1, 3), (2, 5)])
+        createSetDb(self.dbPath, LABELS,
+                    [(i, 10000 + i, f'mic{i % 4}.mrc') for i in range(1, 2001)],
+                    prefix='Class001')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def newReader(self, prefix):
+        emSet = SimpleNamespace(getFileName=lambda: self.dbPath, getPrefix=lambda: prefix)
+        return SetColumnReader.fromSet(emSet)
+
+    def testPrefix(self):
+        self.assertEqual(normalizePrefix(None), '')
+        self.assertEqual(normalizePrefix(' Class001 '), 'Class001_')
+        self.assertEqual(normalizePrefix('Class001_'), 'Class001_')
+
+        classes = self.newReader(None)
+        self.assertTrue(classes.hasColumns('_size'))
+        self.assertEqual(list(classes.read('_size')['_size']), [3, 5])
+
+        for prefix in ('Class001', 'Class001_'):
+            items = self.newReader(prefix)
+            self.assertTrue(items.hasColumns(*LABELS))
+            self.assertFalse(items.hasColumns('_size'))
+            columns = items.read('id', *LABELS, dtypes={'_micObj._micName': object})
+            self.assertEqual(len(columns['id']), 2000)
+            self.assertEqual(columns['_defocusU'][0], 10001)
+            self.assertEqual(columns['_micObj._micName'][0], 'mic1.mrc')
+
+    def testMissingFile(self):
+        emSet = SimpleNamespace(getFileName=lambda: None, getPrefix=lambda: None)
+        self.assertIsNone(SetColumnReader.fromSet(emSet))
+
+    def testFilters(self):
+        items = self.newReader('Class001')
+        ids = list(range(1, 2001, 2))
+        self.assertGreater(len(ids), MAX_VARIABLES)
+        columns = items.read('id', '_defocusU', filters={'id': ids})
+        self.assertEqual(sorted(columns['id']), ids)
+        np.testing.assert_array_equal(np.sort(columns['_defocusU']), np.array(ids) + 10000)
+
+        names = items.read('id', filters={'_micObj._micName': ['mic0.mrc'],
+                                          'id': range(1, 101)})['id']
+        self.assertEqual(list(names), list(range(4, 101, 4)))
+
+        self.assertEqual([len(b) for b in batches(range(2000), 900)], [900, 900, 200])
@@ -0,0 +1,50 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+""" Loading the plugin must stay cheap: no heavy modules at import. The
+import time depends on the machine, so its budget (see empiar.benchmark
+--import-time) is only checked when given in EMPIAR_TEST_IMPORT_BUDGET (ms). """
+
+import io
+import os
+import unittest
+
+from empiar.benchmark import checkImportTime, measureImportTime, HEAVY_MODULES
+
+IMPORT_BUDGET_VAR = 'EMPIAR_TEST_IMPORT_BUDGET'
+
+
+class TestImportTime(unittest.TestCase):
+    def testNoHeavyModules(self):
+        loaded = [module for module in measureImportTime()
+                  if module.split('.')[0] in HEAVY_MODULES]
+        self.assertEqual(loaded, [])
+
+    @unittest.skipUnless(os.environ.get(IMPORT_BUDGET_VAR),
+                         f"{IMPORT_BUDGET_VAR} not set")
+    def testBudget(self):
+        out = io.StringIO()
+        errors = checkImportTime(budget=float(os.environ[IMPORT_BUDGET_VAR]), out=out)
+        self.assertEqual(errors, [], out.getvalue())
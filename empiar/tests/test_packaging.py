@@ -0,0 +1,131 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+""" Deposition tree analysis, walking the links as the upload does, and
+the logs put into the tree. """
+
+import os
+import gzip
+import shutil
+import tempfile
+import unittest
+
+from empiar.packaging import (analyzeTree, walkTree, packLog, KB,
+                              LOG_COPY, LOG_GZIP, LOG_TAIL)
+from empiar.upload import buildChunks
+
+
+class TestAnalyzeTree(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.data = os.path.join(self.folder, 'Runs', '000002_ProtImport', 'extra')
+        os.makedirs(os.path.join(self.data, 'tmp'))
+        for name, size in [('a.mrc', 2 * KB), ('b.mrc', 100 * KB), ('tmp/c.mrc', KB)]:
+            with open(os.path.join(self.data, name), 'wb') as f:
+                f.write(b'\0' * size)
+        os.symlink('missing.mrc', os.path.join(self.data, 'broken.mrc'))
+        os.symlink(self.data, os.path.join(self.data, 'tmp', 'loop'))
+
+        # the deposition tree links twice the same input folder
+        self.rootDir = os.path.join(self.folder, 'deposition')
+        os.makedirs(self.rootDir)
+        os.symlink(self.data, os.path.join(self.rootDir, 'import'))
+        os.symlink(self.data, os.path.join(self.rootDir, 'import_again'))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def testReport(self):
+        report = analyzeTree(self.rootDir)
+        self.assertEqual(report['files'], 6)
+        self.assertEqual(report['bytes'], 2 * 103 * KB)
+        self.assertEqual(report['smallFiles'], 6)
+        self.assertEqual(sorted(report['duplicates']),
+                         ['import_again/a.mrc', 'import_again/b.mrc', 'import_again/tmp/c.mrc'])
+        self.assertEqual(sorted(report['intermediates']), ['import/tmp/c.mrc',
+                                                           'import_again/tmp/c.mrc'])
+        self.assertEqual(sorted(report['brokenLinks']), ['import/broken.mrc',
+                                                         'import_again/broken.mrc'])
+        self.assertEqual(sorted(report['linkLoops']), ['import/tmp/loop',
+                                                       'import_again/tmp/loop'])
+        buckets = {bucket['upTo']: bucket['files'] for bucket in report['histogram']}
+        self.assertEqual(buckets[4 * KB], 4)
+        self.assertEqual(buckets[64 * KB], 0)
+        self.assertEqual(buckets[1024 * KB], 2)
+
+    def testUploadSameFiles(self):
+        # the upload sends what the report counts, without entering the loops
+        chunks = buildChunks(self.rootDir, chunkSize=KB)
+        files = [fn for chunk in chunks for fn, size in chunk.files]
+        self.assertEqual(len(files), 6)
+        self.assertEqual(sum(chunk.size for chunk in chunks), 2 * 103 * KB)
+        self.assertTrue(all(fn.startswith('deposition/import') for fn in files))
+
+        walked = [os.path.relpath(dirPath, self.rootDir) for dirPath, _, _ in walkTree(self.rootDir)]
+        self.assertEqual(walked, ['.', 'import', 'import/tmp', 'import_again', 'import_again/tmp'])
+
+
+class TestPackLog(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.log = os.path.join(self.folder, 'run.stdout')
+        with open(self.log, 'w') as f:
+            f.writelines(f'line {i}\n' for i in range(1000))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def append(self, text):
+        with open(self.log, 'a') as f:
+            f.write(text)
+
+    def read(self, fn):
+        with (gzip.open if fn.endswith('.gz') else open)(fn, 'rt') as f:
+            return f.read()
+
+    def testCopy(self):
+        dst = os.path.join(self.folder, 'deposited.log')
+        # a link left by an older version is replaced, without touching the log
+        os.link(self.log, dst)
+        self.assertEqual(packLog(self.log, dst, LOG_COPY), dst)
+        content = self.read(dst)
+        self.append('still running\n')
+        self.assertEqual(self.read(dst), content)
+        self.assertNotEqual(os.stat(dst).st_ino, os.stat(self.log).st_ino)
+        self.assertTrue(self.read(self.log).endswith('still running\n'))
+
+    def testGzipAndTail(self):
+        dst = os.path.join(self.folder, 'deposited.log')
+        self.assertEqual(packLog(self.log, dst, LOG_GZIP), dst + '.gz')
+        self.assertEqual(self.read(dst + '.gz'), self.read(self.log))
+
+        self.assertEqual(packLog(self.log, dst, LOG_TAIL, tailSize=100), dst)
+        lines = self.read(dst).splitlines()
+        self.assertEqual(lines[0], '[...]')
+        self.assertEqual(lines[-1], 'line 999')
+        self.assertLessEqual(len(self.read(dst)), 100 + len('[...]\n'))
+        # short logs are copied whole
+        packLog(self.log, dst, LOG_TAIL, tailSize=100 * KB)
+        self.assertEqual(self.read(dst), self.read(self.log))
@@ -0,0 +1,168 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+""" Images of the viewer read from memory mapped MRC files and rendered
+PSDs. """
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+from PIL import Image as ImagePIL
+
+from empiar.representation import (MrcStack, MRC_VOLUME_STACK, getMrcFileName,
+                                   toUint8, writeStackThumbnails, downsample,
+                                   getGammaLut, renderPsd, writePsdThumbnails,
+                                   GAMMA_LUT_SIZE)
+from empiar.tests.synthetic import writeMrc
+
+
+class TestMrcStack(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def getPath(self, name):
+        return os.path.join(self.folder, name)
+
+    def testHeader(self):
+        images = np.arange(5 * 8 * 6).reshape(5, 8, 6)
+        for dtype in (np.int8, np.int16, np.float32, np.uint16, np.float16):
+            for bigEndian in (False, True):
+                writeMrc(self.getPath('stack.mrcs'), images.astype(dtype), bigEndian=bigEndian,
+                         extendedHeader=b'\1' * 96)
+                stack = MrcStack(self.getPath('stack.mrcs'))
+                self.assertEqual(len(stack), 5)
+                self.assertEqual(stack.data.shape, (5, 8, 6))
+                np.testing.assert_array_equal(stack.data, images.astype(dtype))
+        # Scipion indexes start at 1
+        np.testing.assert_array_equal(stack.getImage(3), images[2])
+        np.testing.assert_array_equal(stack.getImage(1), images[0])
+
+        with open(self.getPath('stack.mrcs'), 'r+b') as f:
+            f.seek(12)
+            f.write(np.array([4], dtype='>i4').tobytes())  # complex mode
+        with self.assertRaises(ValueError):
+            MrcStack(self.getPath('stack.mrcs'))
+
+    def testFileName(self):
+        self.assertEqual(getMrcFileName('particles.mrcs:mrcs'), 'particles.mrcs')
+        self.assertEqual(getMrcFileName('Runs/movie.MRC'), 'Runs/movie.MRC')
+        self.assertIsNone(getMrcFileName('particles.stk'))
+
+    def testThumbnails(self):
+        images = np.random.default_rng(0).normal(size=(4, 64, 48)).astype(np.float32)
+        images[3] = 7  # constant image
+        writeMrc(self.getPath('particles.mrcs'), images)
+        outputs = [(i, self.getPath(f'particle_{i}.jpg'), 'label' if i == 2 else None)
+                   for i in (1, 2, 4)]
+        writeStackThumbnails(self.getPath('particles.mrcs'), outputs)
+        for index, outputFn, _ in outputs:
+            with ImagePIL.open(outputFn) as image:
+                self.assertEqual(image.size, (48, 64))
+                self.assertEqual(image.mode, 'RGB' if index == 2 else 'L')
+        with ImagePIL.open(self.getPath('particle_4.jpg')) as image:
+            self.assertEqual(image.getextrema(), (0, 0))
+
+        scaled = toUint8(images[0])
+        self.assertEqual((scaled.min(), scaled.max()), (0, 255))
+
+    def testVolumes(self):
+        volumes = np.arange(3 * 4 * 5 * 6, dtype=np.float32).reshape(12, 5, 6)
+        writeMrc(self.getPath('subtomos.mrcs'), volumes, mz=4, spaceGroup=MRC_VOLUME_STACK)
+        stack = MrcStack(self.getPath('subtomos.mrcs'))
+        self.assertEqual(stack.volumeDepth, 4)
+        for index in (1, 2, 3):
+            np.testing.assert_array_equal(stack.getVolume(index),
+                                          volumes[(index - 1) * 4:index * 4])
+        with self.assertRaises(IndexError):
+            stack.getVolume(4)
+
+        # a single volume, whatever its index
+        writeMrc(self.getPath('subtomo.mrc'), volumes[:4])
+        volume = MrcStack(self.getPath('subtomo.mrc'))
+        np.testing.assert_array_equal(volume.getVolume(None), volumes[:4])
+        np.testing.assert_array_equal(volume.getVolume(1), volumes[:4])
+        # without the volume stack space group the sections can not be split
+        writeMrc(self.getPath('unmarked.mrcs'), volumes, mz=4)
+        with self.assertRaises(IndexError):
+            MrcStack(self.getPath('unmarked.mrcs')).getVolume(2)
+
+
+class TestPsd(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        # rings centered at the corner, as written by the CTF programs
+        y, x = np.mgrid[:512, :512]
+        radius = np.hypot(np.minimum(y, 512 - y), np.minimum(x, 512 - x))
+        self.psd = (1 + np.cos(radius / 4)).astype(np.float32)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def getPath(self, name):
+        return os.path.join(self.folder, name)
+
+    def testDownsample(self):
+        data = np.arange(16, dtype=np.float32).reshape(4, 4)
+        np.testing.assert_array_equal(downsample(data, 2), [[2.5, 4.5], [10.5, 12.5]])
+        self.assertIs(downsample(data, 4), data)
+        self.assertEqual(downsample(np.ones((1030, 700)), 256).shape, (257, 175))
+
+    def testGammaLut(self):
+        lut = getGammaLut()
+        self.assertIs(lut, getGammaLut())
+        self.assertEqual((len(lut), lut[0], lut[-1]), (GAMMA_LUT_SIZE, 0, 255))
+        self.assertTrue(np.all(np.diff(lut.astype(int)) >= 0))
+        # gamma brightens the dark values
+        self.assertGreater(lut[GAMMA_LUT_SIZE // 4], 255 // 4)
+
+    def testRender(self):
+        renderPsd(self.psd, self.getPath('psd.jpg'))
+        with ImagePIL.open(self.getPath('psd.jpg')) as image:
+            self.assertEqual(image.size, (256, 256))
+            data = np.asarray(image, dtype=np.float32)
+        # the center of the rings is moved to the middle of the image
+        self.assertGreater(data[128, 128], 200)
+        renderPsd(np.zeros((64, 64)), self.getPath('empty.jpg'))
+        with ImagePIL.open(self.getPath('empty.jpg')) as image:
+            self.assertEqual(image.getextrema(), (0, 0))
+
+    def testThumbnails(self):
+        writeMrc(self.getPath('ctf.mrc'), self.psd[None])
+        read = []
+        psds = [(self.getPath('ctf.mrc:mrc'), self.getPath('ctf.jpg')),
+                (self.getPath('ctf.psd'), self.getPath('ctf_psd.jpg')),
+                (self.getPath('missing.mrc'), self.getPath('missing.jpg'))]
+        errors = writePsdThumbnails(psds, readData=lambda fn: read.append(fn) or self.psd)
+        self.assertEqual(read, [self.getPath('ctf.psd')])
+        self.assertEqual([fn for fn, _ in errors], [self.getPath('missing.mrc')])
+        with ImagePIL.open(self.getPath('ctf.jpg')) as fromMrc, \
+                ImagePIL.open(self.getPath('ctf_psd.jpg')) as fromData:
+            np.testing.assert_array_equal(np.asarray(fromMrc), np.asarray(fromData))
@@ -0,0 +1,132 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+""" Sampling policies: parsing, the selected items and the fallbacks when
+a policy can not be applied to a set. """
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from empiar.sampling import SamplingPolicy, getPolicy, parsePolicies
+from empiar.tests.fakesets import createSetDb, FakeSet, FakeSetOfClasses
+
+LABELS = ['_defocusU', '_micName']
+ROWS = [(i, 30000 - 100 * i, f'mic{i:03d}.mrc') for i in range(1, 101)]
+
+
+# Classes named as the Scipion ones, to check the policies of base classes
+class SetOfImages(FakeSet):
+    pass
+
+
+class SetOfMicrographsBase(SetOfImages):
+    pass
+
+
+class SetOfMicrographs(SetOfMicrographsBase):
+    pass
+
+
+class SetOfClasses2D(FakeSetOfClasses):
+    pass
+
+
+class TestSamplingPolicy(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.dbPath = os.path.join(self.folder, 'set.sqlite')
+        createSetDb(self.dbPath, LABELS, ROWS)
+        self.warnings = []
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def sample(self, text, setClass=FakeSet):
+        emSet = setClass(self.dbPath, LABELS, ROWS)
+        items = list(SamplingPolicy.parse(text).iterItems(emSet, log=self.warnings.append))
+        return [item.getObjId() for item in items], emSet
+
+    def testParse(self):
+        for text in ('all', 'first 3', 'random 15 7', 'stratified 5 _defocusU'):
+            self.assertEqual(str(SamplingPolicy.parse(text)), text)
+        self.assertEqual(str(SamplingPolicy.parse('random 15')), 'random 15 0')
+        for text in ('', 'some 3', 'first', 'stratified 5'):
+            with self.assertRaises(ValueError):
+                SamplingPolicy.parse(text)
+        with self.assertRaises(ValueError):
+            parsePolicies('SetOfParticles first 3')
+
+    def testSelection(self):
+        self.assertEqual(self.sample('all')[0], list(range(1, 101)))
+        ids, emSet = self.sample('first 4')
+        self.assertEqual(ids, [1, 2, 3, 4])
+        self.assertEqual(emSet.queries, [(None, 4)])
+
+        ids = self.sample('random 10 3')[0]
+        self.assertEqual(len(set(ids)), 10)
+        self.assertEqual(ids, self.sample('random 10 3')[0])
+        self.assertNotEqual(ids, self.sample('random 10 4')[0])
+
+        # defocus decreases with the id
+        self.assertEqual(self.sample('stratified 3 _defocusU')[0], [1, 50, 100])
+        self.assertEqual(self.sample('stratified 1000 _defocusU')[0], list(range(1, 101)))
+        self.assertEqual(self.warnings, [])
+
+    def testClasses(self):
+        # SetOfClasses.iterItems accepts neither limit nor where
+        ids, classes = self.sample('first 3', SetOfClasses2D)
+        self.assertEqual(ids, [1, 2, 3])
+        ids, classes = self.sample('random 5 1', SetOfClasses2D)
+        self.assertEqual(ids, self.sample('random 5 1')[0])
+        self.assertEqual(classes.queries, [('getitem', objId) for objId in ids])
+        self.assertEqual(self.sample('stratified 3 _defocusU', SetOfClasses2D)[0], [1, 50, 100])
+
+    def testFallback(self):
+        randomIds = self.sample('random 5 0')[0]
+        for text, reason in [('stratified 5 _micName', 'not numeric'),
+                             ('stratified 5 _ctfModel._defocusV', 'has no column')]:
+            self.warnings = []
+            self.assertEqual(self.sample(text)[0], randomIds)
+            self.assertEqual(len(self.warnings), 1)
+            self.assertIn(reason, self.warnings[0])
+
+        # sets without sqlite are read item by item
+        emSet = FakeSet(None, LABELS, ROWS)
+        self.warnings = []
+        policy = SamplingPolicy.parse('stratified 5 _defocusU')
+        self.assertEqual(len(list(policy.iterItems(emSet, log=self.warnings.append))), 5)
+        self.assertIn('can not be read by columns', self.warnings[0])
+
+    def testGetPolicy(self):
+        micrographs = SetOfMicrographs(self.dbPath, LABELS, ROWS)
+        self.assertEqual(str(getPolicy(micrographs)), 'first 3')
+        # a user policy for a base class wins over the default of a subclass
+        policies = parsePolicies('SetOfImages: random 7 1; SetOfClasses2D: first 10')
+        self.assertEqual(str(getPolicy(micrographs, policies)), 'random 7 1')
+        self.assertEqual(str(getPolicy(SetOfClasses2D(self.dbPath, LABELS, ROWS), policies)),
+                         'first 10')
+        self.assertEqual(str(getPolicy(FakeSet(self.dbPath, LABELS, ROWS), policies)), 'all')
@@ -0,0 +1,127 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+""" Header only scan of synthetic MRC and TIFF files and the report of
+the files that differ from the rest of their set. """
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from empiar.scan import (readMrcHeader, readTiffHeader, readHeader, scanFiles,
+                         findOutliers, HeaderCache, SCAN_CHUNK)
+from empiar.tests.synthetic import writeMrc, writeTiff
+
+
+class TestScan(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def getPath(self, name):
+        return os.path.join(self.folder, name)
+
+    def writeMovie(self, name, frames=4, dtype=np.float32, **kwargs):
+        path = self.getPath(name)
+        data = np.zeros((frames, 16, 24), dtype=dtype)
+        (writeTiff if name.endswith(('.tif', '.tiff', '.eer')) else writeMrc)(path, data, **kwargs)
+        return path
+
+    def testMrc(self):
+        path = self.writeMovie('movie.mrc', extendedHeader=b'\0' * 128, bigEndian=True)
+        self.assertEqual(readMrcHeader(path, os.path.getsize(path)), ([24, 16], 4, 'float32'))
+        path = self.writeMovie('movie16.mrcs', frames=2, dtype=np.uint16)
+        self.assertEqual(readMrcHeader(path, os.path.getsize(path)), ([24, 16], 2, 'uint16'))
+
+        with self.assertRaisesRegex(ValueError, 'truncated'):
+            readMrcHeader(path, os.path.getsize(path) - 1)
+        with open(self.getPath('short.mrc'), 'wb') as f:
+            f.write(b'\0' * 100)
+        with self.assertRaisesRegex(ValueError, 'shorter'):
+            readMrcHeader(self.getPath('short.mrc'), 100)
+
+    def testTiff(self):
+        for kwargs in ({}, {'bigTiff': True}, {'bigEndian': True}):
+            path = self.writeMovie('movie.tif', frames=5, dtype=np.uint8, **kwargs)
+            self.assertEqual(readTiffHeader(path), ([24, 16], 5, 'uint8'))
+        path = self.writeMovie('gain.tiff', frames=1, dtype=np.float32)
+        self.assertEqual(readTiffHeader(path), ([24, 16], 1, 'float32'))
+        path = self.writeMovie('movie.eer', frames=3, dtype=np.uint16, compression=65001)
+        self.assertEqual(readTiffHeader(path), ([24, 16], 3, 'eer'))
+
+        with open(self.getPath('fake.tif'), 'wb') as f:
+            f.write(b'GIF89a')
+        with self.assertRaisesRegex(ValueError, 'not a TIFF'):
+            readTiffHeader(self.getPath('fake.tif'))
+
+    def testReadHeader(self):
+        path = self.writeMovie('movie.mrcs')
+        header = readHeader(path + ':mrcs')
+        self.assertEqual(header, {'path': path, 'format': 'mrcs', 'dims': [24, 16],
+                                  'frames': 4, 'voxelType': 'float32',
+                                  'bytes': os.path.getsize(path)})
+        with open(self.getPath('volume.vol'), 'wb') as f:
+            f.write(b'\0' * 10)
+        self.assertEqual(readHeader(self.getPath('volume.vol'))['bytes'], 10)
+        self.assertIn('error', readHeader(self.getPath('missing.mrc')))
+
+    def testOutliers(self):
+        paths = [self.writeMovie(f'movie{i:03d}.tif', dtype=np.uint8) for i in range(SCAN_CHUNK + 2)]
+        paths.append(self.writeMovie('movie_more_frames.tif', frames=6, dtype=np.uint8))
+        paths.append(self.writeMovie('movie_float.tif', dtype=np.float32))
+        paths.append(self.getPath('movie_missing.tif'))
+
+        # in a pool of processes and with the cache of the headers
+        cacheFile = self.getPath('headers.json')
+        with HeaderCache(cacheFile) as cache:
+            headers = scanFiles(paths, cache, workers=2)
+        self.assertEqual([h['path'] for h in headers], paths)
+
+        report = findOutliers(headers)
+        self.assertEqual(report['files'], len(paths))
+        self.assertEqual(report['reference'], {'format': 'tif', 'dims': [24, 16],
+                                               'frames': 4, 'voxelType': 'uint8'})
+        outliers = {os.path.basename(o['path']): o for o in report['outliers']}
+        self.assertEqual(sorted(outliers), ['movie_float.tif', 'movie_missing.tif',
+                                            'movie_more_frames.tif'])
+        self.assertEqual(outliers['movie_more_frames.tif']['differences'], {'frames': 6})
+        self.assertEqual(outliers['movie_float.tif']['differences'], {'voxelType': 'float32'})
+        self.assertIn('error', outliers['movie_missing.tif'])
+        self.assertEqual(report['bytes'], sum(os.path.getsize(p) for p in paths[:-1]))
+
+        # headers are read again only for modified files, errors are not cached
+        self.writeMovie('movie000.tif', frames=2, dtype=np.uint8)
+        stat = os.stat(paths[0])
+        os.utime(paths[0], ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        cache = HeaderCache(cacheFile)
+        self.assertIsNone(cache.get(paths[0]))
+        self.assertIsNone(cache.get(paths[-1]))
+        self.assertEqual(cache.get(paths[1])['frames'], 4)
+        self.assertEqual(scanFiles(paths[:1], cache, workers=1)[0]['frames'], 2)
@@ -0,0 +1,169 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+""" Statistics of the workflow plots computed over whole columns, and the
+shifts read from RELION motion correction star files. """
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from empiar.statistics import (ColumnAccumulator, totalDrift, totalDrifts,
+                               parseShifts, parseShiftsColumn, defocusStats,
+                               StarShiftsReader)
+
+SHIFTS_X = ['0,1,3', '0.5,0.5', '2,-2,2,-2']
+SHIFTS_Y = ['0,0,0', '0,1', '0,0,0,0']
+
+
+class TestDrifts(unittest.TestCase):
+    def testTotalDrift(self):
+        self.assertAlmostEqual(totalDrift([0, 3], [0, 4]), 5)
+        # relative to the previous frame: sqrt(1 + 2^2)
+        self.assertAlmostEqual(totalDrift([0, 1, 3], [0, 0, 0]), np.sqrt(5))
+        # shifts of different lengths use the shortest
+        self.assertAlmostEqual(totalDrift([0, 1, 3, 10], [0, 0, 0]), np.sqrt(5))
+        self.assertEqual(totalDrift([1], [1]), 0)
+
+    def testColumn(self):
+        shifts, counts = parseShiftsColumn(SHIFTS_X)
+        np.testing.assert_array_equal(counts, [3, 2, 4])
+        np.testing.assert_array_equal(shifts, [0, 1, 3, 0.5, 0.5, 2, -2, 2, -2])
+        self.assertEqual(parseShiftsColumn([])[0].size, 0)
+
+        # same result as movie by movie, without mixing consecutive movies
+        expected = [totalDrift(parseShifts(x), parseShifts(y)) for x, y in zip(SHIFTS_X, SHIFTS_Y)]
+        np.testing.assert_allclose(totalDrifts(SHIFTS_X, SHIFTS_Y), expected)
+        np.testing.assert_allclose(expected, [np.sqrt(5), 1, np.sqrt(48)])
+        # movies with a different number of X and Y shifts
+        np.testing.assert_allclose(totalDrifts(['0,3', '0,1,3'], ['0,4', '0,0']), [5, 1])
+
+
+class TestColumns(unittest.TestCase):
+    def testAccumulator(self):
+        columns = ColumnAccumulator('defocusU', 'resolution')
+        self.assertEqual(len(columns), 0)
+        for i in range(5):
+            columns.append(defocusU=10000 + i, resolution=3.5)
+        self.assertEqual(len(columns), 5)
+        np.testing.assert_array_equal(columns.getArray('defocusU'), np.arange(10000, 10005))
+        self.assertEqual(columns.getArray('resolution', np.float32).dtype, np.float32)
+
+    def testDefocus(self):
+        mean, astigmatism = defocusStats([10000, 20000], [12000, 20000])
+        np.testing.assert_array_equal(mean, [11000, 20000])
+        np.testing.assert_array_equal(astigmatism, [1000, 0])
+
+
+STAR_TEMPLATE = """
+data_general
+
+_rlnImageSizeX 4096
+_rlnImageSizeY 4096
+_rlnImageSizeZ %(frames)d
+
+data_global_shift
+
+loop_
+_rlnMicrographFrameNumber #1
+_rlnMicrographShiftX #2
+_rlnMicrographShiftY #3
+%(rows)s
+"""
+
+
+def writeStar(fileName, shiftsX, shiftsY):
+    rows = '\n'.join(f'{i + 1} {x:.6f} {y:.6f}' for i, (x, y) in enumerate(zip(shiftsX, shiftsY)))
+    with open(fileName, 'w') as f:
+        f.write(STAR_TEMPLATE % {'frames': len(shiftsX), 'rows': rows})
+
+
+class TestStarShiftsReader(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.starDir = os.path.join(self.folder, 'MotionCorr', 'job002', 'Movies')
+        os.makedirs(self.starDir)
+        for i in range(3):
+            writeStar(self.getStar(i), [0, i, 2 * i], [0, 0, 1])
+        self.cacheFile = os.path.join(self.folder, 'cache', 'shifts.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def getStar(self, i):
+        return os.path.join(self.starDir, f'mic{i}.star')
+
+    def newReader(self):
+        reader = StarShiftsReader(self.starDir, self.cacheFile, threads=2)
+        reader.parsed = []
+        parse = reader._parse
+
+        def recordParse(fileName):
+            reader.parsed.append(fileName)
+            return parse(fileName)
+        reader._parse = recordParse
+        return reader
+
+    def testRead(self):
+        reader = self.newReader()
+        shifts = reader.readShifts(['Runs/mic2.mrc', 'mic0.mrc', 'missing.mrc'])
+        self.assertEqual(len(shifts), 2)
+        np.testing.assert_array_equal(shifts[0][0], [0, 2, 4])
+        np.testing.assert_array_equal(shifts[0][1], [0, 0, 1])
+        np.testing.assert_array_equal(shifts[1][0], [0, 0, 0])
+        self.assertEqual(sorted(reader.parsed), ['mic0.star', 'mic2.star'])
+
+        self.assertEqual(StarShiftsReader(os.path.join(self.folder, 'none')).readShifts(['mic0.mrc']),
+                         [])
+
+    def testCache(self):
+        micNames = [f'mic{i}.mrc' for i in range(3)]
+        self.newReader().readShifts(micNames)
+        with open(self.cacheFile) as f:
+            self.assertEqual(sorted(json.load(f)), ['mic0.star', 'mic1.star', 'mic2.star'])
+
+        # a new reader only parses the star files modified since
+        writeStar(self.getStar(1), [0, 5], [0, 0])
+        stat = os.stat(self.getStar(1))
+        os.utime(self.getStar(1), (stat.st_atime, stat.st_mtime + 10))
+        reader = self.newReader()
+        shifts = reader.readShifts(micNames)
+        self.assertEqual(reader.parsed, ['mic1.star'])
+        np.testing.assert_array_equal(shifts[1][0], [0, 5])
+
+        reader = self.newReader()
+        reader.readShifts(micNames)
+        self.assertEqual(reader.parsed, [])
+
+        # a corrupted cache is regenerated
+        with open(self.cacheFile, 'w') as f:
+            f.write('{')
+        reader = self.newReader()
+        reader.readShifts(micNames)
+        self.assertEqual(len(reader.parsed), 3)
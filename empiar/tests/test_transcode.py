@@ -0,0 +1,106 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+""" Compression of downloaded MRC movies into TIFF, alone and in the pool
+of processes fed by the downloader. """
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from empiar.scan import readTiffHeader
+from empiar.tests.synthetic import writeMrc
+from empiar.transcode import (MovieTranscoder, transcodeMovie, getTranscodedName,
+                              isTranscodable)
+
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+
+
+class TestTranscode(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.frames = np.random.default_rng(1).integers(0, 4, size=(6, 32, 40)).astype(np.int8)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def getPath(self, name):
+        return os.path.join(self.folder, name)
+
+    def writeMovie(self, name):
+        writeMrc(self.getPath(name), self.frames, bigEndian=True)
+        return self.getPath(name)
+
+    def testNames(self):
+        self.assertEqual(getTranscodedName('Movies/movie_001.mrc'), 'Movies/movie_001.tif')
+        self.assertTrue(isTranscodable('movie.MRCS'))
+        self.assertFalse(isTranscodable('movie.tiff'))
+
+        movie = self.writeMovie('movie.mrc')
+        self.assertEqual(MovieTranscoder.findLocalFile(movie), movie)
+        self.assertIsNone(MovieTranscoder.findLocalFile(self.getPath('missing.mrc')))
+        open(getTranscodedName(movie), 'w').close()
+        self.assertEqual(MovieTranscoder.findLocalFile(movie), getTranscodedName(movie))
+        # a tiff is never the transcoded version of itself
+        tiff = self.getPath('gain.tif')
+        open(tiff, 'w').close()
+        self.assertEqual(MovieTranscoder.findLocalFile(tiff), tiff)
+
+    @unittest.skipIf(tifffile is None, "tifffile not installed")
+    def testTranscode(self):
+        movie = self.writeMovie('movie.mrc')
+        outputFn, inputBytes, outputBytes = transcodeMovie(movie, getTranscodedName(movie))
+        self.assertEqual(outputFn, self.getPath('movie.tif'))
+        self.assertFalse(os.path.exists(movie))
+        self.assertFalse(os.path.exists(outputFn + '.tmp'))
+        self.assertLess(outputBytes, inputBytes)
+        self.assertEqual(readTiffHeader(outputFn), ([40, 32], 6, 'int8'))
+        np.testing.assert_array_equal(tifffile.imread(outputFn), self.frames)
+
+    def testTranscoder(self):
+        registered, messages = [], []
+        movies = [self.writeMovie(f'movie{i}.mrc') for i in range(3)]
+        with open(self.getPath('broken.mrc'), 'wb') as f:
+            f.write(b'\0' * 10)
+        gain = self.getPath('gain.tif')
+        open(gain, 'w').close()
+        with MovieTranscoder(registered.append, workers=2, log=messages.append) as transcoder:
+            for fileName in movies + [self.getPath('broken.mrc'), gain]:
+                transcoder.submit(fileName)
+
+        # every file is registered once: compressed or, if it fails, as it is
+        self.assertIn(gain, registered)
+        self.assertIn(self.getPath('broken.mrc'), registered)
+        self.assertEqual(len(registered), 5)
+        expected = ([getTranscodedName(m) for m in movies] if tifffile is not None else movies)
+        self.assertEqual(sorted(set(registered) - {gain, self.getPath('broken.mrc')}), expected)
+        self.assertTrue(all(os.path.exists(fn) for fn in registered))
+        self.assertTrue(any('broken.mrc could not be compressed' in m for m in messages))
@@ -0,0 +1,105 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+""" Chunked upload with a fake ascp: an interrupted upload is resumed
+without sending again the chunks recorded in the journal. """
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from types import SimpleNamespace
+
+from empiar.upload import UploadOrchestrator, buildChunks
+
+FILE_SIZE = 1000
+FILES = 12
+
+
+class FakeAscp:
+    """ Runner recording the files of each ascp call. It fails (as an
+    interrupted transfer) from the call number failAt on. """
+    def __init__(self, failAt=None):
+        self.failAt = failAt
+        self.calls = []
+
+    def __call__(self, cmd, env=None):
+        manifestFn = cmd[cmd.index('--file-list') + 1]
+        with open(manifestFn) as f:
+            files = f.read().split()
+        self.calls.append(files)
+        failed = self.failAt is not None and len(self.calls) >= self.failAt
+        return SimpleNamespace(returncode=1 if failed else 0)
+
+    def getFiles(self):
+        return [fn for files in self.calls for fn in files]
+
+
+class TestUploadOrchestrator(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.rootDir = os.path.join(self.folder, 'deposition')
+        for i in range(FILES):
+            subDir = os.path.join(self.rootDir, f'set{i % 3}')
+            os.makedirs(subDir, exist_ok=True)
+            with open(os.path.join(subDir, f'file{i:02d}.mrc'), 'wb') as f:
+                f.write(b'\0' * FILE_SIZE)
+        self.workingDir = os.path.join(self.folder, 'upload')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def newOrchestrator(self, runner, concurrency=1):
+        # two files per chunk
+        return UploadOrchestrator(self.rootDir, 'upload/dir/data', 'ascp', self.workingDir,
+                                  chunkSize=2 * FILE_SIZE, concurrency=concurrency,
+                                  runner=runner, log=lambda msg: None)
+
+    def testResume(self):
+        chunks = buildChunks(self.rootDir, 2 * FILE_SIZE)
+        self.assertEqual(len(chunks), FILES // 2)
+
+        interrupted = FakeAscp(failAt=3)
+        with self.assertRaises(RuntimeError):
+            self.newOrchestrator(interrupted).run()
+        uploaded = interrupted.getFiles()[:4]  # the 2 chunks that succeeded
+
+        resumed = FakeAscp()
+        self.newOrchestrator(resumed).run()
+        self.assertEqual(len(resumed.calls), len(chunks) - 2)
+        self.assertFalse(set(uploaded) & set(resumed.getFiles()))
+        self.assertEqual(len(set(uploaded) | set(resumed.getFiles())), FILES)
+
+        # nothing left to upload
+        finished = FakeAscp()
+        self.newOrchestrator(finished).run()
+        self.assertEqual(finished.calls, [])
+
+    def testConcurrentJournal(self):
+        self.newOrchestrator(FakeAscp(), concurrency=4).run()
+        with open(os.path.join(self.workingDir, 'journal.json')) as f:
+            journal = json.load(f)
+        self.assertEqual(len(journal['chunks']), FILES // 2)
@@ -0,0 +1,125 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+""" Workflow json written item by item, in place only when complete, the
+protocols selected from the parents index and the fragments reused from
+the workflow cache. """
+
+import os
+import gzip
+import json
+import shutil
+import tempfile
+import unittest
+
+from empiar.workflow import JsonListWriter, WorkflowCache, getAncestors
+
+ITEMS = [{'object.id': '2', 'label': 'import'}, {'object.id': '5', 'label': 'ctf'}]
+
+
+class TestJsonListWriter(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'workflow.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def load(self, path):
+        with (gzip.open if path.endswith('.gz') else open)(path, 'rt') as f:
+            return json.load(f)
+
+    def testWrite(self):
+        for indent in (4, None):
+            with JsonListWriter(self.path, indent=indent, gzipCopy=True) as writer:
+                for item in ITEMS:
+                    writer.write(item)
+            self.assertEqual(self.load(self.path), ITEMS)
+            self.assertEqual(self.load(self.path + '.gz'), ITEMS)
+        with JsonListWriter(self.path):
+            pass
+        self.assertEqual(self.load(self.path), [])
+        self.assertEqual(sorted(os.listdir(self.folder)), ['workflow.json', 'workflow.json.gz'])
+
+    def testFailure(self):
+        with JsonListWriter(self.path, gzipCopy=True) as writer:
+            writer.write(ITEMS[0])
+        with self.assertRaises(RuntimeError):
+            with JsonListWriter(self.path, gzipCopy=True) as writer:
+                writer.write(ITEMS[1])
+                raise RuntimeError("export failed")
+        # the previous workflow is kept and no partial file is left
+        self.assertEqual(self.load(self.path), ITEMS[:1])
+        self.assertEqual(self.load(self.path + '.gz'), ITEMS[:1])
+        self.assertEqual(sorted(os.listdir(self.folder)), ['workflow.json', 'workflow.json.gz'])
+
+
+
+class TestGetAncestors(unittest.TestCase):
+    def testAncestors(self):
+        parentsIndex = {1: set(), 2: {1}, 3: {2}, 4: {2}, 5: {3, 4}, 6: {1}}
+        self.assertEqual(set(getAncestors(parentsIndex, [5])), {1, 2, 3, 4, 5})
+        self.assertEqual(set(getAncestors(parentsIndex, [6, 4])), {1, 2, 4, 6})
+
+
+class TestWorkflowCache(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.cacheDir = os.path.join(self.folder, 'workflow_cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def testReuse(self):
+        fingerprint = ['finished', '2024-05-02 10:00:00', [['outputCTF', 120, 1714640000.5]],
+                       'SetOfCTF: first 3', 0, 1024, 'deposition']
+        fragment = {'summary': 'CTF estimated', 'log': 'images_representation/2_Ctf.log'}
+        cache = WorkflowCache(self.cacheDir)
+        self.assertIsNone(cache.get(2, fingerprint))
+        cache.set(2, tuple(fingerprint), fragment)
+        cache.save()
+
+        # a new export reuses it while the protocol does not change
+        cache = WorkflowCache(self.cacheDir)
+        self.assertEqual(cache.get(2, fingerprint), fragment)
+        self.assertEqual(cache.get('2', fingerprint), fragment)
+        self.assertIsNone(cache.get(3, fingerprint))
+        changed = list(fingerprint)
+        changed[2] = [['outputCTF', 121, 1714640100.0]]
+        self.assertIsNone(cache.get(2, changed))
+        changed = fingerprint[:-1] + ['renamed']
+        self.assertIsNone(cache.get(2, changed))
+
+        # unsaved fragments are not reused, nor those whose file is gone
+        cache.set(3, fingerprint, fragment)
+        self.assertIsNone(WorkflowCache(self.cacheDir).get(3, fingerprint))
+        os.remove(os.path.join(self.cacheDir, '2.json'))
+        self.assertIsNone(WorkflowCache(self.cacheDir).get(2, fingerprint))
+
+    def testCorruptedIndex(self):
+        os.makedirs(self.cacheDir)
+        with open(os.path.join(self.cacheDir, WorkflowCache.INDEX), 'w') as f:
+            f.write('{"2": [')
+        self.assertIsNone(WorkflowCache(self.cacheDir).get(2, ['finished']))
@@ -0,0 +1,147 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+""" Lossless compression of downloaded MRC movies into TIFF files, done
+in a pool of processes while the download goes on. """
+
+import os
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from empiar.constants import MRC_EXTENSIONS
+
+TRANSCODED_EXTENSION = '.tif'
+COMPRESSIONS = ['zlib', 'lzw', 'zstd']  # lzw and zstd need imagecodecs
+# MRC files larger than this are written as BigTIFF
+BIGTIFF_SIZE = 2 ** 32 - 2 ** 25
+
+
+def getTranscodedName(fileName):
+    return os.path.splitext(fileName)[0] + TRANSCODED_EXTENSION
+
+
+def isTranscodable(fileName):
+    return fileName.lower().endswith(MRC_EXTENSIONS)
+
+
+def transcodeMovie(inputFn, outputFn, compression='zlib', deleteOriginal=True):
+    """ Write the frames of an MRC movie as a compressed multi page TIFF,
+    one frame at a time (the movie is memory mapped, never fully read).
+    The TIFF is written with a temporary name and renamed when finished.
+    :return: (output file, input bytes, output bytes)
+    """
+    import numpy as np
+    import tifffile
+    from empiar.representation import MrcStack
+
+    stack = MrcStack(inputFn)
+    dtype = stack.data.dtype.newbyteorder('=')
+    inputBytes = os.path.getsize(inputFn)
+    tmpFn = outputFn + '.tmp'
+    try:
+        with tifffile.TiffWriter(tmpFn, bigtiff=stack.data.nbytes > BIGTIFF_SIZE) as tif:
+            for frame in stack.data:
+                tif.write(np.asarray(frame, dtype=dtype), compression=compression,
+                          contiguous=False)
+    except Exception:
+        if os.path.exists(tmpFn):
+            os.remove(tmpFn)
+        raise
+    del stack
+    os.replace(tmpFn, outputFn)
+    if deleteOriginal:
+        os.remove(inputFn)
+    return outputFn, inputBytes, os.path.getsize(outputFn)
+
+
+class MovieTranscoder:
+    """ Stage between the downloader and the movie registration: MRC movies
+    are compressed in a pool of processes and the callback is called (from
+    the thread submitting the movies) with the compressed file when it is
+    ready. Other files, or movies that fail to be compressed, are passed
+    as they are. At most 2 movies per worker wait to be compressed, so the
+    download does not get too far ahead. """
+    def __init__(self, callback, workers=2, compression='zlib',
+                 deleteOriginal=True, log=print):
+        self._callback = callback
+        self._compression = compression
+        self._deleteOriginal = deleteOriginal
+        self._log = log
+        self._maxPending = 2 * workers
+        self._executor = ProcessPoolExecutor(max_workers=workers)
+        self._pending = {}  # {future: input file}
+        self.inputBytes = self.outputBytes = 0
+
+    @staticmethod
+    def findLocalFile(fileName):
+        """ Return the local file of a movie: the compressed one if it was
+        already transcoded, the original one or None. """
+        for fn in [getTranscodedName(fileName), fileName]:
+            if os.path.exists(fn) and (fn == fileName or isTranscodable(fileName)):
+                return fn
+        return None
+
+    def submit(self, fileName):
+        if not isTranscodable(fileName):
+            self._callback(fileName)
+        else:
+            future = self._executor.submit(transcodeMovie, fileName, getTranscodedName(fileName),
+                                           self._compression, self._deleteOriginal)
+            self._pending[future] = fileName
+        self.poll(block=len(self._pending) >= self._maxPending)
+
+    def poll(self, block=False, all=False):
+        """ Register the movies already compressed, waiting for one (block)
+        or for all of them. """
+        if not self._pending:
+            return
+        if all:
+            done = wait(self._pending).done
+        else:
+            done = wait(self._pending, timeout=None if block else 0,
+                        return_when=FIRST_COMPLETED).done
+        for future in done:
+            inputFn = self._pending.pop(future)
+            try:
+                outputFn, inputBytes, outputBytes = future.result()
+            except Exception as e:
+                self._log(f"{inputFn} could not be compressed, it is kept as it is: {e}")
+                self._callback(inputFn)
+            else:
+                self.inputBytes += inputBytes
+                self.outputBytes += outputBytes
+                self._callback(outputFn)
+
+    def close(self):
+        self.poll(all=True)
+        self._executor.shutdown()
+        if self.inputBytes:
+            self._log(f"Movies compressed from {self.inputBytes} to {self.outputBytes} bytes "
+                      f"({self.inputBytes / max(self.outputBytes, 1):.1f}x)")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,196 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+""" Upload of the deposition data to EMPIAR in chunks, so a failure only
+requires to upload again the chunks that did not finish. """
+
+import os
+import json
+import time
+import hashlib
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from empiar.packaging import walkTree
+
+ASPERA_USER = 'emp_dep'
+ASPERA_HOST = 'hx-fasp-1.ebi.ac.uk'
+ASPERA_PORT = 33001
+
+GB = 1024 ** 3
+
+
+class UploadChunk:
+    """ A group of files of the deposition tree uploaded by one ascp call.
+    The id depends on the files and their sizes, so it is stable between
+    runs while the tree does not change. """
+    def __init__(self, files, size):
+        self.files = files  # paths relative to the tree parent folder
+        self.size = size
+        digest = hashlib.sha1()
+        for fn, fnSize in files:
+            digest.update(f'{fn}\t{fnSize}\n'.encode())
+        self.id = digest.hexdigest()[:16]
+
+    def __len__(self):
+        return len(self.files)
+
+
+def buildChunks(rootDir, chunkSize=100 * GB, brokenLinks=None):
+    """ Walk the tree (following links) and split its files into chunks
+    of about chunkSize bytes. Paths include the root folder name.
+    :param brokenLinks: optional list where the dangling links (skipped)
+        are appended
+    """
+    baseDir = os.path.dirname(os.path.abspath(rootDir))
+    chunks, files, size = [], [], 0
+    for dirPath, dirNames, fileNames in walkTree(rootDir):
+        for fileName in fileNames:
+            path = os.path.join(dirPath, fileName)
+            try:
+                fileSize = os.path.getsize(path)
+            except FileNotFoundError:
+                if not os.path.islink(path):
+                    raise
+                if brokenLinks is not None:
+                    brokenLinks.append(os.path.relpath(path, rootDir))
+                continue
+            if files and size + fileSize > chunkSize:
+                chunks.append(UploadChunk(files, size))
+                files, size = [], 0
+            files.append((os.path.relpath(os.path.abspath(path), baseDir), fileSize))
+            size += fileSize
+    if files:
+        chunks.append(UploadChunk(files, size))
+    return chunks
+
+
+class UploadJournal:
+    """ Json file recording the chunks already uploaded and their stats.
+    It is updated from the upload threads, so changes are serialized. """
+    def __init__(self, path):
+        self._path = path
+        self._lock = threading.RLock()
+        self._data = {'chunks': {}}
+        if os.path.exists(path):
+            with open(path) as f:
+                self._data = json.load(f)
+
+    def get(self, key, default=None):
+        return self._data.get(key, default)
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self.save()
+
+    def isDone(self, chunkId):
+        return chunkId in self._data['chunks']
+
+    def markDone(self, chunkId, stats):
+        with self._lock:
+            self._data['chunks'][chunkId] = stats
+            self.save()
+
+    def save(self):
+        with self._lock:
+            tmpPath = self._path + '.tmp'
+            with open(tmpPath, 'w') as f:
+                json.dump(self._data, f, indent=4)
+            os.replace(tmpPath, self._path)  # never leave a half written journal
+
+
+class UploadOrchestrator:
+    """ Upload a folder to EMPIAR with one ascp call per chunk, running
+    several of them at the same time and skipping the chunks recorded in
+    the journal. Files already on the server are skipped by ascp itself.
+    :param runner: function with the subprocess.run signature, so the
+        transfer can be replaced (e.g. by a fake ascp)
+    """
+    def __init__(self, rootDir, destination, ascp, workingDir,
+                 chunkSize=100 * GB, concurrency=1, targetRate='1000M',
+                 runner=subprocess.run, log=print):
+        self.rootDir = os.path.abspath(rootDir)
+        self.destination = destination
+        self.ascp = ascp
+        self.workingDir = workingDir
+        self.chunkSize = chunkSize
+        self.concurrency = concurrency
+        self.targetRate = targetRate
+        self.runner = runner
+        self.log = log
+        os.makedirs(workingDir, exist_ok=True)
+        self.journal = UploadJournal(os.path.join(workingDir, 'journal.json'))
+
+    def getAscpCommand(self, manifestFn):
+        return [self.ascp, '-T', '-k', '2', '--overwrite=diff',
+                '-l', self.targetRate, '-P', str(ASPERA_PORT), '-O', str(ASPERA_PORT),
+                '--mode=send', '--user', ASPERA_USER, '--host', ASPERA_HOST,
+                '--src-base', os.path.dirname(self.rootDir),
+                '--file-list', manifestFn, self.destination]
+
+    def uploadChunk(self, chunk):
+        """ Upload the files of a chunk and return its stats. """
+        manifestFn = os.path.join(self.workingDir, f'{chunk.id}.txt')
+        with open(manifestFn, 'w') as f:
+            for fn, _ in chunk.files:
+                f.write(os.path.join(os.path.dirname(self.rootDir), fn) + '\n')
+
+        start = time.time()
+        result = self.runner(self.getAscpCommand(manifestFn), env=os.environ.copy())
+        if result.returncode != 0:
+            raise RuntimeError(f"ascp failed for chunk {chunk.id} "
+                               f"(exit code {result.returncode})")
+        seconds = max(time.time() - start, 1e-6)
+        stats = {'files': len(chunk), 'bytes': chunk.size,
+                 'seconds': round(seconds, 3), 'bytesPerSecond': chunk.size / seconds}
+        self.journal.markDone(chunk.id, stats)
+        self.log(f"Chunk {chunk.id}: {len(chunk)} files, {chunk.size} bytes "
+                 f"in {seconds:0.1f} s ({chunk.size / seconds / 1024 ** 2:0.1f} MB/s)")
+        return stats
+
+    def run(self):
+        """ Upload the pending chunks. Raise RuntimeError if any of them
+        failed, once the others are done (and recorded in the journal). """
+        brokenLinks = []
+        chunks = buildChunks(self.rootDir, self.chunkSize, brokenLinks)
+        if brokenLinks:
+            self.log(f"{len(brokenLinks)} broken links skipped, e.g. "
+                     f"{', '.join(brokenLinks[:5])}")
+        pending = [c for c in chunks if not self.journal.isDone(c.id)]
+        self.log(f"Uploading {len(pending)} of {len(chunks)} chunks "
+                 f"({sum(c.size for c in pending)} bytes)")
+
+        errors = []
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = [executor.submit(self.uploadChunk, c) for c in pending]
+            for future in futures:
+                try:
+                    future.result()
+                except Exception as e:
+                    errors.append(str(e))
+        if errors:
+            raise RuntimeError("Upload not completed, it can be resumed:\n" + '\n'.join(errors))
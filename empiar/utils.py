@@ -26,7 +26,6 @@
 
 import os
 import json
-import requests
 import ftplib
 
 import pyworkflow.utils as pwutils
@@ -36,6 +35,7 @@ def readFromEmpiar(entryId):
     """ Access a specific dataset from EMPIAR repository.
     :param entryId: Entry ID
     """
+    import requests
     empiarUrl = 'https://www.ebi.ac.uk/empiar/api/entry/' + entryId  # URL of EMPIAR API
 
     jsonFile = requests.get(empiarUrl, allow_redirects=True)               # getting the json file
@@ -72,13 +72,19 @@ def readFromEmpiar(entryId):
 class FTPDownloader:
     """ Downloads files from an FTP server with a limit, a filter
     and a callback called on each downloaded file"""
-    def __init__(self, server, username='anonymous', password='', fnFilter=None):
+    def __init__(self, server, username='anonymous', password='', fnFilter=None,
+                 findLocalFile=None, store=None, entryId=None):
         self.server = server
         self.username = username
         self.password = password
         self.ftp_client = None
         self.download_count = 0
         self.filter = fnFilter
+        # returns the local file of an already downloaded file or None
+        self.findLocalFile = findLocalFile or (lambda path: path if os.path.exists(path) else None)
+        # optional DownloadStore shared between projects, files are keyed by entry
+        self.store = store
+        self.entryId = entryId
 
     def _getFtp(self):
         if not self.ftp_client:
@@ -118,6 +124,42 @@ class FTPDownloader:
 
         ftp.close()
 
+    def _closeFtp(self):
+        if self.ftp_client:
+            try:
+                self.ftp_client.close()
+            except ftplib.all_errors:
+                pass
+            self.ftp_client = None
+
+    def fetchFile(self, remoteFile, localPath):
+        """ Download a remote file (absolute path) into a local file. The
+        connection is opened again once if the server closed it (e.g. after
+        a long time idle between files). """
+        for attempt in range(2):
+            try:
+                with open(localPath, 'wb') as f:
+                    self._getFtp().retrbinary('RETR ' + remoteFile, f.write)
+                return
+            except (EOFError, OSError, ftplib.error_temp):
+                self._closeFtp()
+                if attempt:
+                    raise
+
+    def listFiles(self, remoteFolder):
+        """ Return (remote path, size) of the files under a remote folder
+        (recursively) matching the filter, without downloading them. It
+        uses MLSD, so a single command per folder gives names and sizes. """
+        files = []
+        ftp = self._getFtp()
+        for name, facts in ftp.mlsd(remoteFolder, facts=['type', 'size']):
+            remotePath = '/'.join([remoteFolder.rstrip('/'), name])
+            if facts.get('type') == 'dir':
+                files.extend(self.listFiles(remotePath))
+            elif facts.get('type') == 'file' and self.matchFilter(name):
+                files.append((remotePath, int(facts.get('size', 0))))
+        return files
+
     def matchFilter(self, file):
         if self.filter is None:
             return True
@@ -147,29 +189,8 @@ class FTPDownloader:
                 print(f"File limit of {limit} reached!")
                 return
 
-    def isFolder(self, folder):
-        try:
-            self.ftp_client.cwd(folder)
-            return True
-        except ftplib.error_perm:
-            return False
-
-    def _downloadFile(self, file, downloadFolder, fileReadyCallback=None):
-        """ Downloads a single file using current ftp status (cwd)"""
-        finalPath = os.path.join(downloadFolder, file)
-        if os.path.exists(finalPath):
-            # TODO: more robust check in case local file is partially downloaded..
-            #  size?.
-            #  Download with a suffix?
-            print(f"{finalPath} exists. Skipping download.")
-            fileReadyCallback(finalPath)
-            self.download_count += 1
-            return
-
-        # Start actual downloading
-        fhandle = open(finalPath, 'wb')
-        print(pwutils.yellowStr(f"Downloading: {finalPath}"), flush=True)
-
+    def _retrieve(self, file, fhandle):
+        """ Write a remote file (in the cwd) into an open local file. """
         bytesDownloaded = 0
         SIZE_100MB = 1024*1024*100
         nextPrint = SIZE_100MB
@@ -189,7 +210,54 @@ class FTPDownloader:
                 nextPrint += SIZE_100MB
 
         self.ftp_client.retrbinary('RETR ' + file, downloadListener)
-        fhandle.close()
+
+    def _fetchFromStore(self, file, finalPath):
+        """ Get a remote file (in the cwd) through the shared store: it is
+        only downloaded if the store does not have this version yet. """
+        ftp = self.ftp_client
+        ftp.voidcmd('TYPE I')  # SIZE needs binary mode
+        remotePath = '/'.join([ftp.pwd().rstrip('/'), file])
+        size = ftp.size(file)
+        try:
+            mtime = ftp.voidcmd('MDTM ' + file)[4:].strip()
+        except ftplib.error_perm:  # MDTM not supported, only the size tells versions apart
+            mtime = ''
+
+        def download(localFn):
+            print(pwutils.yellowStr(f"Downloading into the shared store: {remotePath}"), flush=True)
+            with open(localFn, 'wb') as fhandle:
+                self._retrieve(file, fhandle)
+
+        method = self.store.fetch(self.entryId, remotePath, size, mtime, download, finalPath)
+        print(f"{finalPath} taken from the shared store ({method})", flush=True)
+
+    def isFolder(self, folder):
+        try:
+            self.ftp_client.cwd(folder)
+            return True
+        except ftplib.error_perm:
+            return False
+
+    def _downloadFile(self, file, downloadFolder, fileReadyCallback=None):
+        """ Downloads a single file using current ftp status (cwd)"""
+        finalPath = os.path.join(downloadFolder, file)
+        localPath = self.findLocalFile(finalPath)
+        if localPath:
+            # TODO: more robust check in case local file is partially downloaded..
+            #  size?.
+            #  Download with a suffix?
+            print(f"{localPath} exists. Skipping download.")
+            fileReadyCallback(localPath)
+            self.download_count += 1
+            return
+
+        # Start actual downloading
+        if self.store is not None:
+            self._fetchFromStore(file, finalPath)
+        else:
+            print(pwutils.yellowStr(f"Downloading: {finalPath}"), flush=True)
+            with open(finalPath, 'wb') as fhandle:
+                self._retrieve(file, fhandle)
         self.download_count += 1
 
         # Call the callback..
@@ -0,0 +1,62 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+from pyworkflow.wizard import Wizard
+from pyworkflow.object import String
+from pyworkflow.gui import dialog
+from pyworkflow.gui.tree import ListTreeProviderString
+
+from empiar import Plugin
+from empiar.constants import EMPIAR_CATALOG
+from empiar.catalog import EmpiarCatalog, parseQuery, formatResult
+from empiar.protocols import EmpiarDownloader
+
+
+class EmpiarCatalogWizard(Wizard):
+    """ Choose the entry to download among the image sets of the local
+    EMPIAR catalog that match the catalog query. """
+    _targets = [(EmpiarDownloader, ['entryId'])]
+
+    def show(self, form, *params):
+        protocol = form.protocol
+        try:
+            with EmpiarCatalog(Plugin.getVar(EMPIAR_CATALOG)) as catalog:
+                results = catalog.search(**parseQuery(protocol.catalogQuery.get() or ''))
+        except Exception as e:
+            dialog.showError("EMPIAR catalog", f"The catalog can not be searched: {e}", form.root)
+            return
+
+        if not results:
+            dialog.showInfo("EMPIAR catalog", "No image sets match the catalog query. "
+                            "Is the catalog updated? (scipion3 python -m empiar.catalog update)",
+                            form.root)
+            return
+
+        provider = ListTreeProviderString([String(formatResult(r)) for r in results])
+        dlg = dialog.ListDialog(form.root, "EMPIAR catalog", provider,
+                                "Select the EMPIAR entry to download")
+        if dlg.resultYes():
+            form.setVar('entryId', dlg.values[0].get().split()[0])
@@ -0,0 +1,276 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+""" Helpers to export the Scipion workflow shown by the EMPIAR viewer. """
+
+import os
+import re
+import gzip
+import json
+import textwrap
+
+ROOT_NODE = 'root'
+# sizes used by the viewer to draw the nodes (pixels)
+CHAR_WIDTH = 7
+NODE_PADDING = 10
+NODE_SEPARATION = 20
+RANK_SEPARATION = 60
+ORDERING_SWEEPS = 4
+
+_INPUT_REGEX = re.compile(r'^(\d+)\.')
+
+
+def getAncestors(parentsIndex, startIds):
+    """ Return the ids of the given nodes and all their ancestors.
+    :param parentsIndex: dict {node id: iterable of parent ids}
+    :param startIds: ids of the nodes to start from
+    """
+    ancestors = set()
+    pending = list(startIds)
+    while pending:
+        nodeId = pending.pop()
+        if nodeId not in ancestors:
+            ancestors.add(nodeId)
+            pending.extend(parentsIndex.get(nodeId, ()))
+    return ancestors
+
+
+class JsonListWriter:
+    """ Write a json list item by item, so the whole list never needs
+    to be in memory. Optionally, a gzip compressed copy is written
+    at the same time (<path>.gz). Files are written with a .tmp suffix
+    and only renamed when closed without errors, so a failed export
+    never leaves a truncated (but valid) list.
+    """
+    def __init__(self, path, indent=4, gzipCopy=False):
+        self._indent = indent
+        self._separators = (',', ': ') if indent else (',', ':')
+        self._paths = [path] + ([path + '.gz'] if gzipCopy else [])
+        self._files = [open(path + '.tmp', 'w')]
+        if gzipCopy:
+            self._files.append(gzip.open(path + '.gz.tmp', 'wt'))
+        self._count = 0
+        self._write('[')
+
+    def _write(self, text):
+        for f in self._files:
+            f.write(text)
+
+    def write(self, item):
+        text = json.dumps(item, indent=self._indent, separators=self._separators)
+        if self._indent:
+            text = '\n' + textwrap.indent(text, ' ' * self._indent)
+        self._write((',' if self._count else '') + text)
+        self._count += 1
+
+    def close(self, discard=False):
+        """ Finish the list and put the files in place, or remove them
+        if discard. """
+        if not discard:
+            self._write('\n]' if self._indent and self._count else ']')
+        for f in self._files:
+            f.close()
+        for path in self._paths:
+            if discard:
+                os.remove(path + '.tmp')
+            else:
+                os.replace(path + '.tmp', path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, *args):
+        self.close(discard=excType is not None)
+
+
+class WorkflowCache:
+    """ Store the workflow fragment of each protocol (outputs, summary,
+    log...) together with a fingerprint of the protocol state, so the
+    fragment can be reused next time if the protocol did not change.
+    Each fragment is kept in its own file and only loaded when needed.
+    """
+    INDEX = 'fingerprints.json'
+
+    def __init__(self, folder):
+        self._folder = folder
+        os.makedirs(folder, exist_ok=True)
+        self._index = {}
+        indexFn = os.path.join(folder, self.INDEX)
+        if os.path.exists(indexFn):
+            try:
+                with open(indexFn) as f:
+                    self._index = json.load(f)
+            except ValueError:
+                pass  # corrupted index, everything will be recomputed
+
+    def _getFragmentFn(self, key):
+        return os.path.join(self._folder, f'{key}.json')
+
+    def get(self, key, fingerprint):
+        """ Return the cached fragment or None if the fingerprint changed. """
+        key = str(key)
+        fragmentFn = self._getFragmentFn(key)
+        if self._index.get(key) != fingerprint or not os.path.exists(fragmentFn):
+            return None
+        with open(fragmentFn) as f:
+            return json.load(f)
+
+    def set(self, key, fingerprint, fragment):
+        key = str(key)
+        with open(self._getFragmentFn(key), 'w') as f:
+            json.dump(fragment, f)
+        # round trip so it compares equal to the one read from disk
+        self._index[key] = json.loads(json.dumps(fingerprint))
+
+    def save(self):
+        with open(os.path.join(self._folder, self.INDEX), 'w') as f:
+            json.dump(self._index, f)
+
+
+def getInputProtocolIds(protDict):
+    """ Return the ids of the protocols a protocol takes inputs from, as
+    strings, reading the pointers ('<protId>.<output>') in its json, the
+    same way the viewer does. """
+    ids = []
+    for key, value in protDict.items():
+        if key == 'pluginVersion':
+            continue
+        for item in value if isinstance(value, list) else [value]:
+            match = _INPUT_REGEX.match(item) if isinstance(item, str) else None
+            if match and match.group(1) not in ids:
+                ids.append(match.group(1))
+    return ids
+
+
+def layoutDag(nodes, parents):
+    """ Compute a layered layout of the workflow graph: each node goes one
+    rank below its deepest parent and the nodes of a rank are ordered by
+    the mean position of their neighbours, sweeping down and up a few
+    times to reduce crossings.
+    :param nodes: list of (node id, label), in the order to start with
+    :param parents: dict {node id: list of parent ids}
+    :return: dict {node id: {'x': x, 'y': y}} with the node centers
+    """
+    ids = [nodeId for nodeId, _ in nodes]
+    known = set(ids)
+    parents = {nodeId: [p for p in parents.get(nodeId, ()) if p in known]
+               for nodeId in ids}
+    children = {nodeId: [] for nodeId in ids}
+    for nodeId in ids:
+        for parent in parents[nodeId]:
+            children[parent].append(nodeId)
+
+    # ranks by longest path, in topological order (Kahn)
+    rank = {}
+    pending = {nodeId: len(parents[nodeId]) for nodeId in ids}
+    queue = [nodeId for nodeId in ids if not pending[nodeId]]
+    while queue:
+        nodeId = queue.pop(0)
+        rank[nodeId] = max((rank[p] + 1 for p in parents[nodeId]), default=0)
+        for child in children[nodeId]:
+            pending[child] -= 1
+            if not pending[child]:
+                queue.append(child)
+    for nodeId in ids:  # nodes in a cycle, should not happen
+        rank.setdefault(nodeId, max(rank.values(), default=-1) + 1)
+
+    layers = [[] for _ in range(max(rank.values(), default=-1) + 1)]
+    for nodeId in ids:
+        layers[rank[nodeId]].append(nodeId)
+
+    def sortLayer(layer, neighbours, order):
+        def barycenter(nodeId):
+            positions = [order[n] for n in neighbours[nodeId]]
+            return sum(positions) / len(positions) if positions else order[nodeId]
+        layer.sort(key=barycenter)
+        order.update((nodeId, i) for i, nodeId in enumerate(layer))
+
+    order = {nodeId: i for layer in layers for i, nodeId in enumerate(layer)}
+    for _ in range(ORDERING_SWEEPS):
+        for layer in layers[1:]:
+            sortLayer(layer, parents, order)
+        for layer in reversed(layers[:-1]):
+            sortLayer(layer, children, order)
+
+    # each rank is centered around x = 0
+    widths = {nodeId: len(label) * CHAR_WIDTH + 2 * NODE_PADDING for nodeId, label in nodes}
+    positions = {}
+    for r, layer in enumerate(layers):
+        x = -(sum(widths[n] for n in layer) + NODE_SEPARATION * (len(layer) - 1)) / 2
+        for nodeId in layer:
+            positions[nodeId] = {'x': round(x + widths[nodeId] / 2), 'y': r * RANK_SEPARATION}
+            x += widths[nodeId] + NODE_SEPARATION
+    return positions
+
+
+class WorkflowIndexWriter:
+    """ Write the workflow for the viewer as a small index (nodes with
+    their precomputed positions, edges and colors) and one detail file
+    per protocol (<shards folder>/<protocol id>.json), that the viewer
+    only loads when the protocol is opened.
+    """
+    def __init__(self, indexPath, shardsFolder):
+        self._indexPath = indexPath
+        self._shardsFolder = shardsFolder
+        os.makedirs(shardsFolder, exist_ok=True)
+        self._nodes = [(ROOT_NODE, 'Project')]
+        self._colors = {}
+        self._parents = {}
+
+    def write(self, protDict):
+        protId = str(protDict['object.id'])
+        with open(os.path.join(self._shardsFolder, f'{protId}.json'), 'w') as f:
+            json.dump(protDict, f, separators=(',', ':'))
+        self._nodes.append((protId, protDict['object.label']))
+        if 'labelColor' in protDict:
+            self._colors[protId] = protDict['labelColor']
+        self._parents[protId] = getInputProtocolIds(protDict) or [ROOT_NODE]
+
+    def close(self):
+        # parents outside the exported workflow are drawn as the root
+        known = {nodeId for nodeId, _ in self._nodes}
+        parents = {nodeId: list(dict.fromkeys(p if p in known else ROOT_NODE for p in nodeParents))
+                   for nodeId, nodeParents in self._parents.items()}
+        positions = layoutDag(self._nodes, parents)
+        shards = os.path.relpath(self._shardsFolder, os.path.dirname(self._indexPath))
+        index = {
+            'shards': shards.replace(os.sep, '/'),
+            'nodes': [{'id': nodeId, 'name': label,
+                       'color': self._colors.get(nodeId, '#EEEEEE'),
+                       'position': positions[nodeId]}
+                      for nodeId, label in self._nodes],
+            'edges': [{'source': parent, 'target': nodeId}
+                      for nodeId, nodeParents in parents.items() for parent in nodeParents]
+        }
+        with open(self._indexPath, 'w') as f:
+            json.dump(index, f, separators=(',', ':'))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, *args):
+        # the index of a failed export is not written
+        if excType is None:
+            self.close()
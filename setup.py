@@ -37,7 +37,8 @@ setup(
     install_requires=['empiar-depositor', 'jsonschema', 'scipion-em'],
     package_data={
        'empiar': ['EMPIAR_logo.png',
-                  'templates/empiar_deposition_template.json', 'protocols.conf'],
+                  'templates/empiar_deposition_template.json', 'protocols.conf',
+                  'tests/data/*.json'],
     },
     entry_points={
         'pyworkflow.plugin': 'empiar = empiar'